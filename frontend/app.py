@@ -23,6 +23,11 @@ def classify_sentence():
             return cap_allocation
 
 
+@app.route('/classify/stats')
+def classify_stats():
+    return jsonify(sentence_classifier.stats())
+
+
 @app.route('/chart/<symbol>')
 def eod_historical_prices(symbol: str = 'LPG'):
     if "_" in symbol:
@@ -72,6 +77,9 @@ def timeline(symbol: str = 'LPG'):
             for event in corp_timeline['events']:
                 event['event'] = display_names[event['corp_alloc']]
                 events.append(event)
+            if len(events) > 0:
+                # Unchanged timelines aren't rewritten so the open period is stored with the date it was last written
+                events[-1]['end'] = datetime.date.today().isoformat()
 
         except elasticsearch.exceptions.NotFoundError as e:
             # default answer
@@ -0,0 +1,309 @@
+"""
+A two tier cascade in front of the spaCy capital allocation classifier.
+
+A linear model over hashed word n-grams is trained on the spaCy model's own labels. It answers the sentences it is
+confident about and only the sentences below the confidence margin go through the full spaCy pipeline.
+
+The linear model's softmax is not the same distribution as the textcat scores the downstream thresholds were tuned on.
+Training holds out a tenth of the sentences and fits a temperature so the linear model's probabilities match spaCy's
+scores on them. The sentences the linear model answers still get its calibrated softmax which always sums to one.
+
+Train with the sentences the pipeline sees (one per line) and evaluate on a held out set:
+    python cascade_classifier.py train -i sentences.txt -m cascade.npz
+    python cascade_classifier.py evaluate -i held_out.txt -m cascade.npz -mg 0.5
+"""
+
+import argparse
+import sys
+import re
+import time
+import zlib
+import hashlib
+import logging
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+(?:['’.]\w+)*", re.UNICODE)
+
+DIMENSIONS = 2 ** 18
+
+
+def hashed_features(sentences: list, dimensions: int = DIMENSIONS):
+    """
+    Sparse L2 normalized hashed unigram and bigram counts plus a bias feature in column 0
+    :param sentences:
+    :param dimensions:
+    :return: CSR arrays indptr, indices and values
+    """
+    indptr = [0]
+    indices = []
+    values = []
+    for sentence in sentences:
+        tokens = TOKEN_PATTERN.findall(sentence.lower())
+        counts = {0: 1.0}
+        for feature in tokens + [first + ' ' + second for first, second in zip(tokens, tokens[1:])]:
+            column = 1 + zlib.crc32(feature.encode('utf-8')) % (dimensions - 1)
+            counts[column] = counts.get(column, 0.0) + 1.0
+        row_values = np.array(list(counts.values()), dtype=np.float32)
+        indices.extend(counts.keys())
+        values.extend(row_values / np.linalg.norm(row_values))
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64), np.array(values, dtype=np.float32)
+
+
+class HashedLinearModel:
+    """
+    Softmax regression over hashed features
+    """
+
+    def __init__(self, labels: list, weights: np.ndarray = None, dimensions: int = DIMENSIONS,
+                 temperature: float = 1.0):
+        self.labels = list(labels)
+        self.dimensions = dimensions
+        self.weights = weights if weights is not None else np.zeros((dimensions, len(labels)), dtype=np.float32)
+        self.temperature = temperature
+
+    @property
+    def identity(self):
+        digest = hashlib.sha1(self.weights.tobytes())
+        digest.update(repr(self.temperature).encode('utf-8'))
+        return digest.hexdigest()[:12]
+
+    def _logits(self, indptr, indices, values):
+        rows = self.weights[indices] * values[:, None]
+        # Every row has the bias feature so none of the reduceat slices are empty
+        return np.add.reduceat(rows, indptr[:-1], axis=0)
+
+    def predict_proba(self, sentences: list):
+        """
+        :param sentences:
+        :return: matrix of label probabilities with a row per sentence
+        """
+        if len(sentences) == 0:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        return softmax(self._logits(*hashed_features(sentences, self.dimensions)) / self.temperature)
+
+    def calibrate(self, sentences: list, target_cats: list, temperatures: np.ndarray = None):
+        """
+        Pick the temperature whose probabilities are closest in cross entropy to the target scores
+        :param sentences: Held out sentences
+        :param target_cats: The spaCy cats of each sentence
+        :param temperatures: Candidate temperatures
+        :return:
+        """
+        if temperatures is None:
+            temperatures = np.exp(np.linspace(np.log(0.25), np.log(8.0), 61))
+        targets = np.array([[cats.get(label, 0.0) for label in self.labels] for cats in target_cats],
+                           dtype=np.float64)
+        # Multi label scores don't sum to one so compare the distributions they imply
+        targets /= np.maximum(targets.sum(axis=1, keepdims=True), 1e-12)
+        logits = self._logits(*hashed_features(sentences, self.dimensions)).astype(np.float64)
+        losses = [-np.mean(np.sum(targets * np.log(np.maximum(softmax(logits / temperature), 1e-12)), axis=1))
+                  for temperature in temperatures]
+        self.temperature = float(temperatures[int(np.argmin(losses))])
+        return self
+
+    def fit(self, sentences: list, labels: list, epochs: int = 5, batch_size: int = 256, learning_rate: float = 0.5,
+            seed: int = 0):
+        """
+        Mini batch Adagrad on the cross entropy of the labels
+        :param sentences:
+        :param labels: The label of each sentence
+        :param epochs:
+        :param batch_size:
+        :param learning_rate:
+        :param seed:
+        :return:
+        """
+        targets = np.array([self.labels.index(label) for label in labels])
+        indptr, indices, values = hashed_features(sentences, self.dimensions)
+        squared_grads = np.full_like(self.weights, 1e-8)
+        random = np.random.RandomState(seed)
+        for epoch in range(epochs):
+            order = random.permutation(len(sentences))
+            for start in range(0, len(order), batch_size):
+                rows = order[start:start + batch_size]
+                row_starts, row_ends = indptr[rows], indptr[rows + 1]
+                lengths = row_ends - row_starts
+                batch_positions = np.concatenate([np.arange(s, e) for s, e in zip(row_starts, row_ends)])
+                batch_indptr = np.concatenate([[0], np.cumsum(lengths)])
+                batch_indices, batch_values = indices[batch_positions], values[batch_positions]
+
+                logits = self._logits(batch_indptr, batch_indices, batch_values)
+                logits -= logits.max(axis=1, keepdims=True)
+                probs = np.exp(logits)
+                probs /= probs.sum(axis=1, keepdims=True)
+                probs[np.arange(len(rows)), targets[rows]] -= 1
+
+                # Only the features in the batch have a gradient so only update those rows
+                features, positions = np.unique(batch_indices, return_inverse=True)
+                grads = np.zeros((len(features), len(self.labels)), dtype=np.float32)
+                np.add.at(grads, positions, np.repeat(probs, lengths, axis=0) * batch_values[:, None])
+                grads /= len(rows)
+                squared_grads[features] += grads ** 2
+                self.weights[features] -= learning_rate * grads / np.sqrt(squared_grads[features])
+        return self
+
+    def save(self, path: str):
+        np.savez_compressed(path, weights=self.weights, labels=np.array(self.labels),
+                            temperature=np.array(self.temperature))
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path) as saved:
+            weights = saved['weights']
+            # Models saved before calibration use the raw softmax
+            temperature = float(saved['temperature']) if 'temperature' in saved.files else 1.0
+            return HashedLinearModel(labels=[str(label) for label in saved['labels']], weights=weights,
+                                     dimensions=weights.shape[0], temperature=temperature)
+
+
+def softmax(logits: np.ndarray):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+def cascade_classify(model: HashedLinearModel, sentences: list, slow_classify, margin: float = 0.5):
+    """
+    Classify with the linear model where the top two labels are at least margin apart and with slow_classify otherwise
+    :param model:
+    :param sentences:
+    :param slow_classify: function of a list of sentences returning a list of cats dicts e.g. the spaCy pipeline
+    :param margin:
+    :return: a cats dict per sentence in the same format as doc.cats and how many the linear model answered
+    """
+    probs = model.predict_proba(sentences)
+    top_two = np.sort(probs, axis=1)[:, -2:]
+    confident = (top_two[:, 1] - top_two[:, 0]) >= margin
+
+    results = [None] * len(sentences)
+    for i in np.nonzero(confident)[0]:
+        results[i] = {label: float(prob) for label, prob in zip(model.labels, probs[i])}
+
+    uncertain = np.nonzero(~confident)[0]
+    if len(uncertain) > 0:
+        for i, cats in zip(uncertain, slow_classify([sentences[i] for i in uncertain])):
+            results[i] = cats
+    return results, int(confident.sum())
+
+
+def top_label(cats: dict):
+    return max(cats.items(), key=lambda cat: cat[1])[0]
+
+
+def read_sentences(path: str):
+    with open(path, 'r') as sentence_file:
+        return [line.strip() for line in sentence_file if len(line.strip()) > 0]
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Train or evaluate the linear first pass of the capital allocation classifier cascade")
+    parser.add_argument(
+        dest="command",
+        help="train on the spaCy labels of the sentences or evaluate the cascade against spaCy",
+        choices=["train", "evaluate"])
+    parser.add_argument(
+        "-i",
+        dest="sentence_file",
+        help="A file of sentences one per line",
+        type=str)
+    parser.add_argument(
+        "-m",
+        dest="model_file",
+        help="The linear model file",
+        type=str,
+        default="cascade.npz")
+    parser.add_argument(
+        "-mg",
+        dest="margin",
+        help="Min difference between the top two linear model probabilities to skip spaCy",
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        "-e",
+        dest="epochs",
+        help="Training epochs",
+        type=int,
+        default=5)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO)
+    return parser.parse_args(args)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    logging.basicConfig(level=args.loglevel or logging.WARNING, stream=sys.stdout,
+                        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    # The same model and components sentence_classifier.py falls back to
+    import sentence_classifier
+
+    nlp = sentence_classifier.load_model()
+
+    def spacy_classify(sentences):
+        return [dict(doc.cats) for doc in nlp.pipe(sentences, batch_size=64)]
+
+    sentences = read_sentences(args.sentence_file)
+    start = time.time()
+    spacy_cats = spacy_classify(sentences)
+    spacy_secs = time.time() - start
+    spacy_labels = [top_label(cats) for cats in spacy_cats]
+
+    if args.command == "train":
+        held_out = np.arange(len(sentences)) % 10 == 9
+        train_rows, held_out_rows = np.nonzero(~held_out)[0], np.nonzero(held_out)[0]
+        model = HashedLinearModel(labels=list(spacy_cats[0].keys()))
+        model.fit([sentences[i] for i in train_rows], [spacy_labels[i] for i in train_rows], epochs=args.epochs)
+        model.calibrate([sentences[i] for i in held_out_rows], [spacy_cats[i] for i in held_out_rows])
+        model.save(args.model_file)
+        print("Trained on {count} sentences, calibrated with temperature {temperature:.2f} on {held_out} and saved "
+              "to {file}".format(count=len(train_rows), temperature=model.temperature, held_out=len(held_out_rows),
+                                 file=args.model_file))
+        return
+
+    model = HashedLinearModel.load(args.model_file)
+    start = time.time()
+    cascade_cats, fast_count = cascade_classify(model, sentences, spacy_classify, args.margin)
+    cascade_secs = time.time() - start
+    agreement = np.mean([top_label(cats) == label for cats, label in zip(cascade_cats, spacy_labels)])
+    # How far the probabilities the thresholds see moved for the sentences the linear model answered. The others
+    # come from spaCy and don't move.
+    prob_error = sum(abs(cats[label] - spacy[label]) for cats, spacy in zip(cascade_cats, spacy_cats)
+                     for label in spacy) / max(fast_count * len(model.labels), 1)
+    print("Sentences:              {0}".format(len(sentences)))
+    print("Answered by linear:     {0:.1%}".format(fast_count / len(sentences)))
+    print("Agreement with spaCy:   {0:.2%}".format(agreement))
+    print("Mean prob difference:   {0:.4f}".format(prob_error))
+    print("spaCy sentences/sec:    {0:.1f}".format(len(sentences) / spacy_secs))
+    print("Cascade sentences/sec:  {0:.1f}".format(len(sentences) / cascade_secs))
+    print("Throughput gain:        {0:.2f}x".format(spacy_secs / cascade_secs))
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+A local classification service so the flask app and the classify-sentence workers on a machine share one pool of
+preloaded spaCy models instead of each loading their own.
+
+Concurrent requests from every client are merged into micro batches which are classified by a pool of worker processes.
+Point clients at it with CORP_ALLOC_CLASSIFY_SERVICE=http://localhost:8765
+
+    python classify_service.py -w 2 -bs 64 -mw 10
+
+POST /classify {"sentences": [...], "timeout": 30} returns {"cats": [...]} with a cats dict per sentence
+GET /stats returns queue depth, batch sizes, throughput and latency percentiles
+"""
+
+import argparse
+import sys
+import os
+import json
+import time
+import queue
+import logging
+import functools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+
+class ClassifyRequest:
+    """
+    One client's sentences waiting to be classified
+    """
+
+    def __init__(self, sentences: list, timeout: float):
+        self.sentences = sentences
+        self.received = time.time()
+        self.deadline = self.received + timeout
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def percentile(values: list, fraction: float):
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class MicroBatcher:
+    """
+    Merges requests from a bounded queue into batches of up to batch_size sentences. A batch is sent once it is full or
+    max_wait_ms after its first request arrived. At most one batch per worker is in flight so requests keep merging in
+    the queue while the workers are busy.
+    """
+
+    def __init__(self, classify, executor, workers: int = 1, batch_size: int = 64, max_wait_ms: int = 10,
+                 max_queue: int = 1000, model_id: str = None):
+        """
+
+        :param classify: function of a list of sentences returning a list of cats dicts. Must be picklable for a
+        process pool.
+        :param executor: concurrent.futures executor the batches are classified on
+        :param workers: Number of batches in flight at a time
+        :param batch_size: Max sentences in a batch. A single request larger than this is sent as its own batch.
+        :param max_wait_ms: Max time to wait for a batch to fill
+        :param max_queue: Max requests waiting. Requests beyond it are rejected.
+        :param model_id: The classifier version reported to clients
+        """
+        self.model_id = model_id
+        self.classify_fn = classify
+        self.executor = executor
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.slots = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.sentences = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sentences = 0
+        self.classify_secs = 0.0
+        self.latencies = deque(maxlen=10000)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, sentences: list, timeout: float):
+        """
+        :param sentences:
+        :param timeout: Seconds the client waits for the result
+        :return: the request to wait on
+        :raises queue.Full: when the queue is full
+        """
+        req = ClassifyRequest(sentences, timeout)
+        try:
+            self.queue.put_nowait(req)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        return req
+
+    def classify(self, sentences: list, timeout: float = 30):
+        """
+        Classify the sentences as part of the next batch
+        :param sentences:
+        :param timeout:
+        :return: a cats dict per sentence
+        :raises queue.Full: when the queue is full
+        :raises TimeoutError: when the sentences are not classified within the timeout
+        """
+        req = self.submit(sentences, timeout)
+        if not req.done.wait(timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise TimeoutError("Not classified within {0}s".format(timeout))
+
+        with self.lock:
+            self.latencies.append(time.time() - req.received)
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        count = len(batch[0].sentences)
+        deadline = time.time() + self.max_wait_ms / 1000
+        while count < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                req = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(req)
+            count += len(req.sentences)
+
+        # Nobody is waiting for the requests that already timed out
+        now = time.time()
+        return [req for req in batch if req.deadline > now]
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            batch = self._next_batch()
+            if len(batch) == 0:
+                self.slots.release()
+                continue
+
+            sentences = [sentence for req in batch for sentence in req.sentences]
+            try:
+                future = self.executor.submit(self.classify_fn, sentences)
+            except Exception as e:
+                self._fail(batch, e)
+                self.slots.release()
+                continue
+            future.add_done_callback(functools.partial(self._complete, batch, time.time()))
+
+    def _fail(self, batch: list, error: Exception):
+        _logger.error("Error classifying batch of {count} requests\n{error}".format(count=len(batch), error=error))
+        with self.lock:
+            self.errors += len(batch)
+        for req in batch:
+            req.error = error
+            req.done.set()
+
+    def _complete(self, batch: list, start: float, future):
+        self.slots.release()
+        try:
+            cats = future.result()
+        except Exception as e:
+            self._fail(batch, e)
+            return
+
+        with self.lock:
+            self.batches += 1
+            self.batch_sentences += len(cats)
+            self.classify_secs += time.time() - start
+            self.requests += len(batch)
+            self.sentences += len(cats)
+
+        offset = 0
+        for req in batch:
+            req.result = cats[offset:offset + len(req.sentences)]
+            offset += len(req.sentences)
+            req.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            uptime = time.time() - self.started
+            return {"model_id": self.model_id,
+                    "uptime_secs": uptime,
+                    "queue_depth": self.queue.qsize(),
+                    "requests": self.requests,
+                    "sentences": self.sentences,
+                    "rejected": self.rejected,
+                    "timeouts": self.timeouts,
+                    "errors": self.errors,
+                    "batches": self.batches,
+                    "mean_batch_size": self.batch_sentences / self.batches if self.batches > 0 else 0.0,
+                    "sentences_per_sec": self.sentences / uptime if uptime > 0 else 0.0,
+                    "classify_sentences_per_sec": self.batch_sentences / self.classify_secs
+                    if self.classify_secs > 0 else 0.0,
+                    "latency_ms": {"p50": percentile(latencies, 0.5) * 1000,
+                                   "p95": percentile(latencies, 0.95) * 1000,
+                                   "p99": percentile(latencies, 0.99) * 1000}}
+
+
+def make_handler(batcher: MicroBatcher, default_timeout: float = 30):
+    """
+    HTTP handler class bound to the batcher
+    :param batcher:
+    :param default_timeout: Used when the request doesn't set a timeout
+    :return:
+    """
+
+    class ClassifyHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            else:
+                self._reply(404, {"error": "Unknown path {0}".format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/classify':
+                self._reply(404, {"error": "Unknown path {0}".format(self.path)})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                sentences = [str(sentence) for sentence in body['sentences']]
+                timeout = float(body.get('timeout', default_timeout))
+            except Exception as e:
+                self._reply(400, {"error": "Bad request {0}".format(e)})
+                return
+
+            try:
+                self._reply(200, {"cats": batcher.classify(sentences, timeout)})
+            except queue.Full:
+                self._reply(503, {"error": "Queue full"})
+            except TimeoutError as e:
+                self._reply(504, {"error": str(e)})
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            _logger.debug(format % args)
+
+    return ClassifyHandler
+
+
+def init_worker():
+    """
+    Load the model when the worker starts rather than on its first batch
+    """
+    import sentence_classifier
+
+    sentence_classifier.get_nlp()
+
+
+def worker_model_id():
+    import sentence_classifier
+
+    return sentence_classifier.classifier_version()
+
+
+def classify_in_worker(sentences: list, batch_size: int = 64):
+    import sentence_classifier
+
+    return sentence_classifier.local_classify_sentences(sentences, batch_size=batch_size)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Local capital allocation classification service merging requests into micro batches")
+    parser.add_argument(
+        "-host",
+        dest="host",
+        help="The interface to listen on",
+        type=str,
+        default="127.0.0.1")
+    parser.add_argument(
+        "-p",
+        dest="port",
+        help="The port to listen on",
+        type=int,
+        default=8765)
+    parser.add_argument(
+        "-w",
+        dest="workers",
+        help="Number of worker processes each with its own copy of the model",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "-bs",
+        dest="batch_size",
+        help="Max sentences classified together",
+        type=int,
+        default=64)
+    parser.add_argument(
+        "-mw",
+        dest="max_wait_ms",
+        help="Max milliseconds to wait for a batch to fill",
+        type=int,
+        default=10)
+    parser.add_argument(
+        "-q",
+        dest="max_queue",
+        help="Max requests waiting. Requests beyond it are rejected with 503.",
+        type=int,
+        default=1000)
+    parser.add_argument(
+        "-t",
+        dest="timeout",
+        help="Seconds a request waits when it doesn't set a timeout",
+        type=float,
+        default=30)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO)
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG)
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel, stream=sys.stdout,
+                        format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel or logging.WARNING)
+
+    # The workers classify locally even if this machine's clients are pointed at the service
+    os.environ.pop('CORP_ALLOC_CLASSIFY_SERVICE', None)
+    # spawn so the workers don't inherit this process's threads or the classifier's sqlite connection
+    executor = ProcessPoolExecutor(max_workers=args.workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker)
+    batcher = MicroBatcher(functools.partial(classify_in_worker, batch_size=args.batch_size), executor,
+                           workers=args.workers, batch_size=args.batch_size, max_wait_ms=args.max_wait_ms,
+                           max_queue=args.max_queue, model_id=executor.submit(worker_model_id).result()).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, args.timeout))
+    _logger.critical("Classification service listening on {host}:{port} with {workers} workers".format(
+        host=args.host, port=args.port, workers=args.workers))
+    try:
+        server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -1,6 +1,312 @@
-import spacy
+import os
+import json
+import time
+import logging
+import sqlite3
+import hashlib
+import resource
+import threading
+import unicodedata
+from pathlib import Path
+from collections import OrderedDict
 
-NLP = spacy.load('corp_alloc_bal')
+_logger = logging.getLogger(__name__)
+
+MODEL_NAME = os.getenv('CORP_ALLOC_MODEL', 'corp_alloc_bal')
+# Only load the components the text classifier needs. Set to 0 to load the whole pipeline.
+TEXTCAT_ONLY = os.getenv('CORP_ALLOC_TEXTCAT_ONLY', '1') != '0'
+# Components the text classifier can depend on. Everything else in the pipeline is excluded.
+TEXTCAT_COMPONENTS = {'textcat', 'textcat_multilabel', 'tok2vec', 'transformer'}
+
+# Loaded on first use so importing the module is cheap
+NLP = None
+LOAD_STATS = {}
+_load_lock = threading.Lock()
+# The model identity and cache are set up on the first classification too
+MODEL_ID = None
+CACHE = None
+_cache_lock = threading.Lock()
+
+# Shared by the flask app and the classify-sentence workers on the same machine. Set to an empty string to only
+# cache in memory.
+CACHE_PATH = os.getenv('CORP_ALLOC_CACHE', os.path.join(os.path.expanduser('~'), '.corp_alloc_cache.sqlite'))
+CACHE_SIZE = int(os.getenv('CORP_ALLOC_CACHE_SIZE', '100000'))
+# Classifications older than this or beyond the newest CACHE_MAX_ROWS are evicted from the sqlite file whatever model
+# they belong to
+CACHE_MAX_AGE_DAYS = float(os.getenv('CORP_ALLOC_CACHE_MAX_AGE_DAYS', '30'))
+CACHE_MAX_ROWS = int(os.getenv('CORP_ALLOC_CACHE_MAX_ROWS', '5000000'))
+
+# Set to the url of a classify_service.py e.g. http://localhost:8765 to classify there instead of loading the model
+CLASSIFY_SERVICE_URL = os.getenv('CORP_ALLOC_CLASSIFY_SERVICE')
+CLASSIFY_SERVICE_TIMEOUT = float(os.getenv('CORP_ALLOC_CLASSIFY_SERVICE_TIMEOUT', '30'))
+
+# Set to a model trained with cascade_classifier.py to answer the confident sentences without spaCy
+CASCADE_PATH = os.getenv('CORP_ALLOC_CASCADE')
+CASCADE_MARGIN = float(os.getenv('CORP_ALLOC_CASCADE_MARGIN', '0.5'))
+CASCADE = None
+
+
+def model_path(name: str = MODEL_NAME):
+    """
+    :param name: An installed model package or a model directory
+    :return: The model directory
+    """
+    import spacy
+
+    path = Path(name)
+    if not path.exists():
+        path = spacy.util.get_package_path(name)
+    return path
+
+
+def model_meta(name: str = MODEL_NAME):
+    """
+    Reads the model's meta.json without loading the model
+    :param name: An installed model package or a model directory
+    :return:
+    """
+    import spacy
+
+    return spacy.util.get_model_meta(model_path(name))
+
+
+def weights_stamp(path: Path):
+    """
+    The path, size and modification time of the weights of every pipeline component i.e. the files named model
+    anywhere under the model directory. Only stats the files so every worker can afford it on start up.
+    :param path: model_path
+    :return:
+    """
+    stamps = [str(path.resolve())]
+    for weights in sorted(path.glob('**/model')):
+        if not weights.is_file():
+            continue
+        stat = weights.stat()
+        stamps.append("{name}:{size}:{mtime}".format(name=weights.relative_to(path), size=stat.st_size,
+                                                     mtime=stat.st_mtime_ns))
+    return '|'.join(stamps)
+
+
+def resident_memory_mb():
+    """
+    The current resident memory of the process falling back to the peak where /proc is not available
+    :return:
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def load_model(name: str = MODEL_NAME, textcat_only: bool = TEXTCAT_ONLY):
+    """
+    Loads the spaCy model excluding the pipeline components the text classifier doesn't need
+    :param name:
+    :param textcat_only:
+    :return:
+    """
+    import spacy
+
+    excluded = []
+    if textcat_only:
+        excluded = [pipe for pipe in model_meta(name).get('pipeline', []) if pipe not in TEXTCAT_COMPONENTS]
+
+    rss_before = resident_memory_mb()
+    start = time.time()
+    if spacy.__version__.startswith('2.'):
+        nlp = spacy.load(name, disable=excluded)
+    else:
+        nlp = spacy.load(name, exclude=excluded)
+
+    LOAD_STATS.update({"model": name,
+                       "excluded": excluded,
+                       "load_secs": time.time() - start,
+                       "model_rss_mb": resident_memory_mb() - rss_before,
+                       "rss_mb": resident_memory_mb()})
+    _logger.critical("Loaded {model} in {load_secs:.1f}s excluding {excluded} using {model_rss_mb:.0f}MB "
+                     "({rss_mb:.0f}MB resident)".format(**LOAD_STATS))
+    return nlp
+
+
+def get_nlp():
+    """
+    The spaCy model loaded on first use
+    :return:
+    """
+    global NLP
+    if NLP is None:
+        with _load_lock:
+            if NLP is None:
+                NLP = load_model()
+    return NLP
+
+
+def get_cache():
+    """
+    The classification cache set up on first use. Its identity comes from meta.json and the weight files so it is
+    ready without loading the model.
+    :return:
+    """
+    global MODEL_ID, CACHE, CASCADE
+    if CACHE is None:
+        with _cache_lock:
+            if CACHE is None:
+                MODEL_ID = model_identity(model_meta(), weights_stamp(model_path()))
+                cache_id = MODEL_ID
+                if CASCADE_PATH:
+                    import cascade_classifier
+
+                    CASCADE = cascade_classifier.HashedLinearModel.load(CASCADE_PATH)
+                    cache_id = "{model_id}+cascade-{cascade_id}-{margin}".format(model_id=MODEL_ID,
+                                                                                 cascade_id=CASCADE.identity,
+                                                                                 margin=CASCADE_MARGIN)
+                CACHE = ClassificationCache(cache_id)
+    return CACHE
+
+
+def model_identity(meta: dict, weights: str = ''):
+    """
+    Identifies the trained model so a retrained model never reads the classifications of the previous one.
+    Retraining often leaves meta.json as it was so where and when the weights were written is part of the identity.
+    :param meta: The model's meta.json
+    :param weights: weights_stamp of the model directory
+    :return:
+    """
+    meta_json = json.dumps(meta, sort_keys=True, default=str)
+    digest = hashlib.sha1((meta_json + weights).encode('utf-8')).hexdigest()[:12]
+    return "{name}-{version}-{digest}".format(name=meta.get('name'), version=meta.get('version'), digest=digest)
+
+
+def normalize_sentence(sentence: str):
+    """
+    The same sentence is repeated across filings with different white space so collapse it
+    :param sentence:
+    :return:
+    """
+    return ' '.join(unicodedata.normalize('NFKC', sentence).split())
+
+
+class ClassificationCache:
+    """
+    Classifications keyed by a hash of the normalized sentence and the model identity. An in-process LRU sits in
+    front of a sqlite file that survives restarts and is shared between processes.
+    """
+
+    def __init__(self, model_id: str, path: str = CACHE_PATH, max_size: int = CACHE_SIZE,
+                 max_age_days: float = CACHE_MAX_AGE_DAYS, max_rows: int = CACHE_MAX_ROWS):
+        self.model_id = model_id
+        self.max_size = max_size
+        self.max_age_days = max_age_days
+        self.max_rows = max_rows
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.puts_since_evict = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS classification "
+                            "(key TEXT PRIMARY KEY, model_id TEXT, cats TEXT, created REAL)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(classification)")]
+            if 'created' not in columns:
+                # Caches written before classifications were dated start their clock now
+                self.db.execute("ALTER TABLE classification ADD COLUMN created REAL")
+                self.db.execute("UPDATE classification SET created = ?", (time.time(),))
+            self.db.execute("CREATE INDEX IF NOT EXISTS classification_created ON classification (created)")
+            self.db.commit()
+            # Other processes on the machine can still be using other models so only evict by age and size
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the classifications older than max_age_days and the oldest ones beyond max_rows
+        :return: The number of classifications deleted
+        """
+        if self.db is None:
+            return 0
+        cursor = self.db.execute("DELETE FROM classification WHERE created < ?",
+                                 (time.time() - self.max_age_days * 86400,))
+        deleted = cursor.rowcount
+        extra = self.db.execute("SELECT COUNT(*) FROM classification").fetchone()[0] - self.max_rows
+        if extra > 0:
+            cursor = self.db.execute("DELETE FROM classification WHERE key IN "
+                                     "(SELECT key FROM classification ORDER BY created LIMIT ?)", (extra,))
+            deleted += cursor.rowcount
+        self.db.commit()
+        self.puts_since_evict = 0
+        if deleted > 0:
+            _logger.info("Evicted {count} cached classifications".format(count=deleted))
+        return deleted
+
+    def key(self, sentence: str):
+        return hashlib.sha1("{model_id}|{sentence}".format(model_id=self.model_id,
+                                                           sentence=sentence).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: list):
+        """
+        :param keys:
+        :return: dict of key to cats for the keys found
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.lru:
+                    self.lru.move_to_end(key)
+                    found[key] = self.lru[key]
+                    self.memory_hits += 1
+
+            missing = list(set(key for key in keys if key not in found))
+            stored = {}
+            if self.db is not None and len(missing) > 0:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = self.db.execute("SELECT key, cats FROM classification WHERE key IN ({0})".format(
+                        ','.join('?' * len(chunk))), chunk)
+                    for key, cats in rows:
+                        stored[key] = json.loads(cats)
+                        self._remember(key, stored[key])
+            found.update(stored)
+            self.store_hits += sum(1 for key in keys if key in stored)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: dict):
+        """
+        :param items: dict of key to cats
+        :return:
+        """
+        with self.lock:
+            for key, cats in items.items():
+                self._remember(key, cats)
+            if self.db is not None:
+                now = time.time()
+                self.db.executemany("INSERT OR REPLACE INTO classification (key, model_id, cats, created) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    [(key, self.model_id, json.dumps(cats), now) for key, cats in items.items()])
+                self.db.commit()
+                self.puts_since_evict += len(items)
+                if self.puts_since_evict >= self.max_size:
+                    self.evict()
+
+    def _remember(self, key: str, cats: dict):
+        self.lru[key] = cats
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.store_hits + self.misses
+        return {"model_id": self.model_id,
+                "lookups": lookups,
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.store_hits) / lookups if lookups > 0 else 0.0,
+                "memory_size": len(self.lru)}
 
 
 def classify_sentence(sentence: str, min_prob: float = 0.7, format: str = 'text'):
@@ -10,8 +316,8 @@ def classify_sentence(sentence: str, min_prob: float = 0.7, format: str = 'text'
     :param min_prob: Min cutoff probability
     :return:
     """
-    doc = NLP(sentence)
-    cap_alloc_states = sorted(doc.cats.items(), key=lambda cat: cat[1], reverse=True)
+    cats = classify_sentences([sentence])[0]
+    cap_alloc_states = sorted(cats.items(), key=lambda cat: cat[1], reverse=True)
     if format == 'text':
         state, prob = cap_alloc_states[0]
         if prob > min_prob:
@@ -19,5 +325,92 @@ def classify_sentence(sentence: str, min_prob: float = 0.7, format: str = 'text'
         else:
             return "unknown ({prob})".format(prob=prob)
     else:
-        return doc.cats
+        return cats
+
+
+def classify_sentences(sentences: list, batch_size: int = 64):
+    """
+    Classifies a batch of sentences with the classification service when one is configured and locally otherwise
+    :param sentences:
+    :param batch_size: Number of sentences spaCy processes at a time
+    :return: The capital allocation category probabilities of each sentence
+    """
+    if CLASSIFY_SERVICE_URL:
+        return service_classify_sentences(sentences)
+    return local_classify_sentences(sentences, batch_size)
+
+
+def service_classify_sentences(sentences: list, url: str = CLASSIFY_SERVICE_URL,
+                               timeout: float = CLASSIFY_SERVICE_TIMEOUT):
+    """
+    Classifies the sentences with classify_service.py which merges them into batches with other clients' sentences
+    :param sentences:
+    :param url:
+    :param timeout: Seconds the service has to classify them
+    :return:
+    """
+    import requests
+
+    response = requests.post(url.rstrip('/') + '/classify', json={"sentences": sentences, "timeout": timeout},
+                             timeout=timeout + 5)
+    response.raise_for_status()
+    return response.json()['cats']
+
+
+def classifier_version():
+    """
+    Identifies the model and cascade the classifications come from
+    :return:
+    """
+    global MODEL_ID
+    if CLASSIFY_SERVICE_URL:
+        if MODEL_ID is None:
+            MODEL_ID = stats()['model_id']
+        return MODEL_ID
+    return get_cache().model_id
+
+
+def stats():
+    """
+    Cache and model load stats or the service's batching stats when the service is used
+    :return:
+    """
+    if CLASSIFY_SERVICE_URL:
+        import requests
+
+        response = requests.get(CLASSIFY_SERVICE_URL.rstrip('/') + '/stats', timeout=CLASSIFY_SERVICE_TIMEOUT)
+        response.raise_for_status()
+        return dict(response.json(), service=CLASSIFY_SERVICE_URL)
+    return dict(get_cache().stats(), model=LOAD_STATS)
+
+
+def local_classify_sentences(sentences: list, batch_size: int = 64):
+    """
+    Classifies a batch of sentences with nlp.pipe which is several times faster than one call per sentence.
+    Sentences already in the cache are not classified again.
+    :param sentences:
+    :param batch_size: Number of sentences spaCy processes at a time
+    :return: The capital allocation category probabilities of each sentence
+    """
+    cache = get_cache()
+    normalized = [normalize_sentence(sentence) for sentence in sentences]
+    keys = [cache.key(sentence) for sentence in normalized]
+    cached = cache.get_many(keys)
+
+    to_classify = OrderedDict((key, sentence) for key, sentence in zip(keys, normalized) if key not in cached)
+    if len(to_classify) > 0:
+        def spacy_classify(uncertain_sentences):
+            return [dict(doc.cats) for doc in get_nlp().pipe(uncertain_sentences, batch_size=batch_size)]
+
+        if CASCADE is None:
+            cats = spacy_classify(list(to_classify.values()))
+        else:
+            import cascade_classifier
+
+            cats, _ = cascade_classifier.cascade_classify(CASCADE, list(to_classify.values()), spacy_classify,
+                                                          CASCADE_MARGIN)
+        classified = dict(zip(to_classify.keys(), cats))
+        cache.put_many(classified)
+        cached.update(classified)
 
+    return [cached[key] for key in keys]
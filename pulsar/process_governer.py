@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 """
+Keeps replicas of a worker command running and restarts the ones that die as soon as they exit, backing off the ones
+that keep crashing.
 
+With --autoscale the number of replicas follows the backlog of the topic's subscription polled from the Pulsar admin
+REST API e.g.
+    python process_governer.py 4 python -c_args="classify_sentence.py" -as classify-sentence -min 1 -max 8
+
+With --config every stage of the pipeline runs under one governor with its own replicas, cpus and memory ceiling
+    python process_governer.py --config pipeline.json
 """
 
 import argparse
@@ -8,6 +16,13 @@ import sys
 import logging
 import subprocess
 import time
+import json
+import math
+import os
+import queue
+import signal
+import threading
+import requests
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -16,6 +31,478 @@ __license__ = "mit"
 _logger = logging.getLogger(__name__)
 
 
+def topic_path(topic: str):
+    """
+    :param topic: Full topic name or a short one in public/default like the workers use
+    :return: persistent/tenant/namespace/topic as used in the admin REST paths
+    """
+    if '://' in topic:
+        domain, _, rest = topic.partition('://')
+        return "{0}/{1}".format(domain, rest)
+    return "persistent/public/default/{0}".format(topic)
+
+
+def subscription_metrics(stats: dict, subscription: str):
+    """
+    :param stats: Topic stats from the admin REST API
+    :param subscription:
+    :return: dict of the subscription's backlog, its consume rate and the topic's publish rate in msgs/sec
+    :raises: ValueError when the subscription doesn't exist so its replicas are held rather than scaled to zero
+    """
+    sub_stats = stats.get('subscriptions', {}).get(subscription)
+    if sub_stats is None:
+        raise ValueError("No subscription {subscription} in {subscriptions}".format(
+            subscription=subscription, subscriptions=sorted(stats.get('subscriptions', {}))))
+    return {'backlog': sub_stats.get('msgBacklog', 0),
+            'rate_out': sub_stats.get('msgRateOut', 0.0),
+            'rate_in': stats.get('msgRateIn', 0.0)}
+
+
+class PulsarAdminMetrics:
+    """
+    Polls a subscription's stats from the Pulsar admin REST API
+    """
+
+    def __init__(self, admin_url: str, topic: str, subscription: str, timeout: float = 10):
+        self.admin_url = admin_url.rstrip('/')
+        self.topic = topic
+        self.subscription = subscription
+        self.timeout = timeout
+
+    def stats(self):
+        url = "{admin}/admin/v2/{topic}".format(admin=self.admin_url, topic=topic_path(self.topic))
+        response = requests.get(url + "/stats", timeout=self.timeout)
+        if response.status_code in (404, 409):
+            # Partitioned topics only have the stats aggregated over the partitions
+            response = requests.get(url + "/partitioned-stats", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def __call__(self):
+        return subscription_metrics(self.stats(), self.subscription)
+
+
+class LocalMetrics(PulsarAdminMetrics):
+    """
+    Stand-in reading the stats from a JSON file in the admin REST API format so scaling can be tried without a broker
+    """
+
+    def __init__(self, path: str, topic: str, subscription: str):
+        super().__init__('', topic, subscription)
+        self.path = path
+
+    def stats(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+
+def backlog_metrics(admin_url: str, topic: str, subscription: str):
+    """
+    :param admin_url: e.g. http://10.0.0.11:8080 or file:stats.json for LocalMetrics
+    :param topic:
+    :param subscription:
+    :return:
+    """
+    if admin_url.startswith('file:'):
+        return LocalMetrics(admin_url[len('file:'):], topic, subscription)
+    return PulsarAdminMetrics(admin_url, topic, subscription)
+
+
+class Autoscaler:
+    """
+    Picks the number of replicas for a backlog. It scales up as soon as each replica has more than backlog_per_replica
+    messages waiting but only scales down once the backlog is below scale_down_ratio of that, so the count doesn't
+    flap around the threshold. Each change starts a cooldown before the next one in the same direction.
+    """
+
+    def __init__(self, min_replicas: int, max_replicas: int, backlog_per_replica: int = 1000,
+                 scale_down_ratio: float = 0.5, up_cooldown_secs: float = 60, down_cooldown_secs: float = 300):
+        self.min_replicas = min_replicas
+        self.max_replicas = max_replicas
+        self.backlog_per_replica = backlog_per_replica
+        self.scale_down_ratio = scale_down_ratio
+        self.up_cooldown_secs = up_cooldown_secs
+        self.down_cooldown_secs = down_cooldown_secs
+        self.last_scaled = None
+
+    def clamp(self, replicas: int):
+        return max(self.min_replicas, min(self.max_replicas, replicas))
+
+    def decide(self, replicas: int, metrics: dict, now: float = None):
+        """
+        :param replicas: The current number of replicas
+        :param metrics: subscription_metrics
+        :param now:
+        :return: The number of replicas and why
+        """
+        now = time.time() if now is None else now
+        since_scaled = math.inf if self.last_scaled is None else now - self.last_scaled
+        backlog = metrics['backlog']
+        wanted = self.clamp(math.ceil(backlog / self.backlog_per_replica))
+        per_replica = backlog / max(replicas, 1)
+
+        if replicas < self.min_replicas or replicas > self.max_replicas:
+            wanted = self.clamp(replicas)
+            reason = "outside {0}-{1} replicas".format(self.min_replicas, self.max_replicas)
+        elif wanted > replicas and per_replica > self.backlog_per_replica:
+            if since_scaled < self.up_cooldown_secs:
+                return replicas, "backlog {0} waiting on up cooldown".format(backlog)
+            reason = "backlog {backlog} is {per:.0f} per replica > {limit}".format(
+                backlog=backlog, per=per_replica, limit=self.backlog_per_replica)
+        elif wanted < replicas and per_replica < self.backlog_per_replica * self.scale_down_ratio:
+            if since_scaled < self.down_cooldown_secs:
+                return replicas, "backlog {0} waiting on down cooldown".format(backlog)
+            # One at a time because the backlog lags behind the replicas removed
+            wanted = replicas - 1
+            reason = "backlog {backlog} is {per:.0f} per replica < {limit:.0f} consuming {rate_out:.1f} msgs/sec " \
+                     "publishing {rate_in:.1f} msgs/sec".format(
+                        backlog=backlog, per=per_replica, limit=self.backlog_per_replica * self.scale_down_ratio,
+                        rate_out=metrics['rate_out'], rate_in=metrics['rate_in'])
+        else:
+            return replicas, "backlog {0} within bounds".format(backlog)
+
+        self.last_scaled = now
+        return wanted, reason
+
+
+def resident_mb(pid: int):
+    """
+    :param pid:
+    :return: The resident memory of the process in MB or None if it is gone or /proc is not available
+    """
+    try:
+        with open('/proc/{0}/statm'.format(pid), 'r') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2, 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Slot:
+    """
+    One replica of a command and the history of the processes that ran in it
+    """
+
+    def __init__(self, index: int, now: float):
+        self.index = index
+        self.child = None
+        self.started = None
+        self.next_start = now
+        self.restarts = 0
+        # Exits in a row that happened before the process was up stable_secs
+        self.failures = 0
+        self.last_exit_code = None
+        self.crash_looping = False
+
+    def status(self, now: float):
+        return {'slot': self.index,
+                'pid': None if self.child is None else self.child.pid,
+                'uptime_secs': None if self.child is None else round(now - self.started, 1),
+                'rss_mb': None if self.child is None else resident_mb(self.child.pid),
+                'restarts': self.restarts,
+                'failures': self.failures,
+                'last_exit_code': self.last_exit_code,
+                'crash_looping': self.crash_looping,
+                'next_start_in_secs': None if self.child is not None else round(max(self.next_start - now, 0), 1)}
+
+
+class ProcessGroup:
+    """
+    Runs replicas of a command. Every child has a thread blocked on its wait() that puts (group, slot, process, exit
+    code) on the events queue so exits are handled as soon as they happen. A process that dies before it was up
+    stable_secs is restarted after an exponential backoff and the slot is flagged as crash looping after
+    crash_loop_failures of those in a row. Processes are stopped with SIGTERM and killed if they haven't drained
+    within drain_secs.
+    """
+
+    def __init__(self, name: str, command: list, replicas: int, events: queue.Queue, backoff_secs: float = 1,
+                 max_backoff_secs: float = 300, stable_secs: float = 60, crash_loop_failures: int = 5,
+                 drain_secs: float = 30, popen_kwargs: dict = None, cpus: set = None, memory_mb: float = None):
+        """
+        :param cpus: CPUs the processes are pinned to. None for any.
+        :param memory_mb: Processes whose resident memory goes over this are stopped and restarted. None for no limit.
+        """
+        self.name = name
+        self.command = command
+        self.events = events
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.stable_secs = stable_secs
+        self.crash_loop_failures = crash_loop_failures
+        self.drain_secs = drain_secs
+        self.popen_kwargs = popen_kwargs or {}
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.slots = []
+        # Processes sent SIGTERM to the time they get killed
+        self.stopping = {}
+        self.scale(replicas)
+
+    @property
+    def replicas(self):
+        return len(self.slots)
+
+    def scale(self, replicas: int, now: float = None):
+        now = time.time() if now is None else now
+        while len(self.slots) < replicas:
+            self.slots.append(Slot(len(self.slots), now))
+        while len(self.slots) > replicas:
+            # Newest slots first
+            slot = self.slots.pop()
+            if slot.child is not None:
+                self.stop(slot.child, now)
+
+    def spawn(self, slot: Slot, now: float):
+        try:
+            proc = subprocess.Popen(self.command, **self.popen_kwargs)
+        except OSError as e:
+            _logger.error("Error starting {name}: {command}\n{0}".format(e, name=self.name, command=self.command))
+            self.on_exit(slot, None, None, now)
+            return
+        if self.cpus:
+            try:
+                # Threads the child starts from here on inherit it
+                os.sched_setaffinity(proc.pid, self.cpus)
+            except OSError as e:
+                _logger.error("Error pinning {name} pid {pid} to cpus {cpus}\n{0}".format(e, name=self.name,
+                                                                                       pid=proc.pid, cpus=self.cpus))
+        slot.child = proc
+        slot.started = now
+        threading.Thread(target=lambda: self.events.put((self, slot, proc, proc.wait())), daemon=True).start()
+        _logger.info("Started {name}[{slot}] pid {pid}".format(name=self.name, slot=slot.index, pid=proc.pid))
+
+    def stop(self, proc: subprocess.Popen, now: float):
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+        self.stopping[proc] = now + self.drain_secs
+
+    def on_exit(self, slot: Slot, proc, exit_code, now: float = None):
+        """
+        :param slot:
+        :param proc: None when it couldn't be started
+        :param exit_code:
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        if proc is not None and proc in self.stopping:
+            del self.stopping[proc]
+            _logger.info("Stopped {name} pid {pid} exit code {code}".format(name=self.name, pid=proc.pid,
+                                                                            code=exit_code))
+        # Stopped by scaling down. The ones stopped for using too much memory are still in their slot and restart.
+        if slot not in self.slots or slot.child is not proc:
+            return
+
+        uptime = 0 if proc is None else now - slot.started
+        slot.child = None
+        slot.last_exit_code = exit_code
+        slot.restarts += 1
+        if uptime >= self.stable_secs:
+            slot.failures = 0
+            slot.crash_looping = False
+            delay = 0
+        else:
+            slot.failures += 1
+            delay = min(self.backoff_secs * 2 ** (slot.failures - 1), self.max_backoff_secs)
+            if slot.failures >= self.crash_loop_failures and not slot.crash_looping:
+                slot.crash_looping = True
+                _logger.critical("{name}[{slot}] is crash looping: {failures} exits within {stable}s of starting. "
+                                 "Backing off up to {max_delay:.0f}s".format(name=self.name, slot=slot.index,
+                                                                        failures=slot.failures,
+                                                                        stable=self.stable_secs,
+                                                                        max_delay=self.max_backoff_secs))
+        slot.next_start = now + delay
+        _logger.error("{name}[{slot}] exited with {code} after {uptime:.1f}s. Restart {restarts} in {delay:.1f}s"
+                      .format(name=self.name, slot=slot.index, code=exit_code, uptime=uptime,
+                              restarts=slot.restarts, delay=delay))
+
+    def tick(self, now: float = None):
+        """
+        Start the slots that are due and kill the processes that didn't drain in time
+        :param now:
+        :return: The next time tick needs to run or None if nothing is pending
+        """
+        now = time.time() if now is None else now
+        for proc, deadline in list(self.stopping.items()):
+            if deadline <= now:
+                _logger.error("Killing {name} pid {pid} after {drain}s draining".format(name=self.name, pid=proc.pid,
+                                                                                      drain=self.drain_secs))
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+                # Don't kill it again while waiting on its exit
+                self.stopping[proc] = math.inf
+        for slot in self.slots:
+            if slot.child is None and slot.next_start <= now:
+                self.spawn(slot, now)
+        deadlines = [slot.next_start for slot in self.slots if slot.child is None] + list(self.stopping.values())
+        return min(deadlines, default=None)
+
+    def check_memory(self, now: float = None):
+        """
+        Stop the processes over memory_mb. They are restarted like any other exit once they are gone.
+        """
+        if self.memory_mb is None:
+            return
+        now = time.time() if now is None else now
+        for slot in self.slots:
+            if slot.child is None or slot.child in self.stopping:
+                continue
+            rss_mb = resident_mb(slot.child.pid)
+            if rss_mb is not None and rss_mb > self.memory_mb:
+                _logger.critical("Stopping {name}[{slot}] pid {pid} using {rss:.0f}MB over its {limit:.0f}MB "
+                                 "ceiling".format(name=self.name, slot=slot.index, pid=slot.child.pid, rss=rss_mb,
+                                                  limit=self.memory_mb))
+                self.stop(slot.child, now)
+
+    def stop_all(self, now: float = None):
+        """
+        SIGTERM every process and wait up to drain_secs for them before killing the rest
+        """
+        self.terminate_all(now)
+        self.wait_stopped()
+
+    def terminate_all(self, now: float = None):
+        now = time.time() if now is None else now
+        for slot in self.slots:
+            if slot.child is not None and slot.child not in self.stopping:
+                self.stop(slot.child, now)
+        self.slots = []
+
+    def wait_stopped(self):
+        for proc, deadline in list(self.stopping.items()):
+            try:
+                proc.wait(timeout=max(deadline - time.time(), 0) if deadline != math.inf else None)
+            except subprocess.TimeoutExpired:
+                _logger.error("Killing {name} pid {pid} after {drain}s draining".format(name=self.name, pid=proc.pid,
+                                                                                      drain=self.drain_secs))
+                proc.kill()
+                proc.wait()
+        self.stopping = {}
+
+    def status(self, now: float = None):
+        now = time.time() if now is None else now
+        return {'name': self.name,
+                'command': self.command,
+                'cpus': None if self.cpus is None else sorted(self.cpus),
+                'memory_mb': self.memory_mb,
+                'replicas': self.replicas,
+                'stopping': len(self.stopping),
+                'slots': [slot.status(now) for slot in self.slots]}
+
+
+def write_status(path: str, status):
+    """
+    Replace the status file in one step so readers never see half of it
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+STAGE_DEFAULTS = {'replicas': 1,
+                  'cwd': None,
+                  'cpus': None,
+                  'memory_mb': None,
+                  'autoscale': None}
+
+AUTOSCALE_DEFAULTS = {'subscription': None,
+                      'min_replicas': 1,
+                      'max_replicas': None,
+                      'backlog_per_replica': 1000,
+                      'up_cooldown_secs': 60,
+                      'down_cooldown_secs': 300}
+
+
+def parse_cpus(cpus):
+    """
+    :param cpus: list of CPU numbers or a taskset style string e.g. "0-3,6"
+    :return: set of CPU numbers
+    """
+    if isinstance(cpus, str):
+        parsed = set()
+        for part in cpus.split(','):
+            first, _, last = part.strip().partition('-')
+            parsed.update(range(int(first), int(last or first) + 1))
+        return parsed
+    return set(int(cpu) for cpu in cpus)
+
+
+def load_pipeline_config(path: str):
+    """
+    Read the stages of the pipeline from a JSON file. See pipeline.json.
+    :param path:
+    :return: dict of the admin_url and the list of stages with the defaults filled in. cwd is resolved against the
+    directory of the file.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    available_cpus = os.sched_getaffinity(0)
+
+    stages = []
+    for stage in config.get('stages', []):
+        if 'name' not in stage or 'command' not in stage:
+            raise ValueError("Every stage needs a name and a command: {0}".format(stage))
+        unknown = set(stage) - set(STAGE_DEFAULTS) - {'name', 'command'}
+        if unknown:
+            raise ValueError("Unknown settings {0} in stage {1}".format(sorted(unknown), stage['name']))
+        if stage['name'] in [other['name'] for other in stages]:
+            raise ValueError("Stage {0} is listed twice".format(stage['name']))
+        if not isinstance(stage['command'], list):
+            raise ValueError("The command of stage {0} must be a list of arguments".format(stage['name']))
+
+        stage = dict(STAGE_DEFAULTS, **stage)
+        stage['cwd'] = os.path.join(base_dir, stage['cwd']) if stage['cwd'] else base_dir
+        if stage['cpus'] is not None:
+            stage['cpus'] = parse_cpus(stage['cpus'])
+            if not stage['cpus'] <= available_cpus:
+                raise ValueError("Stage {0} is pinned to cpus {1} but only {2} are available".format(
+                    stage['name'], sorted(stage['cpus'] - available_cpus), sorted(available_cpus)))
+        if stage['autoscale'] is not None:
+            if 'topic' not in stage['autoscale']:
+                raise ValueError("The autoscale of stage {0} needs a topic".format(stage['name']))
+            stage['autoscale'] = dict(AUTOSCALE_DEFAULTS, **stage['autoscale'])
+        stages.append(stage)
+
+    if len(stages) == 0:
+        raise ValueError("No stages in {0}".format(path))
+    for i, stage in enumerate(stages):
+        for other in stages[i + 1:]:
+            if stage['cpus'] and other['cpus'] and stage['cpus'] & other['cpus']:
+                _logger.warning("Stages {0} and {1} share cpus {2}".format(stage['name'], other['name'],
+                                                                            sorted(stage['cpus'] & other['cpus'])))
+    return {'admin_url': config.get('admin_url', "http://10.0.0.11:8080"), 'stages': stages}
+
+
+def pipeline_stage(stage: dict, admin_url: str, events: queue.Queue, **group_kwargs):
+    """
+    :param stage: A stage from load_pipeline_config
+    :param admin_url:
+    :param events:
+    :param group_kwargs: Passed to ProcessGroup
+    :return: The ProcessGroup running the stage, its Autoscaler and backlog metrics. None for the last two if it
+    doesn't autoscale.
+    """
+    replicas = stage['replicas']
+    autoscaler = None
+    metrics = None
+    if stage['autoscale'] is not None:
+        autoscale = stage['autoscale']
+        autoscaler = Autoscaler(autoscale['min_replicas'], autoscale['max_replicas'] or replicas,
+                                backlog_per_replica=autoscale['backlog_per_replica'],
+                                up_cooldown_secs=autoscale['up_cooldown_secs'],
+                                down_cooldown_secs=autoscale['down_cooldown_secs'])
+        metrics = backlog_metrics(admin_url, autoscale['topic'],
+                                  autoscale['subscription'] or '{0}-worker'.format(autoscale['topic']))
+        replicas = autoscaler.clamp(replicas)
+    group = ProcessGroup(stage['name'], stage['command'], replicas, events, popen_kwargs={'cwd': stage['cwd']},
+                         cpus=stage['cpus'], memory_mb=stage['memory_mb'], **group_kwargs)
+    return group, autoscaler, metrics
+
+
 def parse_args(args):
     """Parse command line parameters
 
@@ -29,17 +516,125 @@ def parse_args(args):
         description="A governing process to monitor and relaunch sub-processes")
     parser.add_argument(
         dest="replicas",
-        help="The number of subprocess to run",
-        type=int)
+        help="The number of subprocess to run. The starting number with --autoscale.",
+        type=int,
+        nargs='?')
     parser.add_argument(
         dest="command",
         help="The command to run",
+        type=str,
+        nargs='?')
+    parser.add_argument(
+        "-config",
+        "--config",
+        help="Run every stage of the pipeline listed in this JSON file instead of a single command e.g. pipeline.json",
         type=str)
+    parser.add_argument(
+        "-cpus",
+        "--cpus",
+        help="Pin the processes to these cpus e.g. 0-3,6",
+        type=str)
+    parser.add_argument(
+        "-mem",
+        "--memory_mb",
+        help="Restart the processes whose resident memory goes over this many MB",
+        type=float)
+    parser.add_argument(
+        "-mc",
+        "--memory_check_secs",
+        help="Seconds between checking the memory of the processes",
+        type=float,
+        default=5)
     parser.add_argument(
         "-c_args",
         dest="command_args",
         help="The arguments to the command",
         type=str)
+    parser.add_argument(
+        "-i",
+        "--interval",
+        help="Seconds between checks. Defaults to 120 or 30 with --autoscale.",
+        type=float)
+    parser.add_argument(
+        "-as",
+        "--autoscale",
+        help="Scale the replicas on the backlog of this topic",
+        type=str)
+    parser.add_argument(
+        "-sub",
+        "--subscription",
+        help="The subscription to watch. Defaults to <topic>-worker.",
+        type=str)
+    parser.add_argument(
+        "-admin",
+        "--admin_url",
+        help="Pulsar admin REST url or file:stats.json to read the topic stats from a file",
+        type=str,
+        default="http://10.0.0.11:8080")
+    parser.add_argument(
+        "-min",
+        "--min_replicas",
+        help="Min replicas with --autoscale",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "-max",
+        "--max_replicas",
+        help="Max replicas with --autoscale. Defaults to the starting replicas.",
+        type=int)
+    parser.add_argument(
+        "-bpr",
+        "--backlog_per_replica",
+        help="Backlog each replica can have before scaling up",
+        type=int,
+        default=1000)
+    parser.add_argument(
+        "-ucd",
+        "--up_cooldown_secs",
+        help="Min seconds between scaling up",
+        type=float,
+        default=60)
+    parser.add_argument(
+        "-dcd",
+        "--down_cooldown_secs",
+        help="Min seconds after scaling before scaling down",
+        type=float,
+        default=300)
+    parser.add_argument(
+        "-bo",
+        "--backoff_secs",
+        help="Delay before restarting a process that crashed soon after starting. Doubles with each crash in a row.",
+        type=float,
+        default=1)
+    parser.add_argument(
+        "-mbo",
+        "--max_backoff_secs",
+        help="Max delay before restarting a crashed process",
+        type=float,
+        default=300)
+    parser.add_argument(
+        "-ss",
+        "--stable_secs",
+        help="Seconds a process has to run before its exit stops counting as a crash in a row",
+        type=float,
+        default=60)
+    parser.add_argument(
+        "-clf",
+        "--crash_loop_failures",
+        help="Crashes in a row before a replica is reported as crash looping",
+        type=int,
+        default=5)
+    parser.add_argument(
+        "-ds",
+        "--drain_secs",
+        help="Seconds a process has to exit after SIGTERM before it is killed",
+        type=float,
+        default=30)
+    parser.add_argument(
+        "-sf",
+        "--status_file",
+        help="Write the pid, uptime, restarts and last exit code of each replica to this JSON file",
+        type=str)
     parser.add_argument(
         "-v",
         "--verbose",
@@ -54,7 +649,10 @@ def parse_args(args):
         help="set loglevel to DEBUG",
         action="store_const",
         const=logging.DEBUG)
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.config is None and (parsed.replicas is None or parsed.command is None):
+        parser.error("replicas and command are required without --config")
+    return parsed
 
 
 def setup_logging(loglevel):
@@ -80,31 +678,82 @@ def main(args):
     else:
         setup_logging(loglevel=logging.WARNING)
 
-    processes = set()
+    events = queue.Queue()
+    group_kwargs = dict(backoff_secs=args.backoff_secs, max_backoff_secs=args.max_backoff_secs,
+                        stable_secs=args.stable_secs, crash_loop_failures=args.crash_loop_failures,
+                        drain_secs=args.drain_secs)
+    if args.config:
+        config = load_pipeline_config(args.config)
+        admin_url = config['admin_url']
+        stage_configs = config['stages']
+    else:
+        admin_url = args.admin_url
+        sproc_args = args.command_args.split(' ') if args.command_args else []
+        autoscale = None
+        if args.autoscale:
+            autoscale = dict(topic=args.autoscale, subscription=args.subscription, min_replicas=args.min_replicas,
+                             max_replicas=args.max_replicas, backlog_per_replica=args.backlog_per_replica,
+                             up_cooldown_secs=args.up_cooldown_secs, down_cooldown_secs=args.down_cooldown_secs)
+        stage_configs = [dict(STAGE_DEFAULTS, name=args.command, command=[args.command, *sproc_args],
+                              replicas=args.replicas, cpus=parse_cpus(args.cpus) if args.cpus else None,
+                              memory_mb=args.memory_mb, autoscale=autoscale)]
 
-    def is_proc_alive(p):
-        return p.poll() is None
+    # Stop the children gracefully when the governor is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    while True:
-        # Look for dead processes
-        dead_processes = []
-        for proc in processes:
-            if not is_proc_alive(proc):
-                dead_processes.append(proc)
+    stages = [pipeline_stage(stage, admin_url, events, **group_kwargs) for stage in stage_configs]
+    groups = [group for group, _, _ in stages]
+    interval = args.interval or (30 if any(autoscaler for _, autoscaler, _ in stages) else 120)
+    memory_check_secs = args.memory_check_secs if any(group.memory_mb for group in groups) else math.inf
+    next_check = time.time()
+    next_memory_check = time.time()
+    try:
+        while True:
+            now = time.time()
+            if now >= next_check:
+                next_check = now + interval
+                _logger.info('Governing sub processes')
+                for group, autoscaler, metrics in stages:
+                    if autoscaler is None:
+                        continue
+                    try:
+                        wanted, reason = autoscaler.decide(group.replicas, metrics())
+                        if wanted != group.replicas:
+                            _logger.critical("Scaling {name} from {replicas} to {wanted} replicas: {reason}".format(
+                                name=group.name, replicas=group.replicas, wanted=wanted, reason=reason))
+                            group.scale(wanted)
+                        else:
+                            _logger.info("Keeping {replicas} {name} replicas: {reason}".format(
+                                replicas=group.replicas, name=group.name, reason=reason))
+                    except Exception as e:
+                        # Keep the current replicas until the admin API is back
+                        _logger.error("Error polling the backlog of {topic}\n{0}".format(e, topic=metrics.topic))
 
-        # Remove them
-        for proc in dead_processes:
-            processes.remove(proc)
+            if now >= next_memory_check:
+                next_memory_check = now + memory_check_secs
+                for group in groups:
+                    group.check_memory(now)
 
-        # Spawn processes
-        for i in range(args.replicas - len(processes)):
-            sproc_args = args.command_args.split(' ')
-            proc = subprocess.Popen([args.command, *sproc_args])
-            processes.add(proc)
+            next_due = min((due for due in (group.tick() for group in groups) if due is not None), default=math.inf)
+            if args.status_file:
+                write_status(args.status_file, {'stages': [group.status() for group in groups]})
 
-        # Sleep
-        time.sleep(120)
-        _logger.info('Governing sub processes')
+            # Block until a child exits or the next restart, kill or check is due
+            timeout = max(min(next_check, next_memory_check, next_due) - time.time(), 0)
+            try:
+                event_group, slot, proc, exit_code = events.get(timeout=timeout)
+                event_group.on_exit(slot, proc, exit_code)
+            except queue.Empty:
+                pass
+    finally:
+        # Every stage drains at the same time
+        for group in groups:
+            _logger.critical("Stopping {replicas} {name} processes".format(replicas=group.replicas, name=group.name))
+            group.terminate_all()
+        for group in groups:
+            group.wait_stopped()
+        if args.status_file:
+            write_status(args.status_file, {'stages': [group.status() for group in groups]})
 
 
 def run():
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined publishing with producer.send_async shared by the publishers and transformers.
+
+Sends return as soon as the message is queued so throughput isn't tied to the broker round trip or to the batching
+delay. Up to max_in_flight messages can be waiting on the broker. Each send can carry a callback that is told whether
+the message was persisted, which is where upstream messages get acked. Call flush() at checkpoints, e.g. before saving
+a watermark, to wait for every message sent so far.
+"""
+
+import logging
+import threading
+import pulsar
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncPublisher:
+    """
+    Wraps a producer with a bounded window of in flight messages
+    """
+
+    def __init__(self, producer, max_in_flight: int = 1000):
+        self.producer = producer
+        self.max_in_flight = max_in_flight
+        self.window = threading.Semaphore(max_in_flight)
+        self.idle = threading.Condition()
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        # Failures since the last flush
+        self.errors = []
+
+    def send(self, data: bytes, on_delivery=None, **kwargs):
+        """
+        Queue a message without waiting for the broker
+        :param data:
+        :param on_delivery: Called with True once the message is persisted or False if it failed. It runs on the
+        pulsar client's thread so keep it short e.g. ack or negative ack the upstream message.
+        :param kwargs: Passed to send_async e.g. partition_key or properties
+        :return:
+        """
+        if not self.window.acquire(blocking=False):
+            # The window is full. Push out the open batch instead of waiting for batching_max_publish_delay_ms.
+            self.producer.flush()
+            self.window.acquire()
+        with self.idle:
+            self.in_flight += 1
+
+        def callback(res, msg_id):
+            ok = res == pulsar.Result.Ok
+            with self.idle:
+                self.in_flight -= 1
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    self.errors.append(res)
+                self.idle.notify_all()
+            self.window.release()
+            if not ok:
+                _logger.error("Error publishing to {topic}: {res}".format(topic=self.producer.topic(), res=res))
+            if on_delivery is not None:
+                try:
+                    on_delivery(ok)
+                except Exception as e:
+                    _logger.error("Error in delivery callback\n{0}".format(e))
+
+        try:
+            self.producer.send_async(data, callback, **kwargs)
+        except Exception:
+            with self.idle:
+                self.in_flight -= 1
+            self.window.release()
+            raise
+
+    def flush(self, timeout: float = None):
+        """
+        Checkpoint. Wait for every message sent so far to be persisted.
+        :param timeout: Max seconds to wait for the delivery callbacks after the producer flushed
+        :return: The number of messages persisted since the publisher was created
+        """
+        self.producer.flush()
+        with self.idle:
+            if not self.idle.wait_for(lambda: self.in_flight == 0, timeout=timeout):
+                raise RuntimeError("{count} messages to {topic} still in flight".format(
+                    count=self.in_flight, topic=self.producer.topic()))
+            errors, self.errors = self.errors, []
+        if len(errors) > 0:
+            raise RuntimeError("{count} messages to {topic} failed: {error}".format(
+                count=len(errors), topic=self.producer.topic(), error=errors[0]))
+        return self.sent
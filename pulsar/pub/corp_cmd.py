@@ -12,6 +12,9 @@ import pulsar
 import json
 import os
 import socket
+import heapq
+import itertools
+from datetime import datetime, timedelta
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -21,25 +24,171 @@ __version__ = '0.0.1.'
 _logger = logging.getLogger(__name__)
 
 
+def init_els_index(es: elasticsearch.Elasticsearch):
+    """
+    Use this to define the elsaticsearch index otherwise the system just guesses the data types
+
+    :param es:
+    :return:
+    """
+    if not es.indices.exists("publish_watermark"):
+        publish_watermark_def = {"mappings": {
+            "dynamic": False,
+            "properties": {
+                "pub_topic": {"type": "keyword"},
+                "publish_date": {"type": "date"}
+            }
+        }}
+
+        es.indices.create(index="publish_watermark", body=publish_watermark_def)
+
+
 def corp_desc_list_cik(es: elasticsearch.Elasticsearch):
     """
         List all the cik in corp_desc i.e. ones with trading symbol
     :param es:
-    :return:
+    :return: generator of the companies so the list is never held in memory
     """
     s = Search(using=es, index="corp_desc")
-    return [{'cik': doc.meta.id, 'symbol': doc.symbol, 'company_name': doc.name} for doc in s.scan()]
+    for doc in s.scan():
+        yield {'cik': doc.meta.id, 'symbol': doc.symbol, 'company_name': doc.name}
+
+
+# Where each delta source looks for new documents and the date field it compares to the watermark
+DELTA_SOURCES = {"text_source": "parse_date",
+                 "cap_alloc_event": "indexed_at"}
+
+# Searching only needs new filings. Searching again the companies the last search found events in would loop.
+SEARCH_DELTA_SOURCES = ["text_source"]
+TIMELINE_DELTA_SOURCES = ["cap_alloc_event"]
+
+# parse_date and indexed_at are stamped before the document is written so a slow write can show up older than
+# documents already published. The watermark stays this far behind the clock so the next run covers them.
+WATERMARK_LAG_SECS = 900
+
+
+def is_search_topic(pub_topic: str):
+    return pub_topic.startswith("search_filings")
+
+
+def get_publish_watermark(es: elasticsearch.Elasticsearch, pub_topic: str):
+    """
+    The newest date of each delta source published to the topic by the last successful delta run
+    :param es:
+    :param pub_topic:
+    :return: dict with watermarks, the dict of index to date, and the search_terms searched. Empty if never run.
+    """
+    try:
+        return es.get(index="publish_watermark", id=pub_topic)['_source']
+    except elasticsearch.exceptions.NotFoundError:
+        return {}
+
+
+def save_publish_watermark(es: elasticsearch.Elasticsearch, pub_topic: str, watermarks: dict,
+                           search_terms: list = None):
+    es.index(index="publish_watermark", id=pub_topic, body={"pub_topic": pub_topic,
+                                                             "watermarks": watermarks,
+                                                             "search_terms": search_terms,
+                                                             "publish_date": datetime.now()})
+
+
+def get_search_terms(es: elasticsearch.Elasticsearch):
+    """
+    :param es:
+    :return: The search terms saved by the search_filings.py workers or None if they haven't run
+    """
+    try:
+        return es.get(index="search_watermark", id="search_terms")['_source']['search_terms']
+    except elasticsearch.exceptions.NotFoundError:
+        return None
 
 
-def publish_companies(corps: list, pub_topic: str = "search_filings-8-K",
-                      pulsar_connection_string: str = "pulsar://localhost:6650"):
+def lagged_date(latest: str, now: datetime = None, lag_secs: float = WATERMARK_LAG_SECS):
+    """
+    :param latest: The newest date published
+    :param now:
+    :param lag_secs:
+    :return: latest or now - lag_secs if that is earlier, as an ISO 8601 string
+    """
+    now = datetime.now() if now is None else now
+    return min(datetime.fromisoformat(latest.replace('Z', '')), now - timedelta(seconds=lag_secs)).isoformat()
+
+
+def latest_date(es: elasticsearch.Elasticsearch, index: str, field: str):
+    """
+    :param es:
+    :param index:
+    :param field:
+    :return: The newest value of the date field in the index or None
+    """
+    res = es.search(index=index, body={"size": 0, "aggs": {"latest": {"max": {"field": field}}}})
+    return res['aggregations']['latest'].get('value_as_string')
+
+
+def changed_ciks(es: elasticsearch.Elasticsearch, index: str, field: str, since: str = None, until: str = None,
+                 page_size: int = 1000):
+    """
+    Stream the ciks with documents dated after since and up to until in cik order
+    :param es:
+    :param index:
+    :param field:
+    :param since:
+    :param until:
+    :param page_size:
+    :return:
+    """
+    date_range = {"lte": until}
+    if since is not None:
+        date_range["gt"] = since
+    composite = {"size": page_size, "sources": [{"cik": {"terms": {"field": "cik"}}}]}
+    body = {"size": 0,
+            "query": {"range": {field: date_range}},
+            "aggs": {"ciks": {"composite": composite}}}
+    while True:
+        res = es.search(index=index, body=body, request_timeout=300)
+        ciks = res['aggregations']['ciks']
+        for bucket in ciks['buckets']:
+            yield int(bucket['key']['cik'])
+        if len(ciks['buckets']) == 0 or 'after_key' not in ciks:
+            return
+        composite['after'] = ciks['after_key']
+
+
+def corp_desc_delta(es: elasticsearch.Elasticsearch, watermarks: dict, until: dict, page_size: int = 500):
+    """
+    Stream the companies in corp_desc with new documents in any of the delta sources
+    :param es:
+    :param watermarks: dict of index to the date of the last run
+    :param until: dict of index to the newest date to include
+    :param page_size: Companies looked up in corp_desc at a time
+    :return:
+    """
+    # Each source streams in cik order so merging them drops the companies in both without keeping a set
+    streams = [changed_ciks(es, index, DELTA_SOURCES[index], watermarks.get(index), date)
+               for index, date in until.items() if date is not None]
+    ciks = (cik for cik, _ in itertools.groupby(heapq.merge(*streams)))
+    while True:
+        page = list(itertools.islice(ciks, page_size))
+        if len(page) == 0:
+            return
+        res = es.mget(index="corp_desc", body={"ids": page})
+        for doc in res['docs']:
+            if doc.get('found'):
+                yield {'cik': doc['_id'], 'symbol': doc['_source']['symbol'],
+                       'company_name': doc['_source']['name']}
+
+
+def publish_companies(corps, pub_topic: str = "search_filings-8-K",
+                      pulsar_connection_string: str = "pulsar://localhost:6650", full: bool = False):
     """
 
-    :param corps:
+    :param corps: Iterable of companies
     :param pub_topic:
     :param pulsar_connection_string:
-    :return:
+    :param full: Ask the search workers to ignore their watermarks and search the whole filing history
+    :return: The number of companies published
     """
+    from async_publisher import AsyncPublisher
 
     client = pulsar.Client(pulsar_connection_string)
     producer = client.create_producer(topic=pub_topic,
@@ -47,13 +196,65 @@ def publish_companies(corps: list, pub_topic: str = "search_filings-8-K",
                                       batching_enabled=True,
                                       send_timeout_millis=300000,
                                       batching_max_publish_delay_ms=120000)
-
-    i = 1
-    for corp in corps:
-        _logger.info("Publishing {0} of {1}".format(i, len(corps)))
-        msg = json.dumps(corp).encode('utf-8')
-        producer.send(msg)
-        i += 1
+    publisher = AsyncPublisher(producer)
+
+    i = 0
+    try:
+        for corp in corps:
+            i += 1
+            _logger.info("Publishing {0}".format(i))
+            if full:
+                corp = dict(corp, full=True)
+            msg = json.dumps(corp).encode('utf-8')
+            publisher.send(msg)
+        # Raises if any company wasn't published so publish_delta doesn't move its watermark
+        publisher.flush()
+    finally:
+        client.close()
+    return i
+
+
+def publish_delta(es: elasticsearch.Elasticsearch, pub_topic: str = "search_filings-8-K",
+                  pulsar_connection_string: str = "pulsar://localhost:6650", full: bool = False,
+                  lag_secs: float = WATERMARK_LAG_SECS):
+    """
+    Publish only the companies with new filings, for the search topics, or new capital allocation events, for the
+    timeline topics, since the last successful delta run to the topic. Every company is published to the search
+    topics when the search workers have new search terms. The watermark is saved once everything is published so a
+    failed run is repeated in full.
+    :param es:
+    :param pub_topic:
+    :param pulsar_connection_string:
+    :param full: Ask the workers to rebuild the companies published from their whole history
+    :param lag_secs: How far the watermarks stay behind the clock
+    :return: The number of companies published
+    """
+    init_els_index(es)
+    now = datetime.now()
+    published = get_publish_watermark(es, pub_topic)
+    watermarks = published.get('watermarks', {})
+    sources = SEARCH_DELTA_SOURCES if is_search_topic(pub_topic) else TIMELINE_DELTA_SOURCES
+    # Fix the upper bound first so documents added while publishing are picked up by the next run
+    until = {index: latest_date(es, index, DELTA_SOURCES[index]) for index in sources}
+
+    search_terms = published.get('search_terms')
+    corps = None
+    if is_search_topic(pub_topic):
+        current_terms = get_search_terms(es)
+        if current_terms is not None:
+            if search_terms is not None and not set(current_terms) <= set(search_terms):
+                _logger.critical("New search terms so publishing every company")
+                corps = corp_desc_list_cik(es)
+            search_terms = current_terms
+    if corps is None:
+        corps = corp_desc_delta(es, watermarks, until)
+
+    count = publish_companies(corps, pub_topic=pub_topic, pulsar_connection_string=pulsar_connection_string,
+                              full=full)
+    save_publish_watermark(es, pub_topic, dict(watermarks, **{index: lagged_date(date, now, lag_secs)
+                                                               for index, date in until.items() if date is not None}),
+                           search_terms)
+    return count
 
 
 def parse_args(args):
@@ -88,6 +289,24 @@ def parse_args(args):
                         type=str,
                         default='10.0.0.11,10.0.0.12,10.0.0.13')
 
+    parser.add_argument("-full",
+                        "--full",
+                        help="Search the whole filing history instead of only what was added since the last search",
+                        action="store_true")
+
+    parser.add_argument("-delta",
+                        "--delta",
+                        help="Only publish companies with new filings or capital allocation events since the last "
+                             "successful delta run to this topic",
+                        action="store_true")
+
+    parser.add_argument("-wl",
+                        "--watermark_lag",
+                        help="Seconds the delta watermarks stay behind the clock so documents written late are "
+                             "still published",
+                        type=float,
+                        default=WATERMARK_LAG_SECS)
+
     parser.add_argument(
         "--version",
         action="version",
@@ -141,9 +360,14 @@ def main(args):
     test_firms = [{'cik': 93410, 'symbol': 'CVX', 'company_name': 'CHEVRON CORP'},
                   {'cik': 1596993, 'symbol': 'LPG', 'company_name': 'DORIAN LPG LTD.'}]
 
-    firms = corp_desc_list_cik(es)
-    publish_companies(firms, pub_topic=args.pub_topic, pulsar_connection_string=args.pulsar_connection_string)
-    _logger.info("Publishing complete")
+    if args.delta:
+        count = publish_delta(es, pub_topic=args.pub_topic, pulsar_connection_string=args.pulsar_connection_string,
+                              full=args.full, lag_secs=args.watermark_lag)
+    else:
+        firms = corp_desc_list_cik(es)
+        count = publish_companies(firms, pub_topic=args.pub_topic,
+                                  pulsar_connection_string=args.pulsar_connection_string, full=args.full)
+    _logger.info("Publishing complete {count} companies".format(count=count))
 
 
 def run():
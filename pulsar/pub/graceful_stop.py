@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+SIGTERM handling shared by the workers so process_governer.py can drain them.
+
+The handler only sets a flag. Each worker checks it between messages, stops receiving, flushes what it published, acks
+what it finished and closes its consumer before exiting. Receives poll so a worker waiting on an empty topic still
+notices the flag.
+"""
+
+import signal
+import logging
+import threading
+import time
+import pulsar
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+
+class GracefulStop:
+    """
+    Set once the process is asked to stop
+    """
+
+    def __init__(self, signals: tuple = (signal.SIGTERM,)):
+        self.event = threading.Event()
+        for signum in signals:
+            signal.signal(signum, self.handle)
+
+    def handle(self, signum, frame):
+        _logger.critical("Received signal {signum} so draining".format(signum=signum))
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+
+def is_receive_timeout(e: Exception):
+    """
+    Newer pulsar clients raise pulsar.Timeout when a receive times out and older ones a plain Exception
+    :param e:
+    :return:
+    """
+    timeout = getattr(pulsar, 'Timeout', None)
+    if timeout is not None and isinstance(e, timeout):
+        return True
+    return type(e) is Exception and 'TimeOut' in str(e)
+
+
+def receive_until_stopped(consumer, stop: GracefulStop, timeout_millis: int = None, poll_millis: int = 1000):
+    """
+    Receive the next message checking for stop every poll_millis
+    :param consumer:
+    :param stop:
+    :param timeout_millis: Max time to wait. None to wait until a message arrives or stop is set.
+    :param poll_millis:
+    :return: The message or None when stopping or timed out. Errors other than the receive timing out e.g. a closed
+    consumer are raised.
+    """
+    deadline = None if timeout_millis is None else time.time() + timeout_millis / 1000
+    while not stop.is_set():
+        wait_ms = poll_millis
+        if deadline is not None:
+            wait_ms = min(wait_ms, int((deadline - time.time()) * 1000))
+            if wait_ms <= 0:
+                return None
+        try:
+            return consumer.receive(timeout_millis=max(1, wait_ms))
+        except Exception as e:
+            if not is_receive_timeout(e):
+                raise
+    return None
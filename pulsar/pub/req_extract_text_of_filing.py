@@ -4,7 +4,11 @@ import logging
 import pulsar
 import boto3
 import json
-from queue import Queue
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from async_publisher import AsyncPublisher
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -84,7 +88,7 @@ def fetch_s3_keys(cik: str = "315852", form_type: str = "8-K", date_str: str = "
         prefix = cik + "|"
 
     client = boto3.client('s3')
-    paginator = client.get_paginator('list_objects')
+    paginator = client.get_paginator('list_objects_v2')
     operation_parameters = {'Bucket': bucket,
                             'Prefix': prefix}
     page_iterator = paginator.paginate(**operation_parameters)
@@ -97,41 +101,268 @@ def fetch_s3_keys(cik: str = "315852", form_type: str = "8-K", date_str: str = "
     return s3_keys
 
 
-def s3_files_to_extract_text_publish(s3_keys: iter, producer_pool: dict):
+def list_cik_s3_keys(s3_client, cik: str, form_types: set, date_str: str, bucket: str):
+    """
+    List every filing of a company in one pass and keep the form types wanted instead of listing each form type
+    :param s3_client: boto3 s3 client. Clients can be shared between threads.
+    :param cik:
+    :param form_types:
+    :param date_str: Only the filings of this YYYYMMDD date. None for all.
+    :param bucket:
+    :return: Yields the payload of each filing as its page is listed
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=cik + "|"):
+        for s3_file in page.get('Contents', []):
+            # cik|form type|filing date|...
+            key_parts = s3_file['Key'].split('|')
+            if len(key_parts) < 3 or key_parts[1] not in form_types:
+                continue
+            if date_str is not None and key_parts[2] != date_str:
+                continue
+            yield {"bucket": bucket, "key": s3_file['Key']}
+
+
+def s3_files_to_extract_text_publish(s3_keys: iter, producer_pool: dict, on_delivery=None):
     """
 
     :param s3_keys:
-    :param producer_pool:
-    :return:
+    :param producer_pool: form type to AsyncPublisher
+    :param on_delivery: Called with the key and whether it was persisted
+    :return: The form types published to
     """
+    published = set()
     i = 1
-    total = len(s3_keys)
     for payload in s3_keys:
         key = payload['key']
         form_type = key.split('|')[1]
         pulsar_topic = "extract-text-{form_type}".format(form_type=form_type.replace('/', '-').replace(' ', '-'))
         producer = producer_pool[form_type]
         msg = json.dumps(payload).encode('utf-8')
-        producer.send(msg)
+        producer.send(msg, on_delivery=None if on_delivery is None else
+                      lambda ok, key=key: on_delivery(key, ok))
+        published.add(form_type)
 
-        _logger.info("Published {i} of {total} messages to {topic}".format(i=i, total=total, topic=pulsar_topic))
+        _logger.info("Queued {i} messages to {topic}".format(i=i, topic=pulsar_topic))
         i += 1
+    return published
+
+
+class CompanyDeliveries:
+    """
+    Counts the deliveries of one company's filings. The publishers are shared by every company so waiting on them
+    would wait for the other companies too and pick up their failures.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.queued = 0
+        self.delivered = []
+        self.failed = []
+        self.all_queued = False
+
+    def queue(self):
+        with self.lock:
+            self.queued += 1
+
+    def deliver(self, key: str, ok: bool):
+        with self.lock:
+            (self.delivered if ok else self.failed).append(key)
+            self._check()
+
+    def wait(self):
+        """
+        Wait for every filing queued so far. Call once the company's filings are all queued.
+        :return:
+        """
+        with self.lock:
+            self.all_queued = True
+            self._check()
+        self.done.wait()
+
+    def _check(self):
+        if self.all_queued and len(self.delivered) + len(self.failed) == self.queued:
+            self.done.set()
 
 
 def extract_text_by_form_types(cik: str, form_types: str, date_str: str, bucket: str,
-                               producer_pool: dict):
+                               producer_pool: dict, s3_client=None, journal=None):
     """
 
     :param cik:
     :param form_types:
     :param date_str:
     :param bucket:
-    :param producer_pool:
-    :return:
+    :param producer_pool: form type to AsyncPublisher
+    :param s3_client:
+    :param journal: PublishJournal to skip the keys already published and record the new ones
+    :return: The number of filings published
+    """
+    s3_client = s3_client or boto3.client('s3')
+    deliveries = CompanyDeliveries()
+
+    def on_delivery(key: str, ok: bool):
+        if ok and journal is not None:
+            journal.add_key(key)
+        deliveries.deliver(key, ok)
+
+    def queued(s3_keys):
+        for payload in s3_keys:
+            deliveries.queue()
+            yield payload
+
+    s3_keys = list_cik_s3_keys(s3_client, cik=cik, form_types=set(form_types.split(',')), date_str=date_str,
+                               bucket=bucket)
+    if journal is not None:
+        s3_keys = (payload for payload in s3_keys if payload['key'] not in journal.keys)
+    s3_files_to_extract_text_publish(s3_keys=queued(s3_keys), producer_pool=producer_pool, on_delivery=on_delivery)
+    # Wait for every filing of the company to be persisted or fail. send_timeout_millis bounds the wait.
+    deliveries.wait()
+    if len(deliveries.failed) > 0:
+        raise RuntimeError("{count} filings of {cik} failed to publish".format(count=len(deliveries.failed),
+                                                                              cik=cik))
+    if journal is not None:
+        journal.add_cik(cik)
+    return len(deliveries.delivered)
+
+
+def extract_text_ciks(ciks: list, form_types: str, date_str: str, bucket: str, producer_pool: dict,
+                      concurrency: int = 16, journal=None):
+    """
+    List and publish the companies concurrently
+    :param ciks:
+    :param form_types:
+    :param date_str:
+    :param bucket:
+    :param producer_pool: form type to AsyncPublisher
+    :param concurrency: Number of companies listed at the same time
+    :param journal: PublishJournal
+    :return: Yields each cik once all its filings are published
+    """
+    s3_client = boto3.client('s3')
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(extract_text_by_form_types, cik=cik, form_types=form_types, date_str=date_str,
+                                   bucket=bucket, producer_pool=producer_pool, s3_client=s3_client,
+                                   journal=journal): cik
+                   for cik in ciks}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                cik = futures[future]
+                try:
+                    count = future.result()
+                except Exception as e:
+                    _logger.error("Error publishing {cik}\n{error}".format(cik=cik, error=e))
+                    continue
+                _logger.log(logging.CRITICAL, "Published {count} filings of {cik} ({i} of {total})".format(
+                    count=count, cik=cik, i=i, total=len(ciks)))
+                yield cik
+        finally:
+            # Don't start the companies still waiting when stopped early e.g. Ctrl-C
+            for future in futures:
+                future.cancel()
+
+
+class PublishJournal:
+    """
+    Append only file of the S3 keys whose extract-text request was persisted and the ciks that were completely
+    published. It is synced to disk every fsync_secs so a restart skips everything published before it was killed
+    except at most the last few seconds.
+
+    Keys are recorded with their bucket. A cik is only complete for the bucket, form types and filing date it was
+    published with so a run with other options still publishes it.
+    """
+
+    def __init__(self, path: str, bucket: str, form_types: str, filing_date: str = None, fsync_secs: float = 5.0):
+        self.path = path
+        self.bucket = bucket
+        self.scope = "{0}|{1}|{2}".format(bucket, ','.join(sorted(form_types.split(','))), filing_date or '')
+        self.fsync_secs = fsync_secs
+        self.keys = set()
+        self.ciks = set()
+        self.lock = threading.Lock()
+        self.load()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.last_sync = time.time()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        valid_length = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn by a crash in the middle of the write
+                    break
+                kind, scope, value = (line.decode('utf-8').rstrip('\n').split('\t') + ['', ''])[:3]
+                if kind == 'key' and scope == self.bucket:
+                    self.keys.add(value)
+                elif kind == 'cik' and scope == self.scope:
+                    self.ciks.add(value)
+                valid_length += len(line)
+        if os.path.getsize(self.path) > valid_length:
+            os.truncate(self.path, valid_length)
+
+    def add_key(self, key: str):
+        self._append('key', self.bucket, key)
+        self.keys.add(key)
+
+    def add_cik(self, cik: str):
+        self._append('cik', self.scope, cik)
+        self.ciks.add(cik)
+
+    def _append(self, kind: str, scope: str, value: str):
+        with self.lock:
+            self.file.write("{0}\t{1}\t{2}\n".format(kind, scope, value))
+            if time.time() - self.last_sync >= self.fsync_secs:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+def dry_run(ciks: list, form_types: str, date_str: str, bucket: str, journal: PublishJournal = None,
+            concurrency: int = 16):
+    """
+    List the companies that aren't completely published without publishing anything
+    :param ciks:
+    :param form_types:
+    :param date_str:
+    :param bucket:
+    :param journal: None when nothing is journaled e.g. a single -cik
+    :param concurrency:
+    :return: dict of the ciks done and left and the keys done and left by form type
     """
-    for form_type in form_types.split(','):
-        s3_keys = fetch_s3_keys(cik=cik, form_type=form_type, date_str=date_str, bucket=bucket)
-        s3_files_to_extract_text_publish(s3_keys=s3_keys, producer_pool=producer_pool)
+    s3_client = boto3.client('s3')
+    form_type_set = set(form_types.split(','))
+    done_ciks = set() if journal is None else journal.ciks
+    done_keys = set() if journal is None else journal.keys
+    ciks_left = [cik for cik in ciks if cik not in done_ciks]
+
+    def keys_left(cik):
+        return [payload['key'] for payload in list_cik_s3_keys(s3_client, cik, form_type_set, date_str, bucket)
+                if payload['key'] not in done_keys]
+
+    report = {'ciks_done': len(ciks) - len(ciks_left), 'ciks_left': len(ciks_left), 'keys_done': len(done_keys),
+              'keys_left': 0, 'keys_left_by_form_type': {}}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for keys in executor.map(keys_left, ciks_left):
+            report['keys_left'] += len(keys)
+            for key in keys:
+                form_type = key.split('|')[1]
+                report['keys_left_by_form_type'][form_type] = report['keys_left_by_form_type'].get(form_type, 0) + 1
+    return report
 
 
 def parse_args(args):
@@ -173,6 +404,30 @@ def parse_args(args):
                         type=str,
                         default="pulsar://10.0.0.11:6650,pulsar://10.0.0.12:6650,pulsar://10.0.0.13:6650")
 
+    parser.add_argument("-c",
+                        "--concurrency",
+                        help="Number of ciks listed and published at the same time",
+                        type=int,
+                        default=16)
+
+    parser.add_argument("-j",
+                        "--journal",
+                        help="Journal of the published filings to resume from. Defaults to <cik_file>.journal. "
+                             "Runs with -cik are only journaled when this is given. "
+                             "Delete it to publish everything again.",
+                        type=str)
+
+    parser.add_argument("-fs",
+                        "--fsync_secs",
+                        help="Seconds between syncing the journal to disk",
+                        type=float,
+                        default=5.0)
+
+    parser.add_argument("-dry",
+                        "--dry_run",
+                        help="Report how many ciks and filings are left to publish without publishing",
+                        action="store_true")
+
     parser.add_argument("-bkt",
                         "--bucket",
                         help="S3 Bucket to pull from",
@@ -218,50 +473,68 @@ def main(args):
         setup_logging(args.loglevel)
     else:
         setup_logging(loglevel=logging.WARNING)
+    if args.cik != "":
+        ciks = [args.cik]
+    else:
+        with open(args.cik_file, 'r') as cik_file:
+            ciks = [line.strip() for line in cik_file if line.strip() != ""]
+    # A single -cik run stays out of the cik file's journal
+    journal = None
+    if args.journal or args.cik == "":
+        journal = PublishJournal(args.journal or "{0}.journal".format(args.cik_file), bucket=args.bucket,
+                                 form_types=args.form_types, filing_date=args.filing_date,
+                                 fsync_secs=args.fsync_secs)
+
+    if args.dry_run:
+        report = dry_run(ciks, form_types=args.form_types, date_str=args.filing_date, bucket=args.bucket,
+                         journal=journal, concurrency=args.concurrency)
+        if journal is not None:
+            journal.close()
+        print("CIKs published:      {0}".format(report['ciks_done']))
+        print("CIKs left:           {0}".format(report['ciks_left']))
+        print("Filings published:   {0}".format(report['keys_done']))
+        print("Filings left:        {0}".format(report['keys_left']))
+        for form_type, count in sorted(report['keys_left_by_form_type'].items()):
+            print("  {0:<18} {1}".format(form_type, count))
+        return
+
     client = pulsar.Client(args.pulsar_connection_string)
 
     producer_pool = {}
     for form_type in DEFAULT_FORM_TYPES:
         pulsar_topic = "extract-text-{form_type}".format(form_type=form_type.replace('/', '-'))
+        # Companies wait for their own deliveries rather than flushing the shared producers so keep the batching
+        # delay short
         producer = client.create_producer(topic=pulsar_topic,
                                           block_if_queue_full=True,
                                           batching_enabled=True,
                                           send_timeout_millis=300000,
-                                          batching_max_publish_delay_ms=120000
+                                          batching_max_publish_delay_ms=1000
                                           )
-        producer_pool[form_type] = producer
+        producer_pool[form_type] = AsyncPublisher(producer)
 
-    cik_que = Queue()
+    # Only counted once published so a failure leaves it in the remaining file
+    published = set() if journal is None else set(journal.ciks)
     try:
-        if args.cik != "":
-            extract_text_by_form_types(cik=args.cik, form_types=args.form_types, date_str=args.filing_date,
-                                       bucket=args.bucket,
-                                       producer_pool=producer_pool)
-        else:
-            count_lines = 0
-            with open(args.cik_file, 'r') as cik_file:
-                for line in cik_file:
-                    cik_que.put(line.strip())
-                    count_lines += 1
-
-            i = 1
-            while not cik_que.empty():
-                cik = cik_que.get()
-                _logger.log(logging.CRITICAL,
-                            "Processing {i} of {total} on {cik} from file {file}".format(i=i,
-                                                                                         cik=cik,
-                                                                                         total=count_lines,
-                                                                                         file=args.cik_file))
-                extract_text_by_form_types(cik=cik.strip(), form_types=args.form_types, date_str=args.filing_date,
-                                           bucket=args.bucket, producer_pool=producer_pool)
-                i += 1
+        _logger.log(logging.CRITICAL, "Processing {total} ciks from {file} {concurrency} at a time. {done} already "
+                                      "published in {journal}".format(total=len(ciks), file=args.cik_file,
+                                                                      concurrency=args.concurrency,
+                                                                      done=len(published & set(ciks)),
+                                                                      journal=None if journal is None
+                                                                      else journal.path))
+        for cik in extract_text_ciks([cik for cik in ciks if cik not in published], form_types=args.form_types,
+                                     date_str=args.filing_date, bucket=args.bucket, producer_pool=producer_pool,
+                                     concurrency=args.concurrency, journal=journal):
+            published.add(cik)
         _logger.log(logging.CRITICAL, "Publishing CIK complete")
     finally:
-        if not cik_que.empty():
+        if journal is not None:
+            journal.close()
+        remaining = [cik for cik in ciks if cik not in published]
+        if len(remaining) > 0 and args.cik == "":
             _logger.log(logging.CRITICAL, "Incomplete processing dumping remaining ciks")
-            ciks = list(cik_que.queue)
             with open("remaining_{0}".format(args.cik_file), 'w') as remaining_cik_file:
-                remaining_cik_file.write('\n'.join(ciks))
+                remaining_cik_file.write('\n'.join(remaining))
 
         client.close()
 
@@ -0,0 +1 @@
+../pub/async_publisher.py
\ No newline at end of file
@@ -7,11 +7,16 @@ import argparse
 import sys
 import logging
 import elasticsearch
+from elasticsearch import helpers
 import pulsar
 import json
 import os
 import socket
-from datetime import date
+import time
+from datetime import date, datetime
+import message_schema
+from async_publisher import AsyncPublisher
+from graceful_stop import GracefulStop, receive_until_stopped
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -41,46 +46,359 @@ def init_els_index(es: elasticsearch.Elasticsearch):
                 "text_line_id": {"type": "keyword"},
                 "search_term": {"type": "keyword"},
                 "search_term_category": {"type": "keyword"},
-                "capital_allocation": {"type": "object"}
+                "capital_allocation": {"type": "object"},
+                "classifier_version": {"type": "keyword"},
+                "indexed_at": {"type": "date"},
+                "top_category": {"type": "keyword"},
+                "top_prob": {"type": "float"}
             }
         }}
 
         es.indices.create(index="cap_alloc_event", body=text_line_def)
+    else:
+        # Indices created before these fields were added would otherwise guess their types
+        es.indices.put_mapping(index="cap_alloc_event",
+                               body={"properties": {"classifier_version": {"type": "keyword"},
+                                                    "indexed_at": {"type": "date"},
+                                                    "top_category": {"type": "keyword"},
+                                                    "top_prob": {"type": "float"}}})
+
+
+def cap_alloc_event_id(doc: dict):
+    """
+    The same sentence found by the same search category always gets the same id so researching or reclassifying it
+    overwrites the event instead of adding another copy. A sentence several terms of the category match is one event
+    under the last term that found it. The model it was classified with is the classifier_version field.
+    :param doc:
+    :return: None for docs without a text_line_id
+    """
+    if doc.get('text_line_id') is None:
+        return None
+    return "{text_line_id}|{search_term_category}".format(text_line_id=doc['text_line_id'],
+                                                          search_term_category=doc.get('search_term_category'))
+
+
+# Bulk item statuses worth retrying. Anything else e.g. a mapping error fails the same way every time.
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+def receive_batch(consumer, batch_size: int, flush_interval_ms: int, stop: GracefulStop):
+    """
+    Block for the first message then keep gathering until the batch is full or the flush interval passes
+    :param consumer:
+    :param batch_size:
+    :param flush_interval_ms: How long to wait for a batch to fill after the first message arrives
+    :param stop: Stop waiting for the first message once set
+    :return: Empty when stopping
+    """
+    msg = receive_until_stopped(consumer, stop)
+    if msg is None:
+        return []
+    msgs = [msg]
+    deadline = time.time() + flush_interval_ms / 1000
+    while len(msgs) < batch_size:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0:
+            break
+        try:
+            msgs.append(consumer.receive(timeout_millis=remaining_ms))
+        except Exception:
+            # The pulsar client raises a plain Exception when the receive times out
+            break
+    return msgs
+
+
+def bulk_index(es: elasticsearch.Elasticsearch, docs: list, index: str = "cap_alloc_event", max_retries: int = 3,
+               backoff_secs: float = 2):
+    """
+    Index the docs with bulk requests retrying the ones rejected for back pressure with exponential backoff
+    :param es:
+    :param docs:
+    :param index:
+    :param max_retries:
+    :param backoff_secs: Wait before the first retry. Doubles on every retry.
+    :return: dict of the position of each doc that failed to whether it is worth retrying later and the error.
+    Positions not in it were indexed.
+    """
+    pending = list(range(len(docs)))
+    errors = {}
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            time.sleep(backoff_secs * 2 ** (attempt - 1))
+
+        body = []
+        for i in pending:
+            action = {"_index": index}
+            doc_id = cap_alloc_event_id(docs[i])
+            if doc_id is not None:
+                action["_id"] = doc_id
+            body.append({"index": action})
+            body.append(docs[i])
+        try:
+            res = es.bulk(body=body, request_timeout=300)
+        except elasticsearch.exceptions.TransportError as e:
+            # The whole request failed e.g. a timeout or the cluster is unreachable
+            errors.update({i: (True, str(e)) for i in pending})
+            continue
+
+        retry = []
+        for i, item in zip(pending, res['items']):
+            result = item['index']
+            if result['status'] < 300:
+                errors.pop(i, None)
+            else:
+                retryable = result['status'] in RETRY_STATUSES
+                errors[i] = (retryable, json.dumps(result.get('error', result['status'])))
+                if retryable:
+                    retry.append(i)
+        pending = retry
+        if len(pending) == 0:
+            break
+    return errors
+
+
+def dead_letter(producer, msg, error: str):
+    """
+    Publish the message to the dead letter topic with why it failed so it can be replayed once fixed
+    :param producer:
+    :param msg:
+    :param error:
+    :return:
+    """
+    producer.send(msg.data(), properties={"error": error[:1000],
+                                          "message_id": str(msg.message_id())})
+
+
+def process_batch(es: elasticsearch.Elasticsearch, consumer, dead_letter_producer, msgs: list,
+                  max_retries: int = 3, changed_publisher: AsyncPublisher = None):
+    """
+    Index a batch of messages and only ack the ones indexed or dead lettered.
+    Docs rejected with a permanent error are dead lettered. Docs that still fail after the retries are negative acked
+    so Pulsar redelivers them later.
+    :param es:
+    :param consumer:
+    :param dead_letter_producer:
+    :param msgs:
+    :param max_retries:
+    :param changed_publisher: Publishes the cik of every company with a newly indexed event
+    :return: The number of messages indexed, dead lettered and redelivered
+    """
+    docs = []
+    doc_msgs = []
+    dead_lettered = 0
+    for msg in msgs:
+        try:
+            doc = message_schema.decode(msg.data())
+            doc["as_of_date"] = date.fromisoformat(doc["as_of_date"])
+            # Lets create_timeline pick up only the events indexed since its last run
+            doc["indexed_at"] = datetime.utcnow()
+            if doc.get("capital_allocation"):
+                # Indexed so timelines can be aggregated without fetching capital_allocation
+                doc["top_category"], doc["top_prob"] = max(doc["capital_allocation"].items(), key=lambda cat: cat[1])
+        except Exception as e:
+            _logger.error("Error cap_alloc_event:{msg}".format(msg=msg.data()) + "\n{0}".format(e))
+            dead_letter(dead_letter_producer, msg, str(e))
+            consumer.acknowledge(msg)
+            dead_lettered += 1
+            continue
+        docs.append(doc)
+        doc_msgs.append(msg)
+
+    errors = bulk_index(es, docs, max_retries=max_retries) if len(docs) > 0 else {}
+    if changed_publisher is not None:
+        # Signal before acking so a crash in between replays the events rather than losing the signal
+        for cik in set(doc['cik'] for i, doc in enumerate(docs) if i not in errors):
+            changed_publisher.send(json.dumps({"cik": cik}).encode('utf-8'), partition_key=str(cik))
+        try:
+            changed_publisher.flush()
+        except RuntimeError as e:
+            # Redeliver the events so their signals are sent again. Indexing them again overwrites them.
+            _logger.error("Error publishing the changed ciks\n{0}".format(e))
+            errors.update({i: (True, str(e)) for i in range(len(docs)) if i not in errors})
+
+    redelivered = 0
+    for i, msg in enumerate(doc_msgs):
+        if i not in errors:
+            consumer.acknowledge(msg)
+            continue
+
+        retryable, error = errors[i]
+        if retryable:
+            # Still overloaded or unreachable after the retries so let Pulsar redeliver it
+            consumer.negative_acknowledge(msg)
+            redelivered += 1
+        else:
+            _logger.error("Error cap_alloc_event:{doc}".format(doc=docs[i]) + "\n{0}".format(error))
+            dead_letter(dead_letter_producer, msg, error)
+            consumer.acknowledge(msg)
+            dead_lettered += 1
+    return len(doc_msgs) - len(errors), dead_lettered, redelivered
 
 
 def cap_alloc_event_subscribe(es: elasticsearch.Elasticsearch,
                               sub_topic: str = "cap-alloc-event",
-                              pulsar_connection_string: str = "pulsar://localhost:6650"):
+                              pulsar_connection_string: str = "pulsar://localhost:6650",
+                              dead_letter_topic: str = "cap-alloc-event-dlq",
+                              batch_size: int = 500,
+                              flush_interval_ms: int = 1000,
+                              max_retries: int = 3,
+                              changed_topic: str = "cik-changed"):
     """
 
     :param es:
     :param sub_topic:
     :param pulsar_connection_string:
+    :param dead_letter_topic: Where messages that can't be indexed are published
+    :param batch_size: Max docs in a bulk request
+    :param flush_interval_ms: Max time to wait for a bulk request to fill
+    :param max_retries: Retries of docs rejected for back pressure before they are redelivered
+    :param changed_topic: Where the cik of each company with new events is published for debounce_timeline.py.
+    None to not publish.
     :return:
     """
     init_els_index(es)
+    stop = GracefulStop()
     client = pulsar.Client(pulsar_connection_string)
+    dead_letter_producer = client.create_producer(topic=dead_letter_topic,
+                                                  block_if_queue_full=True,
+                                                  send_timeout_millis=300000)
+    changed_publisher = None
+    if changed_topic:
+        # Sent asynchronously and flushed once per batch so the batching delay isn't paid for every cik
+        changed_publisher = AsyncPublisher(client.create_producer(topic=changed_topic,
+                                                                  block_if_queue_full=True,
+                                                                  batching_enabled=True,
+                                                                  # debounce_timeline.py is KeyShared so a batch
+                                                                  # must hold one cik
+                                                                  batching_type=pulsar.BatchingType.KeyBased,
+                                                                  send_timeout_millis=300000,
+                                                                  batching_max_publish_delay_ms=1000))
     subscription = '{pulsar_topics}-worker'.format(pulsar_topics=sub_topic)
     consumer_name = "pid: {pid} on {hostname}".format(pid=os.getpid(), hostname=socket.gethostname())
     consumer = client.subscribe(topic=sub_topic,
                                 subscription_name=subscription,
-                                receiver_queue_size=1,
-                                max_total_receiver_queue_size_across_partitions=1,
+                                receiver_queue_size=batch_size,
                                 consumer_type=pulsar.ConsumerType.Shared,
                                 initial_position=pulsar.InitialPosition.Earliest,
-                                consumer_name=consumer_name)
+                                consumer_name=consumer_name,
+                                negative_ack_redelivery_delay_ms=60000)
 
     _logger.info("Waiting for message on {topic}".format(topic=sub_topic))
+    while not stop.is_set():
+        msgs = receive_batch(consumer, batch_size, flush_interval_ms, stop)
+        if len(msgs) == 0:
+            continue
+        indexed, dead_lettered, redelivered = process_batch(es, consumer, dead_letter_producer, msgs, max_retries,
+                                                            changed_publisher)
+        _logger.info("Indexed {indexed} dead lettered {dead_lettered} redelivering {redelivered}".format(
+            indexed=indexed, dead_lettered=dead_lettered, redelivered=redelivered))
+
+    # Drained. process_batch acked the last batch once it was indexed and its changed ciks were flushed.
+    consumer.close()
+    client.close()
+
+
+def backfill_top_category(es: elasticsearch.Elasticsearch, index: str = "cap_alloc_event", ciks: list = None):
+    """
+    Set top_category and top_prob on the events indexed before they were added
+    :param es:
+    :param index:
+    :param ciks: Only update these companies. None for every company.
+    :return: The number of events updated
+    """
+    # Events without a classification are left alone
+    script = {"lang": "painless",
+              "source": "def probs = ctx._source.capital_allocation;"
+                        "if (probs == null) { ctx.op = 'noop'; } else {"
+                        "  String best = null; double bestProb = -1;"
+                        "  for (def cat : probs.entrySet()) {"
+                        "    if (cat.getValue() != null && cat.getValue() > bestProb) {"
+                        "      bestProb = cat.getValue(); best = cat.getKey();"
+                        "    }"
+                        "  }"
+                        "  ctx._source.top_category = best; ctx._source.top_prob = bestProb;"
+                        "}"}
+    query = {"bool": {"must_not": {"exists": {"field": "top_category"}}}}
+    if ciks:
+        query["bool"]["filter"] = {"terms": {"cik": ciks}}
+    res = es.update_by_query(index=index, body={"query": query, "script": script},
+                             conflicts="proceed", request_timeout=3600)
+    return res['updated']
+
+
+def distinct_ciks(es: elasticsearch.Elasticsearch, index: str = "cap_alloc_event"):
+    """
+    Page through every cik in the index with a composite aggregation
+    :param es:
+    :param index:
+    :return:
+    """
+    ciks = []
+    composite = {"size": 1000, "sources": [{"cik": {"terms": {"field": "cik"}}}]}
     while True:
-        msg = consumer.receive()
-        try:
-            content = msg.data().decode('utf-8')
-            doc = json.loads(content)
-            doc["as_of_date"] = date.fromisoformat(doc["as_of_date"])
-            es.index(index='cap_alloc_event', body=doc)
-        except Exception as e:
-            _logger.error("Error cap_alloc_event:{doc}".format(doc=doc) + "\n{0}".format(e))
-        consumer.acknowledge(msg)
+        res = es.search(index=index, body={"size": 0, "aggs": {"ciks": {"composite": composite}}})
+        buckets = res['aggregations']['ciks']['buckets']
+        ciks.extend(bucket['key']['cik'] for bucket in buckets)
+        if len(buckets) < composite['size']:
+            return ciks
+        composite['after'] = res['aggregations']['ciks']['after_key']
+
+
+def bulk_failures(es: elasticsearch.Elasticsearch, actions: list):
+    """
+    :param es:
+    :param actions:
+    :return: dict of the _id of each failed action to its status
+    """
+    if len(actions) == 0:
+        return {}
+    _, errors = helpers.bulk(es, actions, raise_on_error=False, request_timeout=300)
+    return {result['_id']: result['status'] for error in errors for result in error.values()}
+
+
+def compact_cap_alloc_events(es: elasticsearch.Elasticsearch, index: str = "cap_alloc_event", ciks: list = None):
+    """
+    One off job moving the events indexed under auto generated or older ids to their cap_alloc_event_id and deleting
+    the copies. Safe to run while the sink is running and to run again.
+    :param es:
+    :param index:
+    :param ciks: Only compact these companies. Defaults to every company in the index.
+    :return: The number of events kept and deleted
+    """
+    if ciks is None:
+        ciks = distinct_ciks(es, index)
+
+    kept = 0
+    deleted = 0
+    for cik in ciks:
+        hits = helpers.scan(es, index=index, query={"query": {"term": {"cik": cik}}, "seq_no_primary_term": True})
+        copies = {}
+        for hit in hits:
+            doc_id = cap_alloc_event_id(hit['_source'])
+            if doc_id is not None:
+                copies.setdefault(doc_id, []).append(hit)
+
+        # An event already under its id wins. Otherwise the newest copy is moved onto it with create so an event the
+        # sink writes after the scan is never overwritten.
+        creates = []
+        for doc_id, hits in copies.items():
+            if all(hit['_id'] != doc_id for hit in hits):
+                newest = max(hits, key=lambda hit: str(hit['_source'].get('indexed_at', '')))
+                creates.append({"_op_type": "create", "_index": index, "_id": doc_id, "_source": newest['_source']})
+        failed = {doc_id: status for doc_id, status in bulk_failures(es, creates).items() if status != 409}
+        for doc_id, status in failed.items():
+            _logger.error("Keeping the copies of {doc_id} after creating it failed with {status}".format(
+                doc_id=doc_id, status=status))
+
+        # Only delete the copies as they were scanned
+        deletes = [{"_op_type": "delete", "_index": index, "_id": hit['_id'],
+                    "if_seq_no": hit['_seq_no'], "if_primary_term": hit['_primary_term']}
+                   for doc_id, hits in copies.items() if doc_id not in failed
+                   for hit in hits if hit['_id'] != doc_id]
+        deleted += len(deletes) - len(bulk_failures(es, deletes))
+        kept += len(copies)
+        _logger.info("Compacted {cik} to {count} events".format(cik=cik, count=len(copies)))
+    return kept, deleted
 
 
 def parse_args(args):
@@ -115,6 +433,46 @@ def parse_args(args):
                         default='10.0.0.11,10.0.0.12,10.0.0.13'
                         )
 
+    parser.add_argument("-dlt",
+                        "--dead_letter_topic",
+                        help="The topic messages that can't be indexed are published to",
+                        type=str,
+                        default="cap-alloc-event-dlq")
+
+    parser.add_argument("-bs",
+                        "--batch_size",
+                        help="Max docs in a bulk request",
+                        type=int,
+                        default=500)
+
+    parser.add_argument("-fi",
+                        "--flush_interval_ms",
+                        help="Max milliseconds to wait for a bulk request to fill",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument("-mr",
+                        "--max_retries",
+                        help="Retries of docs rejected for back pressure before they are redelivered",
+                        type=int,
+                        default=3)
+
+    parser.add_argument("-ct",
+                        "--changed_topic",
+                        help="The topic the cik of each company with new events is published to. Empty to disable.",
+                        type=str,
+                        default="cik-changed")
+
+    parser.add_argument("-compact",
+                        "--compact",
+                        help="Give the existing events their ids and top category, delete duplicates and exit",
+                        action="store_true")
+
+    parser.add_argument("-cik",
+                        "--cik",
+                        help="Comma separated ciks to compact. Defaults to every company.",
+                        type=str)
+
     parser.add_argument(
         "--version",
         action="version",
@@ -162,7 +520,17 @@ def main(args):
     _logger.info("Starting corp alloc event subscriber")
     elasticsearch_hosts = args.elasticsearch_hosts.split(',')
     es = elasticsearch.Elasticsearch(elasticsearch_hosts)
-    cap_alloc_event_subscribe(es=es, sub_topic=args.sub_topic, pulsar_connection_string=args.pulsar_connection_string)
+    if args.compact:
+        ciks = [int(cik) for cik in args.cik.split(',')] if args.cik else None
+        print("Set the top category of {count} events".format(count=backfill_top_category(es, ciks=ciks)))
+        kept, deleted = compact_cap_alloc_events(es, ciks=ciks)
+        print("Kept {kept} events and deleted {deleted} duplicates".format(kept=kept, deleted=deleted))
+        return
+
+    cap_alloc_event_subscribe(es=es, sub_topic=args.sub_topic, pulsar_connection_string=args.pulsar_connection_string,
+                              dead_letter_topic=args.dead_letter_topic, batch_size=args.batch_size,
+                              flush_interval_ms=args.flush_interval_ms, max_retries=args.max_retries,
+                              changed_topic=args.changed_topic)
 
 
 def run():
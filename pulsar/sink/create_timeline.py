@@ -7,12 +7,16 @@ import argparse
 import sys
 import logging
 import elasticsearch
+from elasticsearch import helpers
 from elasticsearch_dsl import Search
 import pulsar
 import json
 import os
 import socket
-from datetime import date
+import hashlib
+import time
+from graceful_stop import GracefulStop, receive_until_stopped
+from datetime import date, datetime, timedelta
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -21,6 +25,9 @@ __version__ = '0.0.1.'
 
 _logger = logging.getLogger(__name__)
 
+# Checked on the first timeline so old clusters keep working
+AS_OF_DATE_SORTABLE = None
+
 
 def init_els_index(es: elasticsearch.Elasticsearch):
     """
@@ -36,90 +43,353 @@ def init_els_index(es: elasticsearch.Elasticsearch):
                 "cik": {"type": "integer"},
                 "first_date": {"type": "date"},
                 "last_date": {"type": "date"},
-                "events": {"type": "object"}
+                "events": {"type": "object"},
+                "events_hash": {"type": "keyword"}
             }
         }}
 
         es.indices.create(index="corp_timeline", body=text_line_def)
+    else:
+        es.indices.put_mapping(index="corp_timeline", body={"properties": {"events_hash": {"type": "keyword"}}})
+
+    if not es.indices.exists("timeline_state"):
+        timeline_state_def = {"mappings": {
+            "dynamic": False,
+            "properties": {
+                "cik": {"type": "integer"},
+                "indexed_watermark": {"type": "date"}
+            }
+        }}
 
+        es.indices.create(index="timeline_state", body=timeline_state_def)
 
-def do_create_timeline(cik: int, docs: list):
+
+def score_event(search_term_category: str, capital_allocation: dict, min_prob: float = 0.7):
+    """
+    Final filter for corp allocation event
+    :param search_term_category:
+    :param capital_allocation:
+    :param min_prob:
+    :return:
     """
+    cap_alloc_states = sorted(capital_allocation.items(), key=lambda cat: cat[1], reverse=True)
+    cap_alloc_state, cap_alloc_state_prob = cap_alloc_states[0]
+    if cap_alloc_state_prob < min_prob:
+        return cap_alloc_state
+    else:
+        if cap_alloc_state == search_term_category:
+            return cap_alloc_state
+        else:
+            # Use the search category classifier still needs work
+            return search_term_category
 
-    :param cik:
-    :param docs:
+            # Boost the search for term category by 10%
+            # if cap_alloc_state_prob > capital_allocation[search_term_category] + 0.1:
+            #     return cap_alloc_state
+            #
+            # if cap_alloc_state['search_term_category'] + 0.1 > min_prob:
+            #     return search_term_category
+            #
+            # return 'unknown'
+
+
+def event_sort_key(corp_alloc_event):
+    """
+    The order events are folded into a timeline
+    :param corp_alloc_event:
     :return:
     """
+    return [str(corp_alloc_event['as_of_date']), corp_alloc_event.get('text_source_id') or '',
+            corp_alloc_event.get('line_number') or 0]
+
+
+class TimelineBuilder:
+    """
+    Folds events in as_of_date order into timeline periods. The state of the open period can be saved and restored so
+    later events are folded in without replaying the history.
+    """
 
-    def score_event(search_term_category: str, capital_allocation: dict, min_prob: float = 0.7):
+    def __init__(self, cik: int, state: dict = None):
+        state = state or {}
+        self.cik = cik
+        self.first_date = state.get('first_date')
+        self.periods = state.get('periods', [])
+        self.current_period = state.get('open_period')
+        # There are duplicate sentences. Keep a digest rather than the sentence so memory stays small with a digest of
+        # the model the counted copy was classified with.
+        self.unique_sentences = {bytes.fromhex(digest[:16]): bytes.fromhex(digest[16:])
+                                 for digest in state.get('sentence_digests', [])}
+        self.watermark = state.get('watermark')
+        self.indexed_watermark = state.get('indexed_watermark')
+
+    @staticmethod
+    def sentence_digest(sentence: str):
+        return hashlib.sha1(sentence.encode('utf-8')).digest()[:8]
+
+    @staticmethod
+    def classifier_digest(corp_alloc_event):
+        classifier_version = corp_alloc_event.get('classifier_version') or ''
+        return hashlib.sha1(classifier_version.encode('utf-8')).digest()[:4]
+
+    def seen(self, corp_alloc_event):
         """
-        Final filter for corp allocation event
-        :param search_term_category:
-        :param capital_allocation:
-        :param min_prob:
+        Whether the event was already folded in. A reclassified sentence was not so it forces a rebuild.
+        :param corp_alloc_event:
         :return:
         """
-        cap_alloc_states = sorted(capital_allocation.items(), key=lambda cat: cat[1], reverse=True)
-        cap_alloc_state, cap_alloc_state_prob = cap_alloc_states[0]
-        if cap_alloc_state_prob < min_prob:
-            return cap_alloc_state
+        return self.unique_sentences.get(self.sentence_digest(corp_alloc_event['content'])) == \
+            self.classifier_digest(corp_alloc_event)
+
+    def add(self, corp_alloc_event):
+        """
+        Fold in the next event. Events must be added in event_sort_key order.
+        :param corp_alloc_event:
+        :return:
+        """
+        self.watermark = event_sort_key(corp_alloc_event)
+
+        sentence = corp_alloc_event['content']
+        sentence_digest = self.sentence_digest(sentence)
+        if sentence_digest in self.unique_sentences:
+            return
+        self.unique_sentences[sentence_digest] = self.classifier_digest(corp_alloc_event)
+
+        as_of_date = corp_alloc_event['as_of_date']
+        # print("{0}: {1}".format(as_of_date, sentence))
+        search_term_category = corp_alloc_event['search_term_category']
+        if isinstance(corp_alloc_event['capital_allocation'], dict):
+            capital_allocation = corp_alloc_event['capital_allocation']
+        else:
+            capital_allocation = corp_alloc_event['capital_allocation'].to_dict()
+
+        if self.current_period is None:
+            self.first_date = as_of_date
+            self.current_period = {"start": as_of_date,
+                                   "sentence": sentence,
+                                   "sentence_count": 1,
+                                   "corp_alloc": score_event(search_term_category, capital_allocation)}
         else:
-            if cap_alloc_state == search_term_category:
-                return cap_alloc_state
+            final_corp_allocation_state = score_event(search_term_category, capital_allocation)
+            if final_corp_allocation_state != self.current_period["corp_alloc"]:
+                # Close the previous period
+                self.current_period['end'] = as_of_date
+                self.periods.append(self.current_period)
+
+                # Start a new period
+                self.current_period = {"start": as_of_date,
+                                       "sentence": sentence,
+                                       "sentence_count": 1,
+                                       "corp_alloc": final_corp_allocation_state}
             else:
-                # Use the search category classifier still needs work
-                return search_term_category
-
-                # Boost the search for term category by 10%
-                # if cap_alloc_state_prob > capital_allocation[search_term_category] + 0.1:
-                #     return cap_alloc_state
-                #
-                # if cap_alloc_state['search_term_category'] + 0.1 > min_prob:
-                #     return search_term_category
-                #
-                # return 'unknown'
+                # Increment the sentence count used to clean up noise later
+                self.current_period["sentence_count"] += 1
+
+    def timeline(self):
+        """
+        The timeline with the open period running until today
+        :return:
+        """
+        timeline = {"cik": self.cik}
+        if self.first_date is not None:
+            timeline["first_date"] = self.first_date
+
+        timeline_periods = list(self.periods)
+        # Close the final period
+        if self.current_period is not None:
+            today = date.today().isoformat()
+            timeline["last_date"] = today
+            timeline_periods.append(dict(self.current_period, end=today))
+
+        timeline["events"] = timeline_periods
+        return timeline
+
+    def state(self):
+        return {"cik": self.cik,
+                "first_date": self.first_date,
+                "periods": self.periods,
+                "open_period": self.current_period,
+                "sentence_digests": [(digest + classifier).hex()
+                                     for digest, classifier in self.unique_sentences.items()],
+                "watermark": self.watermark,
+                "indexed_watermark": self.indexed_watermark}
+
+
+def do_create_timeline(cik: int, docs):
+    """
+
+    :param cik:
+    :param docs: Iterable of cap_alloc_event docs sorted by as_of_date e.g. the generator from sorted_events
+    :return:
+    """
+    builder = TimelineBuilder(cik)
+    for corp_alloc_event in docs:
+        builder.add(corp_alloc_event)
+    return builder.timeline()
 
+
+def as_of_date_is_date(es: elasticsearch.Elasticsearch, index: str = "cap_alloc_event"):
+    """
+    Indices created before corp_alloc_event.py defined its mapping have as_of_date dynamically mapped as text which
+    Elasticsearch can't sort on
+    :param es:
+    :param index:
+    :return:
+    """
+    mappings = es.indices.get_mapping(index=index)
+    return all(mapping['mappings'].get('properties', {}).get('as_of_date', {}).get('type') == 'date'
+               for mapping in mappings.values())
+
+
+def sorted_events(es: elasticsearch.Elasticsearch, cik: int, page_size: int = 1000, indexed_since: str = None):
+    """
+    Stream a company's events sorted by Elasticsearch one page at a time
+    :param es:
+    :param cik:
+    :param page_size:
+    :param indexed_since: Only the events indexed at or after this time
+    :return: generator of cap_alloc_event docs in as_of_date order and in filing order within a day
+    """
+    s = Search(using=es, index="cap_alloc_event") \
+        .filter("term", cik=cik)
+    if indexed_since is not None:
+        s = s.filter("range", indexed_at={"gte": indexed_since})
+    s = s.sort('as_of_date', 'text_source_id', 'line_number') \
+        .source(['content', 'as_of_date', 'search_term_category', 'capital_allocation', 'classifier_version',
+                 'text_source_id', 'line_number']) \
+        .params(preserve_order=True, size=page_size)
+    return s.scan()
+
+
+def get_timeline_state(es: elasticsearch.Elasticsearch, cik: int):
+    """
+    The saved state of the company's open timeline period or None if it was never built incrementally
+    :param es:
+    :param cik:
+    :return:
+    """
+    try:
+        return es.get(index="timeline_state", id=cik)['_source']
+    except elasticsearch.exceptions.NotFoundError:
+        return None
+
+
+def save_timeline_state(es: elasticsearch.Elasticsearch, builder: TimelineBuilder):
+    es.index(index="timeline_state", body=builder.state(), id=builder.cik)
+
+
+def build_timeline(es: elasticsearch.Elasticsearch, cik: int, full: bool = False,
+                   indexing_lag_secs: int = 300):
+    """
+    Fold the events indexed since the last run into the saved timeline state. Falls back to a full rebuild when there
+    is no state or a new event sorts before events already folded in e.g. a backfilled or reclassified filing.
+    :param es:
+    :param cik:
+    :param full: Always rebuild from the first event
+    :param indexing_lag_secs: Overlap with the last run for events indexed but not yet searchable when it ran
+    :return: TimelineBuilder and whether it was rebuilt from scratch
+    """
+    started = datetime.utcnow()
+    state = None if full else get_timeline_state(es, cik)
+    if state is not None and not all(len(digest) == 24 for digest in state.get('sentence_digests', [])):
+        # Saved before digests included the classifier version
+        state = None
+    if state is not None and state.get('indexed_watermark') is not None:
+        builder = TimelineBuilder(cik, state)
+        indexed_since = (datetime.fromisoformat(state['indexed_watermark']) -
+                         timedelta(seconds=indexing_lag_secs)).isoformat()
+        for corp_alloc_event in sorted_events(es, cik, indexed_since=indexed_since):
+            if state['watermark'] is not None and event_sort_key(corp_alloc_event) <= state['watermark']:
+                if builder.seen(corp_alloc_event):
+                    # Already folded in by the last run
+                    continue
+                _logger.info("Rebuilding timeline of {cik} for an event before its watermark".format(cik=cik))
+                break
+            builder.add(corp_alloc_event)
+        else:
+            builder.indexed_watermark = started.isoformat()
+            return builder, False
+
+    builder = TimelineBuilder(cik)
+    for corp_alloc_event in sorted_events(es, cik):
+        builder.add(corp_alloc_event)
+    builder.indexed_watermark = started.isoformat()
+    return builder, True
+
+
+def daily_states(es: elasticsearch.Elasticsearch, cik: int, min_prob: float = 0.7, page_size: int = 365):
+    """
+    Per day counts of each final capital allocation state and its highest scored sentence computed by Elasticsearch
+    from the indexed top_category and top_prob so only the buckets cross the network.
+    Confident events take their search category and the others their top category like score_event.
+    :param es:
+    :param cik:
+    :param min_prob:
+    :param page_size: Days per page of the composite aggregation
+    :return: Yields (day, dict of state to count, dict of state to sentence) in date order
+    """
+    def states(field: str):
+        return {"terms": {"field": field, "size": 20},
+                "aggs": {"sentence": {"top_hits": {"size": 1,
+                                                   "sort": [{"top_prob": "desc"}],
+                                                   "_source": ["content"]}}}}
+
+    composite = {"size": page_size,
+                 "sources": [{"day": {"date_histogram": {"field": "as_of_date",
+                                                         "calendar_interval": "day",
+                                                         "format": "yyyy-MM-dd"}}}]}
+    body = {"size": 0,
+            "query": {"bool": {"filter": [{"term": {"cik": cik}}, {"exists": {"field": "top_category"}}]}},
+            "aggs": {"days": {"composite": composite,
+                              "aggs": {"confident": {"filter": {"range": {"top_prob": {"gte": min_prob}}},
+                                                     "aggs": {"states": states("search_term_category")}},
+                                       "unsure": {"filter": {"range": {"top_prob": {"lt": min_prob}}},
+                                                  "aggs": {"states": states("top_category")}}}}}}
+    while True:
+        res = es.search(index="cap_alloc_event", body=body, request_timeout=300)
+        days = res['aggregations']['days']
+        for day in days['buckets']:
+            counts = {}
+            sentences = {}
+            for branch in ('confident', 'unsure'):
+                for state in day[branch]['states']['buckets']:
+                    counts[state['key']] = counts.get(state['key'], 0) + state['doc_count']
+                    hit = state['sentence']['hits']['hits'][0]
+                    if state['key'] not in sentences or hit['sort'][0] > sentences[state['key']][0]:
+                        sentences[state['key']] = (hit['sort'][0], hit['_source']['content'])
+            yield day['key']['day'], counts, {state: sentence for state, (_, sentence) in sentences.items()}
+
+        if len(days['buckets']) == 0 or 'after_key' not in days:
+            return
+        composite['after'] = days['after_key']
+
+
+def aggregate_timeline(es: elasticsearch.Elasticsearch, cik: int, min_prob: float = 0.7):
+    """
+    Build the timeline from daily_states instead of the events. A day's state is its most common one so a period can
+    only change between days and sentences repeated on different days count on each day.
+    :param es:
+    :param cik:
+    :param min_prob:
+    :return: The timeline in the same format as do_create_timeline
+    """
     timeline = {"cik": cik}
     current_period = None
     timeline_periods = []
-    unique_sentences = set()
+    for day, counts, sentences in daily_states(es, cik, min_prob):
+        state, count = max(counts.items(), key=lambda state_count: (state_count[1], state_count[0]))
+        if current_period is None:
+            timeline["first_date"] = day
+        elif state == current_period["corp_alloc"]:
+            current_period["sentence_count"] += count
+            continue
+        else:
+            current_period['end'] = day
+            timeline_periods.append(current_period)
+        current_period = {"start": day,
+                          "sentence": sentences[state],
+                          "sentence_count": count,
+                          "corp_alloc": state}
 
-    for corp_alloc_event in docs:
-        # There are duplicate sentences
-        if corp_alloc_event['content'] not in unique_sentences:
-            sentence = corp_alloc_event['content']
-            unique_sentences.add(sentence)
-            as_of_date = corp_alloc_event['as_of_date']
-            # print("{0}: {1}".format(as_of_date, sentence))
-            search_term_category = corp_alloc_event['search_term_category']
-            if isinstance(corp_alloc_event['capital_allocation'], dict):
-                capital_allocation = corp_alloc_event['capital_allocation']
-            else:
-                capital_allocation = corp_alloc_event['capital_allocation'].to_dict()
-
-            if current_period is None:
-                timeline["first_date"] = as_of_date
-                current_period = {"start": as_of_date,
-                                  "sentence": sentence,
-                                  "sentence_count": 1,
-                                  "corp_alloc": score_event(search_term_category, capital_allocation)}
-            else:
-                final_corp_allocation_state = score_event(search_term_category, capital_allocation)
-                if final_corp_allocation_state != current_period["corp_alloc"]:
-                    # Close the previous period
-                    current_period['end'] = as_of_date
-                    timeline_periods.append(current_period)
-
-                    # Start a new period
-                    current_period = {"start": as_of_date,
-                                      "sentence": sentence,
-                                      "sentence_count": 1,
-                                      "corp_alloc": final_corp_allocation_state}
-                else:
-                    # Increment the sentence count used to clean up noise later
-                    current_period["sentence_count"] += 1
-
-    # Close the final period
     if current_period is not None:
         today = date.today().isoformat()
         timeline["last_date"] = today
@@ -130,17 +400,29 @@ def do_create_timeline(cik: int, docs: list):
     return timeline
 
 
-def create_timeline(es: elasticsearch.Elasticsearch, cik: int):
+def create_timeline(es: elasticsearch.Elasticsearch, cik: int, full: bool = False, aggregate: bool = False):
     """
 
     :param es:
     :param cik:
+    :param full: Rebuild from the first event instead of folding in the events since the last run
+    :param aggregate: Build from per day aggregations instead of the events
     :return:
     """
-    # something is wrong with sorting in elasticsearch
-    # s = Search(using=es, index="cap_alloc_event") \
-    #     .filter("term", cik=cik) \
-    #     .sort('cik', 'as_of_date')
+    if aggregate:
+        return aggregate_timeline(es, cik)
+
+    global AS_OF_DATE_SORTABLE
+    if AS_OF_DATE_SORTABLE is None:
+        AS_OF_DATE_SORTABLE = as_of_date_is_date(es)
+        if not AS_OF_DATE_SORTABLE:
+            _logger.warning("cap_alloc_event.as_of_date is not mapped as a date so events are sorted in memory. "
+                            "Reindex cap_alloc_event with the mapping from corp_alloc_event.py to stream them.")
+
+    if AS_OF_DATE_SORTABLE:
+        builder, _ = build_timeline(es, cik, full)
+        save_timeline_state(es, builder)
+        return builder.timeline()
 
     s = Search(using=es, index="cap_alloc_event") \
         .filter("term", cik=cik)
@@ -150,17 +432,63 @@ def create_timeline(es: elasticsearch.Elasticsearch, cik: int):
     return do_create_timeline(cik, docs)
 
 
+def events_hash(timeline: dict):
+    """
+    Hash of the timeline's periods. The open period's end is left out because it is always today.
+    :param timeline:
+    :return:
+    """
+    events = [dict(event) for event in timeline['events']]
+    if len(events) > 0:
+        events[-1].pop('end', None)
+    return hashlib.sha1(json.dumps(events, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def write_timelines(es: elasticsearch.Elasticsearch, timelines: dict):
+    """
+    Write the timelines that changed in one bulk request. A timeline whose periods are unchanged is still written once
+    a day so the stored last_date and open period end don't go stale.
+    :param es:
+    :param timelines: dict of symbol to timeline
+    :return: the number of timelines written and skipped
+    """
+    for timeline in timelines.values():
+        timeline['events_hash'] = events_hash(timeline)
+
+    res = es.mget(index='corp_timeline', body={"ids": list(timelines.keys())},
+                  _source_includes=['events_hash', 'last_date'])
+    stored = {doc['_id']: (doc['_source'].get('events_hash'), doc['_source'].get('last_date'))
+              for doc in res['docs'] if doc.get('found')}
+    actions = [{"_op_type": "index", "_index": "corp_timeline", "_id": symbol, "_source": timeline}
+               for symbol, timeline in timelines.items()
+               if stored.get(symbol) != (timeline['events_hash'], timeline.get('last_date'))]
+    if len(actions) > 0:
+        helpers.bulk(es, actions, request_timeout=300)
+    return len(actions), len(timelines) - len(actions)
+
+
 def create_timeline_subscribe(es: elasticsearch.Elasticsearch,
                               sub_topic: str = "cap-alloc-event",
-                              pulsar_connection_string: str = "pulsar://localhost:6650"):
+                              pulsar_connection_string: str = "pulsar://localhost:6650",
+                              full: bool = False,
+                              aggregate: bool = False,
+                              batch_size: int = 200,
+                              flush_interval_ms: int = 5000,
+                              report_interval: int = 60):
     """
 
     :param es:
     :param sub_topic:
     :param pulsar_connection_string:
+    :param full: Rebuild every timeline from its first event. Requests with full set are always rebuilt.
+    :param aggregate: Build timelines from per day aggregations instead of the events
+    :param batch_size: Max timelines in a bulk write
+    :param flush_interval_ms: Max time a timeline waits to be written
+    :param report_interval: Seconds between reports of the timelines written and skipped
     :return:
     """
     init_els_index(es)
+    stop = GracefulStop()
     client = pulsar.Client(pulsar_connection_string)
     subscription = '{pulsar_topics}-worker'.format(pulsar_topics=sub_topic)
     consumer_name = "pid: {pid} on {hostname}".format(pid=os.getpid(), hostname=socket.gethostname())
@@ -171,21 +499,65 @@ def create_timeline_subscribe(es: elasticsearch.Elasticsearch,
                                 consumer_name=consumer_name)
 
     _logger.info("Waiting for message on {topic}".format(topic=sub_topic))
-    while True:
-        msg = consumer.receive()
-        content = msg.data().decode('utf-8')
-        doc = json.loads(content)
-        try:
-            cik = doc['cik']
-            symbol = doc['symbol']
-            company_name = doc['company_name']
-            timeline = create_timeline(es, cik)
-            timeline['symbol'] = symbol
-            timeline['company_name'] = company_name
-            es.index(index='corp_timeline', body=timeline, id=symbol)
-        except Exception as e:
-            _logger.error("Error  create_timeline:{doc}".format(doc=doc) + "\n{0}".format(e))
-        consumer.acknowledge(msg)
+    timelines = {}
+    msgs = []
+    flush_deadline = None
+    written = 0
+    skipped = 0
+    report_start = time.time()
+    # Once stopping keep going until the timelines built so far are written and their requests acked
+    while not stop.is_set() or len(msgs) > 0:
+        timeout_millis = None if flush_deadline is None else max(1, int((flush_deadline - time.time()) * 1000))
+        msg = receive_until_stopped(consumer, stop, timeout_millis)
+
+        if msg is not None:
+            msgs.append(msg)
+            content = msg.data().decode('utf-8')
+            doc = json.loads(content)
+            try:
+                cik = doc['cik']
+                symbol = doc['symbol']
+                company_name = doc['company_name']
+                timeline = create_timeline(es, cik, full=full or doc.get('full', False), aggregate=aggregate)
+                timeline['symbol'] = symbol
+                timeline['company_name'] = company_name
+                timelines[symbol] = timeline
+                if flush_deadline is None:
+                    flush_deadline = time.time() + flush_interval_ms / 1000
+            except Exception as e:
+                _logger.error("Error  create_timeline:{doc}".format(doc=doc) + "\n{0}".format(e))
+
+        if len(timelines) >= batch_size or (flush_deadline is not None and time.time() >= flush_deadline) or \
+                (stop.is_set() and len(timelines) > 0):
+            try:
+                batch_written, batch_skipped = write_timelines(es, timelines)
+                written += batch_written
+                skipped += batch_skipped
+                # Only ack the requests once their timelines are stored
+                for written_msg in msgs:
+                    consumer.acknowledge(written_msg)
+            except Exception as e:
+                _logger.error("Error writing {count} timelines".format(count=len(timelines)) + "\n{0}".format(e))
+                for failed_msg in msgs:
+                    consumer.negative_acknowledge(failed_msg)
+            timelines = {}
+            msgs = []
+            flush_deadline = None
+        elif len(timelines) == 0:
+            # Nothing to write for the requests that failed
+            for failed_msg in msgs:
+                consumer.acknowledge(failed_msg)
+            msgs = []
+
+        if time.time() - report_start >= report_interval and written + skipped > 0:
+            _logger.critical("Wrote {written} timelines and skipped {skipped} unchanged in {elapsed:.0f}s".format(
+                written=written, skipped=skipped, elapsed=time.time() - report_start))
+            written = 0
+            skipped = 0
+            report_start = time.time()
+
+    consumer.close()
+    client.close()
 
 
 def parse_args(args):
@@ -220,6 +592,34 @@ def parse_args(args):
                         default='10.0.0.11,10.0.0.12,10.0.0.13'
                         )
 
+    parser.add_argument("-full",
+                        "--full",
+                        help="Rebuild timelines from the first event instead of the events since the last run",
+                        action="store_true")
+
+    parser.add_argument("-bs",
+                        "--batch_size",
+                        help="Max timelines in a bulk write",
+                        type=int,
+                        default=200)
+
+    parser.add_argument("-fi",
+                        "--flush_interval_ms",
+                        help="Max milliseconds a timeline waits to be written",
+                        type=int,
+                        default=5000)
+
+    parser.add_argument("-agg",
+                        "--aggregate",
+                        help="Build timelines from per day aggregations of the events instead of the events",
+                        action="store_true")
+
+    parser.add_argument("-ri",
+                        "--report_interval",
+                        help="Seconds between reports of the timelines written and skipped",
+                        type=int,
+                        default=60)
+
     parser.add_argument(
         "--version",
         action="version",
@@ -268,7 +668,9 @@ def main(args):
     elasticsearch_hosts = args.elasticsearch_hosts.split(',')
     es = elasticsearch.Elasticsearch(elasticsearch_hosts)
     # create_timeline(es, cik=93410, symbol='CVX')
-    create_timeline_subscribe(es=es, sub_topic=args.sub_topic, pulsar_connection_string=args.pulsar_connection_string)
+    create_timeline_subscribe(es=es, sub_topic=args.sub_topic, pulsar_connection_string=args.pulsar_connection_string,
+                              full=args.full, aggregate=args.aggregate, batch_size=args.batch_size,
+                              flush_interval_ms=args.flush_interval_ms, report_interval=args.report_interval)
 
 
 def run():
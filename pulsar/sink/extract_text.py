@@ -14,6 +14,8 @@ from pathlib import Path
 import elasticsearch
 from elasticsearch import helpers
 import socket
+import sentence_vectors
+from graceful_stop import GracefulStop, receive_until_stopped
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -26,6 +28,13 @@ NLTK_TOKENIZER = nltk.data.load('tokenizers/punkt/english.pickle')
 
 __els_init__ = False
 
+# Longest a filing's text_line can take to be written. search_filings.py searches this far behind the newest parse_date
+# because parse_date is stamped before the write.
+BULK_TIMEOUT_SECS = 300
+
+# Pulsar rejects messages over 5MB so the sentences of large filings are published in chunks
+MAX_MESSAGE_BYTES = 1024 * 1024
+
 DEFAULT_FORM_TYPES = [
     '8-K',
     '8-K/A',
@@ -164,7 +173,8 @@ def init_els_index(es: elasticsearch.Elasticsearch):
                 "line_number": {"type": "integer"},
                 "as_of_date": {"type": "date"},
                 "cik": {"type": "integer"},
-                "form_type": {"type": "keyword"}
+                "form_type": {"type": "keyword"},
+                "parse_date": {"type": "date"}
             }
         }}
 
@@ -178,7 +188,7 @@ def save_to_elasticsearch(es: elasticsearch.Elasticsearch, bucket: str, key: str
     :param bucket:
     :param key:
     :param sentences:
-    :return:
+    :return: The text_source_id and the text_line documents saved
     """
     parse_date = datetime.datetime.now()
     text_source_doc_id = bucket + "|" + key
@@ -195,20 +205,24 @@ def save_to_elasticsearch(es: elasticsearch.Elasticsearch, bucket: str, key: str
                           "parse_date": parse_date,
                           "parser_version": __version__}
 
-    res = es.index(index="text_source", body=text_source_action)
+    res = es.index(index="text_source", body=text_source_action, request_timeout=BULK_TIMEOUT_SECS)
     text_source_id = res['_id']
     for line_number, content in enumerate(sentences, 1):
         line_action = {"_index": "text_line",
+                       "_id": "{text_source_id}-{line_number}".format(text_source_id=text_source_id,
+                                                                      line_number=line_number),
                        "text_source_id": text_source_id,
                        "content": content,
                        "line_number": line_number,
                        "as_of_date": as_of_date,
                        "cik": cik,
-                       "form_type": form_type}
+                       "form_type": form_type,
+                       "parse_date": parse_date}
         data.append(line_action)
 
     _logger.info("Saving to elasticsearch: {text_source_doc_id}".format(text_source_doc_id=text_source_doc_id))
-    helpers.bulk(es, data)
+    helpers.bulk(es, data, request_timeout=BULK_TIMEOUT_SECS)
+    return text_source_id, data
 
 
 def process_extract_text_req(es: elasticsearch.Elasticsearch,
@@ -219,7 +233,7 @@ def process_extract_text_req(es: elasticsearch.Elasticsearch,
     :param es:
     :param bucket:
     :param key:
-    :return:
+    :return: The text_source_id and the text_line documents saved
     """
     s3 = boto3.client('s3')
     with tempfile.SpooledTemporaryFile() as f:
@@ -227,22 +241,113 @@ def process_extract_text_req(es: elasticsearch.Elasticsearch,
         s3.download_fileobj(bucket, key, f)
         f.seek(0)
         sentences = extract_sentences(f.read().decode('utf-8'))
-        save_to_elasticsearch(es=es, bucket=bucket, key=key, sentences=sentences)
+        return save_to_elasticsearch(es=es, bucket=bucket, key=key, sentences=sentences)
+
+
+def filing_sentences(text_source_id: str, lines: list):
+    """
+    The sentences of a newly extracted filing with the fields shared by all its lines
+    :param text_source_id:
+    :param lines: The text_line documents saved for the filing
+    :return:
+    """
+    first_line = lines[0]
+    return {"text_source_id": text_source_id,
+            "cik": first_line['cik'],
+            "form_type": first_line['form_type'],
+            "as_of_date": first_line['as_of_date'].isoformat(),
+            "parse_date": first_line['parse_date'].isoformat(),
+            "lines": [{"content": line['content'],
+                       "line_number": line['line_number'],
+                       "text_line_id": line['_id']} for line in lines]}
+
+
+def filing_chunks(filing: dict, max_bytes: int = MAX_MESSAGE_BYTES):
+    """
+    Split a filing's sentences into messages of at most about max_bytes. Each chunk has the filing fields.
+    :param filing: from filing_sentences
+    :param max_bytes:
+    :return:
+    """
+    header_bytes = len(json.dumps(dict(filing, lines=[])).encode('utf-8'))
+    chunk = []
+    chunk_bytes = header_bytes
+    for line in filing['lines']:
+        line_bytes = len(json.dumps(line).encode('utf-8')) + 2
+        if len(chunk) > 0 and chunk_bytes + line_bytes > max_bytes:
+            yield dict(filing, lines=chunk)
+            chunk = []
+            chunk_bytes = header_bytes
+        chunk.append(line)
+        chunk_bytes += line_bytes
+    if len(chunk) > 0:
+        yield dict(filing, lines=chunk)
+
+
+def publish_filing_sentences(producer: pulsar.Producer, text_source_id: str, lines: list,
+                             max_bytes: int = MAX_MESSAGE_BYTES):
+    """
+    Publish the sentences of a newly extracted filing so they can be matched against the search terms once.
+    Large filings are split into several messages so none go over the broker's message size limit.
+    :param producer:
+    :param text_source_id:
+    :param lines: The text_line documents saved for the filing
+    :param max_bytes:
+    :return:
+    """
+    if len(lines) == 0:
+        return
+
+    filing = filing_sentences(text_source_id, lines)
+    for chunk in filing_chunks(filing, max_bytes):
+        producer.send(json.dumps(chunk).encode('utf-8'))
+
+
+def save_filing_vectors(vector_dir: str, text_source_id: str, lines: list):
+    """
+    Embed the sentences of a newly extracted filing and save them with the company's other filings.
+    :param vector_dir:
+    :param text_source_id:
+    :param lines: The text_line documents saved for the filing
+    :return:
+    """
+    if len(lines) == 0:
+        return
+
+    filing = filing_sentences(text_source_id, lines)
+    vectors = sentence_vectors.vectorize([line['content'] for line in filing['lines']])
+    sentence_vectors.save_filing_vectors(vector_dir, filing, vectors)
 
 
 def extract_text_subscribe(es: elasticsearch.Elasticsearch,
                            pulsar_topics: str = "extract_text",
-                           pulsar_connection_string: str = "pulsar://localhost:6650"):
+                           pulsar_connection_string: str = "pulsar://localhost:6650",
+                           pub_topic: str = None,
+                           pub_form_types: str = "8-K",
+                           vector_dir: str = None):
     """
 
     :param es:
     :param pulsar_topics:
     :param pulsar_connection_string:
+    :param pub_topic: The topic to publish the sentences of new filings to be percolated. None to not publish.
+    :param pub_form_types: Comma separated form types to publish to the pub_topic
+    :param vector_dir: Save the sentence vectors of the pub_form_types filings to this directory. None to not save.
     :return:
     """
+    stop = GracefulStop()
     client = pulsar.Client(pulsar_connection_string)
 
     try:
+        producer = None
+        if pub_topic is not None:
+            producer = client.create_producer(topic=pub_topic,
+                                              block_if_queue_full=True,
+                                              batching_enabled=True,
+                                              send_timeout_millis=300000,
+                                              batching_max_publish_delay_ms=120000)
+        pub_form_types = set(pub_form_types.split(','))
+
         subscription = '{pulsar_topics}-worker'.format(pulsar_topics=pulsar_topics)
         if ',' in pulsar_topics:
             pts = pulsar_topics.split(',')
@@ -259,8 +364,10 @@ def extract_text_subscribe(es: elasticsearch.Elasticsearch,
                                     consumer_name=consumer_name)
 
         _logger.info("Subscribed to {topic} with {subscription}".format(topic=pulsar_topics, subscription=subscription))
-        while True:
-            msg = consumer.receive()
+        while not stop.is_set():
+            msg = receive_until_stopped(consumer, stop)
+            if msg is None:
+                continue
             content = msg.data().decode('utf-8')
             _logger.critical("%s received message '%s' id='%s'", consumer_name, content, msg.message_id())
             req = json.loads(content)
@@ -268,11 +375,21 @@ def extract_text_subscribe(es: elasticsearch.Elasticsearch,
             key = req.get('key')
 
             try:
-                process_extract_text_req(es=es, bucket=bucket, key=key)
+                text_source_id, lines = process_extract_text_req(es=es, bucket=bucket, key=key)
+                if key.split('|')[1] in pub_form_types:
+                    if producer is not None:
+                        publish_filing_sentences(producer, text_source_id, lines)
+                    if vector_dir is not None:
+                        save_filing_vectors(vector_dir, text_source_id, lines)
             except Exception as e:
                 _logger.error("Error processing bucket:{bucket} key:{key}".format(bucket=bucket, key=key)
                               + "\n{0}".format(e))
             consumer.acknowledge(msg)
+
+        # Drained. The current filing was finished and acked above.
+        if producer is not None:
+            producer.flush()
+        consumer.close()
     finally:
         client.close()
 
@@ -325,6 +442,25 @@ def parse_args(args):
                         type=str,
                         default='10.0.0.11,10.0.0.12,10.0.0.13')
 
+    parser.add_argument("-pt",
+                        "--pub_topic",
+                        help="Publish the sentences of new filings to this topic e.g. percolate-8-K to be matched "
+                             "against the capital allocation search terms",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("-pfts",
+                        "--pub_form_types",
+                        help="Comma separated form types to publish to the pub_topic or save vectors of",
+                        type=str,
+                        default="8-K")
+
+    parser.add_argument("-vd",
+                        "--vector_dir",
+                        help="Save the sentence vectors of new filings to this directory for vector retrieval",
+                        type=str,
+                        default=None)
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -371,7 +507,8 @@ def main(args):
     elasticsearch_hosts = args.elasticsearch_hosts.split(',')
     es = elasticsearch.Elasticsearch(elasticsearch_hosts)
     init_els_index(es)
-    extract_text_subscribe(es, args.pulsar_topics, args.pulsar_connection_string)
+    extract_text_subscribe(es, args.pulsar_topics, args.pulsar_connection_string,
+                           pub_topic=args.pub_topic, pub_form_types=args.pub_form_types, vector_dir=args.vector_dir)
 
 
 def run():
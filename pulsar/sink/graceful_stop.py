@@ -0,0 +1 @@
+../pub/graceful_stop.py
\ No newline at end of file
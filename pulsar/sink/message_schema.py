@@ -0,0 +1 @@
+../transformer/message_schema.py
\ No newline at end of file
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+CPU only sentence vectors from hashed word unigrams and bigrams.
+
+Sentences are embedded when a filing is extracted and saved as a float16 matrix per filing under a directory per
+company. Retrieval loads a company's filings as one matrix and scores every sentence against every category prototype
+with a single matrix product.
+"""
+
+import os
+import re
+import json
+import zlib
+import tempfile
+import numpy as np
+from datetime import datetime
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+
+DIMENSIONS = 1024
+
+TOKEN_PATTERN = re.compile(r"\w+(?:['’.]\w+)*", re.UNICODE)
+
+
+def hashed_features(sentence: str):
+    """
+    Unigrams and bigrams of the lower case words of the sentence
+    :param sentence:
+    :return:
+    """
+    tokens = TOKEN_PATTERN.findall(sentence.lower())
+    return tokens + [first + ' ' + second for first, second in zip(tokens, tokens[1:])]
+
+
+def vectorize(sentences: list, dimensions: int = DIMENSIONS):
+    """
+    Embed sentences as L2 normalized signed hashed n-gram counts with sublinear term frequency.
+    crc32 is used instead of hash() so vectors are the same in every process.
+    :param sentences:
+    :param dimensions:
+    :return: float32 matrix of shape (len(sentences), dimensions)
+    """
+    vectors = np.zeros((len(sentences), dimensions), dtype=np.float32)
+    for row, sentence in enumerate(sentences):
+        counts = {}
+        for feature in hashed_features(sentence):
+            h = zlib.crc32(feature.encode('utf-8'))
+            column = h % dimensions
+            sign = -1.0 if (h >> 31) & 1 else 1.0
+            counts[(column, sign)] = counts.get((column, sign), 0) + 1
+        for (column, sign), count in counts.items():
+            vectors[row, column] += sign * (1 + np.log(count))
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def save_filing_vectors(vector_dir: str, filing: dict, vectors: np.ndarray):
+    """
+    Save the vectors of a filing's sentences to {vector_dir}/{cik}/{text_source_id}.npz
+    :param vector_dir:
+    :param filing: cik, text_source_id, form_type, as_of_date, parse_date and lines with content, line_number and
+    text_line_id in the same order as the vectors
+    :param vectors:
+    :return:
+    """
+    cik_dir = os.path.join(vector_dir, str(filing['cik']))
+    os.makedirs(cik_dir, exist_ok=True)
+    # Write to a temp file first so a reader never loads half a filing
+    with tempfile.NamedTemporaryFile(dir=cik_dir, suffix='.tmp', delete=False) as f:
+        np.savez(f, vectors=vectors.astype(np.float16), filing=np.array(json.dumps(filing)))
+    os.replace(f.name, os.path.join(cik_dir, "{0}.npz".format(filing['text_source_id'])))
+
+
+def parse_datetime(value):
+    """
+    parse_date is written by Python isoformat and read back from Elasticsearch aggregations in a different format so
+    compare them as datetimes rather than strings
+    :param value: datetime or an ISO 8601 string e.g. 2019-10-24T12:00:00.123Z or 2019-10-24 12:00:00.123456
+    :return: naive datetime
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value.replace(tzinfo=None)
+
+
+def parsed_between(parse_date, since, until=None):
+    """
+    :param parse_date:
+    :param since:
+    :param until: None for no upper bound
+    :return: True if parse_date is after since and not after until
+    """
+    if parse_date is None:
+        return False
+    parse_date = parse_datetime(parse_date)
+    return parse_date > parse_datetime(since) and (until is None or parse_date <= parse_datetime(until))
+
+
+def load_cik_vectors(vector_dir: str, cik: int, since: str = None, until: str = None):
+    """
+    Load every saved filing of a company as one matrix
+    :param vector_dir:
+    :param cik:
+    :param since: Only load filings parsed after this parse_date
+    :param until: Only load filings parsed on or before this parse_date. Only applies with since.
+    :return: float16 matrix and a list of sentence dicts with the filing fields for each row
+    """
+    cik_dir = os.path.join(vector_dir, str(cik))
+    matrices = []
+    sentences = []
+    if os.path.isdir(cik_dir):
+        for file_name in sorted(os.listdir(cik_dir)):
+            if not file_name.endswith('.npz'):
+                continue
+            with np.load(os.path.join(cik_dir, file_name)) as saved:
+                filing = json.loads(saved['filing'].item())
+                if since is not None and not parsed_between(filing.get('parse_date'), since, until):
+                    continue
+                matrices.append(saved['vectors'])
+            lines = filing.pop('lines')
+            sentences.extend(dict(filing, **line) for line in lines)
+
+    if len(matrices) == 0:
+        return np.zeros((0, DIMENSIONS), dtype=np.float16), sentences
+    return np.vstack(matrices), sentences
+
+
+def category_prototypes(terms: list, dimensions: int = DIMENSIONS):
+    """
+    One vector per category from the mean of its search term vectors
+    :param terms: list of (category, search_term)
+    :param dimensions:
+    :return: the categories and a float32 matrix with a row per category
+    """
+    categories = []
+    for category, _ in terms:
+        if category not in categories:
+            categories.append(category)
+
+    term_vectors = vectorize([term for _, term in terms], dimensions)
+    term_categories = np.array([categories.index(category) for category, _ in terms])
+    prototypes = np.stack([term_vectors[term_categories == i].mean(axis=0) for i in range(len(categories))])
+    prototypes /= np.linalg.norm(prototypes, axis=1, keepdims=True)
+    return categories, prototypes
+
+
+def best_categories(vectors: np.ndarray, prototypes: np.ndarray):
+    """
+    Cosine similarity of every sentence to every prototype in one pass
+    :param vectors: normalized sentence vectors
+    :param prototypes: normalized category prototypes
+    :return: the index of the most similar category and its similarity for each sentence
+    """
+    similarity = vectors.astype(np.float32) @ prototypes.T
+    best = np.argmax(similarity, axis=1)
+    return best, similarity[np.arange(len(best)), best]
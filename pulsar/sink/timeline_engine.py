@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Batch timeline segmentation for many companies at once.
+
+Events are loaded into flat NumPy arrays (company, date, search category id, probability matrix and sentence digest) and
+the scoring, duplicate removal and period segmentation are done with array operations instead of one Python step per
+event. The timelines are the same as create_timeline.do_create_timeline builds one company at a time.
+
+Benchmark against do_create_timeline on synthetic events or on the whole cap_alloc_event index:
+    python timeline_engine.py -n 5000 -e 200
+    python timeline_engine.py -els 10.0.0.11
+"""
+
+import argparse
+import sys
+import time
+import logging
+from datetime import date
+import numpy as np
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+
+class TimelineEvents:
+    """
+    The events of many companies as arrays. Events of a company keep the order they were added in which must be
+    as_of_date order.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.label_ids = {}
+        # The label order of capital_allocation. Events from one classifier share a few so rows are grouped by it.
+        self.layouts = []
+        self.layout_ids = {}
+        self.ciks = []
+        self.dates = []
+        self.categories = []
+        self.event_layouts = []
+        self.probs = []
+        self.digests = []
+        self.sentences = []
+
+    def label_id(self, label: str):
+        if label not in self.label_ids:
+            self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        return self.label_ids[label]
+
+    def layout_id(self, labels: tuple):
+        if labels not in self.layout_ids:
+            self.layout_ids[labels] = len(self.layouts)
+            self.layouts.append([self.label_id(label) for label in labels])
+        return self.layout_ids[labels]
+
+    def add(self, cik: int, corp_alloc_event):
+        capital_allocation = corp_alloc_event['capital_allocation']
+        if not isinstance(capital_allocation, dict):
+            capital_allocation = capital_allocation.to_dict()
+        sentence = corp_alloc_event['content']
+
+        self.ciks.append(cik)
+        self.dates.append(corp_alloc_event['as_of_date'])
+        self.categories.append(self.label_id(corp_alloc_event['search_term_category']))
+        self.event_layouts.append(self.layout_id(tuple(capital_allocation)))
+        self.probs.append(list(capital_allocation.values()))
+        # Same key as create_timeline.TimelineBuilder.sentence_digest. The digests only live for one build so the
+        # built in hash will do.
+        self.digests.append(hash(sentence))
+        self.sentences.append(sentence)
+
+    def arrays(self):
+        """
+        :return: ciks, dates, categories, probability matrix, label position matrix and digests. Missing
+        probabilities are -inf so they are never the top state.
+        """
+        probs = np.full((len(self.probs), len(self.labels)), -np.inf)
+        # Position of each label in the event so ties break like create_timeline.score_event
+        ranks = np.full((len(self.probs), len(self.labels)), np.inf)
+        event_layouts = np.asarray(self.event_layouts, dtype=np.int64)
+        by_layout = np.argsort(event_layouts, kind='stable')
+        bounds = np.searchsorted(event_layouts[by_layout], np.arange(len(self.layouts) + 1))
+        for layout, start, end in zip(self.layouts, bounds[:-1].tolist(), bounds[1:].tolist()):
+            rows = by_layout[start:end]
+            probs[rows[:, None], layout] = np.array([self.probs[i] for i in rows.tolist()], dtype=np.float64) \
+                .reshape(len(rows), len(layout))
+            ranks[rows[:, None], layout] = np.arange(len(layout))
+        return (np.asarray(self.ciks, dtype=np.int64),
+                np.asarray(self.dates, dtype='datetime64[D]'),
+                np.asarray(self.categories, dtype=np.int64),
+                probs,
+                ranks,
+                np.asarray(self.digests, dtype=np.int64))
+
+    @classmethod
+    def from_docs(cls, docs_by_cik: dict):
+        """
+        :param docs_by_cik: dict of cik to its sorted event docs
+        :return:
+        """
+        events = cls()
+        for cik, docs in docs_by_cik.items():
+            for doc in docs:
+                events.add(cik, doc)
+        return events
+
+
+def score_events(categories: np.ndarray, probs: np.ndarray, ranks: np.ndarray, min_prob: float = 0.7):
+    """
+    create_timeline.score_event for every event at once i.e. the top state when it is below min_prob otherwise the
+    search category. Ties go to the label that comes first in the event like the stable sort in score_event.
+    :param categories:
+    :param probs:
+    :param ranks: Position of each label in the event
+    :param min_prob:
+    :return:
+    """
+    top_prob = probs.max(axis=1)
+    top = np.argmin(np.where(probs == top_prob[:, None], ranks, np.inf), axis=1)
+    return np.where(top_prob < min_prob, top, categories)
+
+
+def build_timelines(events: TimelineEvents, min_prob: float = 0.7, today: str = None):
+    """
+    Build the timeline of every company in events
+    :param events:
+    :param min_prob:
+    :param today: End of the open period. Defaults to today.
+    :return: dict of cik to timeline in the same format as do_create_timeline
+    """
+    today = today or date.today().isoformat()
+    ciks, dates, categories, probs, ranks, digests = events.arrays()
+    if len(ciks) == 0:
+        return {}
+
+    # Group by company keeping the event order within each company
+    order = np.argsort(ciks, kind='stable')
+    ciks, dates, categories, probs, ranks, digests = ciks[order], dates[order], categories[order], probs[order], \
+        ranks[order], digests[order]
+
+    # Only the first event of each sentence within a company counts
+    by_sentence = np.lexsort((np.arange(len(ciks)), digests, ciks))
+    sorted_ciks, sorted_digests = ciks[by_sentence], digests[by_sentence]
+    first = np.ones(len(ciks), dtype=bool)
+    first[1:] = (sorted_ciks[1:] != sorted_ciks[:-1]) | (sorted_digests[1:] != sorted_digests[:-1])
+    keep = np.sort(by_sentence[first])
+    order, ciks, dates = order[keep], ciks[keep], dates[keep]
+    states = score_events(categories[keep], probs[keep], ranks[keep], min_prob)
+
+    # A period starts at a company's first event and wherever the state changes
+    new_cik = np.ones(len(ciks), dtype=bool)
+    new_cik[1:] = ciks[1:] != ciks[:-1]
+    starts = np.nonzero(new_cik | np.concatenate([[True], states[1:] != states[:-1]]))[0]
+    counts = np.diff(np.append(starts, len(ciks)))
+    # A period ends where the next one starts or today for a company's last period
+    last_of_cik = np.append(new_cik[starts[1:]], True)
+
+    # Plain lists so building the output doesn't pay for NumPy scalars
+    start_dates = dates[starts].astype(str).tolist()
+    end_dates = start_dates[1:] + [today]
+    period_ciks = ciks[starts].tolist()
+    period_sentences = [events.sentences[i] for i in order[starts].tolist()]
+    period_states = [events.labels[state] for state in states[starts].tolist()]
+
+    timelines = {}
+    events_of_cik = None
+    for cik, first_of_cik, last, start, end, sentence, count, state in zip(
+            period_ciks, new_cik[starts].tolist(), last_of_cik.tolist(), start_dates, end_dates, period_sentences,
+            counts.tolist(), period_states):
+        if first_of_cik:
+            events_of_cik = []
+            timelines[cik] = {"cik": cik, "first_date": start, "last_date": today, "events": events_of_cik}
+        events_of_cik.append({"start": start,
+                              "sentence": sentence,
+                              "sentence_count": count,
+                              "corp_alloc": state,
+                              "end": today if last else end})
+    return timelines
+
+
+def docs_from_elasticsearch(es, page_size: int = 5000):
+    """
+    Every event in cap_alloc_event sorted by company then as_of_date in one scroll
+    :param es:
+    :param page_size:
+    :return: dict of cik to its sorted event docs
+    """
+    from elasticsearch_dsl import Search
+
+    docs_by_cik = {}
+    s = Search(using=es, index="cap_alloc_event") \
+        .sort('cik', 'as_of_date', 'text_source_id', 'line_number') \
+        .source(['cik', 'content', 'as_of_date', 'search_term_category', 'capital_allocation']) \
+        .params(preserve_order=True, size=page_size)
+    for doc in s.scan():
+        docs_by_cik.setdefault(int(doc['cik']), []).append(doc.to_dict())
+    return docs_by_cik
+
+
+def synthetic_events(cik_count: int, events_per_cik: int, seed: int = 0):
+    """
+    Random events with repeated sentences, runs of the same category and some noisy classifications
+    :param cik_count:
+    :param events_per_cik:
+    :param seed:
+    :return: dict of cik to its sorted event docs
+    """
+    labels = ['debt_reduction', 'dividend', 'mergers_acquisitions', 'organic_growth', 'share_repurchase']
+    random = np.random.RandomState(seed)
+    docs_by_cik = {}
+    for cik in range(cik_count):
+        days = np.sort(random.randint(0, 3650, events_per_cik))
+        category = random.randint(len(labels))
+        docs = []
+        for i, day in enumerate(days):
+            if random.rand() < 0.1:
+                category = random.randint(len(labels))
+            if random.rand() < 0.8:
+                # The classifier mostly agrees with the search category
+                probs = np.full(len(labels), 0.0)
+                probs[category] = random.uniform(0.7, 1.0)
+                probs[probs == 0] = (1 - probs[category]) / (len(labels) - 1)
+            else:
+                probs = random.dirichlet(np.ones(len(labels)) * 0.3)
+            docs.append({'content': 'Sentence {0} of {1}'.format(random.randint(events_per_cik), cik),
+                         'as_of_date': str(np.datetime64('2010-01-01') + day),
+                         'search_term_category': labels[category],
+                         'capital_allocation': dict(zip(labels, probs.tolist()))})
+        docs_by_cik[cik] = docs
+    return docs_by_cik
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the batch timeline engine against building one timeline at a time")
+    parser.add_argument(
+        "-n",
+        dest="cik_count",
+        help="Number of synthetic companies",
+        type=int,
+        default=2000)
+    parser.add_argument(
+        "-e",
+        dest="events_per_cik",
+        help="Number of synthetic events per company",
+        type=int,
+        default=200)
+    parser.add_argument(
+        "-els",
+        "--elasticsearch_hosts",
+        help="Comma separated elasticsearch hosts to benchmark on every event in cap_alloc_event instead",
+        type=str)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO)
+    return parser.parse_args(args)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    logging.basicConfig(level=args.loglevel or logging.WARNING, stream=sys.stdout,
+                        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    import create_timeline
+
+    start = time.time()
+    if args.elasticsearch_hosts:
+        import elasticsearch
+
+        docs_by_cik = docs_from_elasticsearch(elasticsearch.Elasticsearch(args.elasticsearch_hosts.split(',')))
+    else:
+        docs_by_cik = synthetic_events(args.cik_count, args.events_per_cik)
+    load_secs = time.time() - start
+
+    # Both start from the same docs so the engine pays for building its arrays
+    start = time.time()
+    expected = {cik: create_timeline.do_create_timeline(cik, docs) for cik, docs in docs_by_cik.items()}
+    loop_secs = time.time() - start
+
+    start = time.time()
+    events = TimelineEvents.from_docs(docs_by_cik)
+    arrays_secs = time.time() - start
+    timelines = build_timelines(events)
+    engine_secs = time.time() - start
+
+    print("Companies:              {0}".format(len(docs_by_cik)))
+    print("Events:                 {0}".format(len(events.ciks)))
+    print("Load secs:              {0:.2f}".format(load_secs))
+    print("Engine array secs:      {0:.2f}".format(arrays_secs))
+    print("do_create_timeline:     {0:.1f} ciks/sec".format(len(docs_by_cik) / loop_secs))
+    print("timeline_engine:        {0:.1f} ciks/sec".format(len(docs_by_cik) / engine_secs))
+    print("Speed up:               {0:.2f}x".format(loop_secs / engine_secs))
+    print("Identical timelines:    {0}".format(timelines == expected))
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+A compact in-memory inverted index with BM25 scoring used to run the capital allocation searches without Elasticsearch.
+Postings are kept in flat NumPy arrays (CSR layout) so a company's sentences fit in a few arrays and every query is a
+handful of vectorized array operations.
+"""
+
+import re
+import numpy as np
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+
+# Close to the Elasticsearch standard analyzer: lower case words keeping inner apostrophes and periods e.g. company's
+TOKEN_PATTERN = re.compile(r"\w+(?:['’.]\w+)*", re.UNICODE)
+
+
+# Lucene keeps document lengths up to this exactly and rounds longer ones down to 4 significant bits
+NORM_FREE_VALUES = 24
+
+
+def analyze(text: str):
+    """
+    Split text into lower case tokens
+    :param text:
+    :return:
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def lucene_doc_length(length: int):
+    """
+    The document length Lucene scores with after storing it in a one byte norm i.e. SmallFloat.intToByte4 then
+    byte4ToInt
+    :param length:
+    :return:
+    """
+    if length < NORM_FREE_VALUES:
+        return length
+    i = length - NORM_FREE_VALUES
+    shift = max(i.bit_length() - 4, 0)
+    return NORM_FREE_VALUES + ((i >> shift) << shift)
+
+
+class InMemoryBM25Index:
+    """
+    Inverted index over the content of a list of documents.
+
+    Scoring follows the Elasticsearch 7 explain output i.e. (k1 + 1) * idf * tf / (tf + k1 * (1 - b + b * dl / avgdl))
+    with dl stored as a Lucene norm. Elasticsearch takes idf and avgdl from the whole shard rather than the documents a
+    search is filtered to so pass the shard's statistics to get the same scores. Without them the statistics of the
+    loaded documents are used and scores are only close to the cluster's.
+    """
+
+    def __init__(self, docs: list, k1: float = 1.2, b: float = 0.75):
+        """
+
+        :param docs: dicts with a content field
+        :param k1:
+        :param b:
+        """
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+
+        term_ids = []
+        doc_ids = []
+        term_freqs = []
+        doc_lengths = np.zeros(len(docs), dtype=np.float32)
+        for doc_id, doc in enumerate(docs):
+            tokens = analyze(doc['content'])
+            doc_lengths[doc_id] = len(tokens)
+            counts = {}
+            for token in tokens:
+                term_id = self.vocabulary.setdefault(token, len(self.vocabulary))
+                counts[term_id] = counts.get(term_id, 0) + 1
+            term_ids.extend(counts.keys())
+            doc_ids.extend([doc_id] * len(counts))
+            term_freqs.extend(counts.values())
+
+        term_ids = np.asarray(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind='stable')
+        self.postings_doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        self.postings_term_freqs = np.asarray(term_freqs, dtype=np.float32)[order]
+        doc_freqs = np.bincount(term_ids, minlength=len(self.vocabulary))
+        self.offsets = np.concatenate([[0], np.cumsum(doc_freqs)]).astype(np.int64)
+        self.avg_doc_length = float(doc_lengths.mean()) if len(docs) > 0 else 0.0
+        self.doc_lengths = np.array([lucene_doc_length(int(length)) for length in doc_lengths], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def postings(self, token: str):
+        """
+        The doc ids and term frequencies of the documents containing the token
+        :param token:
+        :return:
+        """
+        term_id = self.vocabulary.get(token)
+        if term_id is None:
+            return self.postings_doc_ids[:0], self.postings_term_freqs[:0]
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.postings_doc_ids[start:end], self.postings_term_freqs[start:end]
+
+    @staticmethod
+    def idf(doc_count: int, doc_freq: int):
+        return np.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def search(self, query: str, exclude: list = (), stats: dict = None):
+        """
+        Same semantics as a bool query with a must match on query and a must_not match on each exclude term i.e.
+        a document matches any query token and is dropped if it contains any exclude token.
+        :param query:
+        :param exclude:
+        :param stats: The shard statistics Elasticsearch scores with i.e. doc_count, avg_doc_length and doc_freqs of
+        the query tokens. None to use the loaded documents.
+        :return: Yields (doc, score) ordered by descending score
+        """
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        matched = np.zeros(len(self.docs), dtype=bool)
+        doc_count = len(self.docs) if stats is None else stats['doc_count']
+        avg_doc_length = self.avg_doc_length if stats is None else stats['avg_doc_length']
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(avg_doc_length, 1e-9))
+
+        # Repeated query tokens are separate should clauses in Elasticsearch so they are scored once each
+        for token in analyze(query):
+            doc_ids, term_freqs = self.postings(token)
+            if len(doc_ids) == 0:
+                continue
+            doc_freq = len(doc_ids) if stats is None else max(stats['doc_freqs'].get(token, 0), len(doc_ids))
+            scores[doc_ids] += (self.k1 + 1) * self.idf(max(doc_count, doc_freq), doc_freq) * term_freqs / (
+                    term_freqs + length_norm[doc_ids])
+            matched[doc_ids] = True
+
+        for exclude_term in exclude:
+            for token in analyze(exclude_term):
+                doc_ids, _ = self.postings(token)
+                matched[doc_ids] = False
+
+        hits = np.nonzero(matched)[0]
+        for doc_id in hits[np.argsort(-scores[hits], kind='stable')]:
+            yield self.docs[doc_id], float(scores[doc_id])
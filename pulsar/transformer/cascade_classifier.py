@@ -0,0 +1 @@
+../../frontend/cascade_classifier.py
\ No newline at end of file
@@ -10,7 +10,10 @@ import pulsar
 import os
 import socket
 import sentence_classifier
-import json
+import time
+from async_publisher import AsyncPublisher
+from graceful_stop import GracefulStop, receive_until_stopped
+import message_schema
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -20,22 +23,96 @@ __version__ = "0.0.1"
 _logger = logging.getLogger(__name__)
 
 
+def receive_batch(consumer: pulsar.Consumer, batch_size: int, batch_deadline_ms: int, stop: GracefulStop):
+    """
+    Block for the first message then keep gathering until the batch is full or the deadline passes
+    :param consumer:
+    :param batch_size:
+    :param batch_deadline_ms: How long to wait for a batch to fill after the first message arrives
+    :param stop: Stop waiting for the first message once set
+    :return: Empty when stopping
+    """
+    msg = receive_until_stopped(consumer, stop)
+    if msg is None:
+        return []
+    msgs = [msg]
+    deadline = time.time() + batch_deadline_ms / 1000
+    while len(msgs) < batch_size:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0:
+            break
+        try:
+            msgs.append(consumer.receive(timeout_millis=remaining_ms))
+        except Exception:
+            # The pulsar client raises a plain Exception when the receive times out
+            break
+    return msgs
+
+
+def classify_batch(sentences: list, batch_size: int):
+    """
+    Classify the whole batch at once falling back to one at a time so a bad sentence only fails itself
+    :param sentences:
+    :param batch_size:
+    :return: The capital allocation categories of each sentence or the exception raised classifying it
+    """
+    try:
+        return sentence_classifier.classify_sentences(sentences, batch_size=batch_size)
+    except Exception as batch_error:
+        _logger.error("Error classifying batch falling back to single sentences\n{0}".format(batch_error))
+
+    results = []
+    for sentence in sentences:
+        try:
+            results.append(sentence_classifier.classify_sentence(sentence, format='dict'))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def delivery_ack(consumer: pulsar.Consumer, msg):
+    """
+    :param consumer:
+    :param msg: The upstream message
+    :return: Delivery callback for AsyncPublisher.send that acks msg once its result is persisted
+    """
+    def on_delivery(ok: bool):
+        if ok:
+            consumer.acknowledge(msg)
+        else:
+            consumer.negative_acknowledge(msg)
+    return on_delivery
+
+
 def classify_sentences_subscribe(sub_topic: str = "classify-sentence",
                                  pub_topic: str = "cap-alloc-event",
-                                 pulsar_connection_string: str = "pulsar://localhost:6650"):
+                                 pulsar_connection_string: str = "pulsar://localhost:6650",
+                                 batch_size: int = 64,
+                                 batch_deadline_ms: int = 500,
+                                 report_interval: int = 60,
+                                 max_in_flight: int = 1000,
+                                 compact: bool = True):
     """
 
     :param sub_topic:
     :param pub_topic:
     :param pulsar_connection_string:
+    :param batch_size: Max number of sentences classified together
+    :param batch_deadline_ms: Max time to wait for a batch to fill
+    :param report_interval: Seconds between throughput reports
+    :param max_in_flight: Max number of classified sentences waiting on the broker
+    :param compact: Send the compact message_schema encoding instead of JSON
     :return:
     """
+    stop = GracefulStop()
     client = pulsar.Client(pulsar_connection_string)
     producer = client.create_producer(topic=pub_topic,
                                       block_if_queue_full=True,
                                       batching_enabled=True,
                                       send_timeout_millis=300000,
-                                      batching_max_publish_delay_ms=120000)
+                                      batching_max_publish_delay_ms=120000,
+                                      compression_type=pulsar.CompressionType.LZ4)
+    publisher = AsyncPublisher(producer, max_in_flight=max_in_flight)
 
     # Subscribe so the messages don't get delete if there are no live subscribers before you start
     pub_subscription = '{pulsar_topics}-worker'.format(pulsar_topics=pub_topic)
@@ -59,26 +136,78 @@ def classify_sentences_subscribe(sub_topic: str = "classify-sentence",
                                          consumer_name=consumer_name)
 
     _logger.info("Waiting for message on {topic}".format(topic=sub_topic))
-    while True:
-        incoming_msg = sentence_consumer.receive()
-        content = incoming_msg.data().decode('utf-8')
-        req = json.loads(content)
-        sentence = req.get('content')
+    report_start = time.time()
+    report_sentences = 0
+    report_classify_secs = 0.0
+    while not stop.is_set():
+        incoming_msgs = receive_batch(sentence_consumer, batch_size, batch_deadline_ms, stop)
+        reqs = []
+        for incoming_msg in incoming_msgs:
+            try:
+                # Either encoding so search_filings.py and percolate_sentences.py can be upgraded in any order
+                reqs.append(message_schema.decode(incoming_msg.data()))
+            except Exception as e:
+                _logger.error("Error processing bucket:{bucket}".format(bucket=incoming_msg.data()) +
+                              "\n{0}".format(e))
+                reqs.append(None)
 
-        try:
-            capital_allocation_cats = sentence_classifier.classify_sentence(sentence, format='dict')
-            req['capital_allocation'] = capital_allocation_cats
-            outgoing_msg = json.dumps(req).encode('utf-8')
-            producer.send(outgoing_msg)
+        classify_start = time.time()
+        sentences = [req.get('content') for req in reqs if req is not None]
+        results = iter(classify_batch(sentences, batch_size))
+        report_classify_secs += time.time() - classify_start
+        report_sentences += len(sentences)
 
-            if pub_consumer is not None:
-                # Close it because we just started it to create a subscription if there wasn't one already.
-                pub_consumer.close()
-                pub_consumer = None
+        for incoming_msg, req in zip(incoming_msgs, reqs):
+            if req is not None:
+                capital_allocation_cats = next(results)
+                try:
+                    if isinstance(capital_allocation_cats, Exception):
+                        raise capital_allocation_cats
+                    req['capital_allocation'] = capital_allocation_cats
+                    req['classifier_version'] = sentence_classifier.classifier_version()
+                    outgoing_msg = message_schema.encode('cap_alloc_event', req, compact=compact)
 
-        except Exception as e:
-            _logger.error("Error processing bucket:{bucket}".format(bucket=content) + "\n{0}".format(e))
-        sentence_consumer.acknowledge(incoming_msg)
+                    if pub_consumer is not None:
+                        # Close it because we just started it to create a subscription if there wasn't one already.
+                        pub_consumer.close()
+                        pub_consumer = None
+
+                    # The sentence is acked once its event is persisted and redelivered if publishing fails
+                    publisher.send(outgoing_msg, on_delivery=delivery_ack(sentence_consumer, incoming_msg))
+                    continue
+
+                except Exception as e:
+                    _logger.error("Error processing bucket:{bucket}".format(bucket=req) + "\n{0}".format(e))
+            sentence_consumer.acknowledge(incoming_msg)
+
+        elapsed = time.time() - report_start
+        if elapsed >= report_interval:
+            report = "Classified {count} sentences in {elapsed:.1f}s: {rate:.1f} sentences/sec overall, " \
+                     "{classify_rate:.1f} sentences/sec in spaCy with batch_size={batch_size} " \
+                     "batch_deadline_ms={deadline}".format(count=report_sentences,
+                                                           elapsed=elapsed,
+                                                           rate=report_sentences / elapsed,
+                                                           classify_rate=report_sentences / max(report_classify_secs,
+                                                                                                1e-9),
+                                                           batch_size=batch_size,
+                                                           deadline=batch_deadline_ms)
+            # The classification service caches in its own workers and doesn't report a hit rate
+            classifier_stats = sentence_classifier.stats()
+            if 'hit_rate' in classifier_stats:
+                report += " cache hit rate {hit_rate:.1%}".format(hit_rate=classifier_stats['hit_rate'])
+            _logger.critical(report)
+            report_start = time.time()
+            report_sentences = 0
+            report_classify_secs = 0.0
+
+    # Drained. Wait for the events in flight so their sentences are acked before the consumer closes.
+    try:
+        publisher.flush()
+    except RuntimeError as e:
+        # Their sentences were negative acked and will be redelivered
+        _logger.error("Error flushing while stopping\n{0}".format(e))
+    sentence_consumer.close()
+    client.close()
 
 
 def parse_args(args):
@@ -104,6 +233,37 @@ def parse_args(args):
                         type=str,
                         default="classify-sentence")
 
+    parser.add_argument("-bs",
+                        "--batch_size",
+                        help="Max number of sentences to classify together with nlp.pipe",
+                        type=int,
+                        default=64)
+
+    parser.add_argument("-bd",
+                        "--batch_deadline_ms",
+                        help="Max milliseconds to wait for a batch to fill after the first sentence arrives",
+                        type=int,
+                        default=500)
+
+    parser.add_argument("-ri",
+                        "--report_interval",
+                        help="Seconds between sentences/sec throughput reports",
+                        type=int,
+                        default=60)
+
+    parser.add_argument("-mif",
+                        "--max_in_flight",
+                        help="Max number of classified sentences waiting on the broker before sends block",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument("-enc",
+                        "--encoding",
+                        help="Encoding of the published events. Use json until every corp_alloc_event.py reads the "
+                             "compact encoding.",
+                        choices=['compact', 'json'],
+                        default='compact')
+
     parser.add_argument("-pcs",
                         "--pulsar_connection_string",
                         help="Pulsar connection string e.g. pulsar://localhost:6650",
@@ -155,7 +315,10 @@ def main(args):
     setup_logging(args.loglevel)
     _logger.info("Starting classify sentence subscriber")
     classify_sentences_subscribe(sub_topic=args.sub_topic, pub_topic=args.pub_topic,
-                                 pulsar_connection_string=args.pulsar_connection_string)
+                                 pulsar_connection_string=args.pulsar_connection_string,
+                                 batch_size=args.batch_size, batch_deadline_ms=args.batch_deadline_ms,
+                                 report_interval=args.report_interval, max_in_flight=args.max_in_flight,
+                                 compact=args.encoding == 'compact')
 
 
 def run():
@@ -0,0 +1 @@
+../../frontend/classify_service.py
\ No newline at end of file
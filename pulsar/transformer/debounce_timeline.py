@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Subscribes to the ciks of companies with newly indexed capital allocation events and requests a timeline refresh for
+each. A burst of events for a company is coalesced into at most one create-timeline request per window so timelines
+stay current without recomputing companies that have nothing new.
+"""
+
+import argparse
+import sys
+import logging
+import elasticsearch
+import pulsar
+import json
+import os
+import socket
+import time
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    """
+    Holds the signals of each company until its window closes. The window opens with the first signal after the
+    previous request was sent so requests for a company are at least a window apart.
+    """
+
+    def __init__(self, window_secs: float = 300):
+        self.window_secs = window_secs
+        # cik to the time its request is due and the signals waiting on it
+        self.pending = {}
+
+    def add(self, cik: int, signal, now: float = None):
+        now = time.time() if now is None else now
+        if cik not in self.pending:
+            self.pending[cik] = (now + self.window_secs, [])
+        self.pending[cik][1].append(signal)
+
+    def next_due(self):
+        """
+        :return: The time the next request is due or None if nothing is pending
+        """
+        return min((due for due, _ in self.pending.values()), default=None)
+
+    def pop_due(self, now: float = None):
+        """
+        :param now:
+        :return: list of (cik, signals) whose window has closed
+        """
+        now = time.time() if now is None else now
+        due_ciks = [cik for cik, (due, _) in self.pending.items() if due <= now]
+        return [(cik, self.pending.pop(cik)[1]) for cik in due_ciks]
+
+
+def timeline_request(es: elasticsearch.Elasticsearch, cik: int):
+    """
+    The create-timeline request for a company in the same format as corp_cmd.py
+    :param es:
+    :param cik:
+    :return: None when the company has no trading symbol
+    """
+    try:
+        corp_desc = es.get(index="corp_desc", id=cik)['_source']
+    except elasticsearch.exceptions.NotFoundError:
+        return None
+    return {'cik': str(cik), 'symbol': corp_desc['symbol'], 'company_name': corp_desc['name']}
+
+
+def debounce_timeline_subscribe(es: elasticsearch.Elasticsearch,
+                                sub_topic: str = "cik-changed",
+                                pub_topic: str = "create-timeline",
+                                pulsar_connection_string: str = "pulsar://localhost:6650",
+                                window_secs: float = 300):
+    """
+
+    :param es:
+    :param sub_topic:
+    :param pub_topic:
+    :param pulsar_connection_string:
+    :param window_secs: Min seconds between timeline requests for a company
+    :return:
+    """
+    client = pulsar.Client(pulsar_connection_string)
+    producer = client.create_producer(topic=pub_topic,
+                                      block_if_queue_full=True,
+                                      send_timeout_millis=300000)
+
+    consumer_name = "pid: {pid} on {hostname}".format(pid=os.getpid(), hostname=socket.gethostname())
+    sub_subscription = '{pulsar_topics}-worker'.format(pulsar_topics=sub_topic)
+    # Key shared so every signal of a company goes to the same debouncer
+    signal_consumer = client.subscribe(topic=sub_topic,
+                                       subscription_name=sub_subscription,
+                                       consumer_type=pulsar.ConsumerType.KeyShared,
+                                       initial_position=pulsar.InitialPosition.Earliest,
+                                       consumer_name=consumer_name)
+
+    debouncer = Debouncer(window_secs)
+    _logger.info("Waiting for message on {topic}".format(topic=sub_topic))
+    while True:
+        next_due = debouncer.next_due()
+        try:
+            if next_due is None:
+                msg = signal_consumer.receive()
+            else:
+                msg = signal_consumer.receive(timeout_millis=max(1, int((next_due - time.time()) * 1000)))
+        except Exception:
+            # The pulsar client raises a plain Exception when the receive times out
+            msg = None
+
+        if msg is not None:
+            try:
+                debouncer.add(int(json.loads(msg.data().decode('utf-8'))['cik']), msg)
+            except Exception as e:
+                _logger.error("Error cik-changed:{msg}".format(msg=msg.data()) + "\n{0}".format(e))
+                signal_consumer.acknowledge(msg)
+
+        for cik, signals in debouncer.pop_due():
+            try:
+                req = timeline_request(es, cik)
+                if req is not None:
+                    producer.send(json.dumps(req).encode('utf-8'))
+                    _logger.info("Requested timeline of {cik} for {count} signals".format(cik=cik,
+                                                                                          count=len(signals)))
+            except Exception as e:
+                _logger.error("Error requesting timeline of {cik}".format(cik=cik) + "\n{0}".format(e))
+                # Redeliver so the refresh isn't lost
+                for signal in signals:
+                    signal_consumer.negative_acknowledge(signal)
+                continue
+            # Only ack once the request is published
+            for signal in signals:
+                signal_consumer.acknowledge(signal)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Coalesce new capital allocation events into at most one timeline refresh per company per window")
+
+    parser.add_argument("-pt",
+                        "--pub_topic",
+                        help="The topic to publish timeline requests to",
+                        type=str,
+                        default="create-timeline")
+
+    parser.add_argument("-st",
+                        "--sub_topic",
+                        help="The topic to subscribe to for the ciks of companies with new events",
+                        type=str,
+                        default="cik-changed")
+
+    parser.add_argument("-pcs",
+                        "--pulsar_connection_string",
+                        help="Pulsar connection string e.g. pulsar://localhost:6650",
+                        type=str,
+                        default="pulsar://10.0.0.11:6650,pulsar://10.0.0.12:6650,pulsar://10.0.0.13:6650"
+                        )
+
+    parser.add_argument("-els",
+                        "--elasticsearch_hosts",
+                        help="Comma separated elasticsearch hosts e.g. host1,host2,host3",
+                        type=str,
+                        default='10.0.0.11,10.0.0.12,10.0.0.13'
+                        )
+
+    parser.add_argument("-w",
+                        "--window_secs",
+                        help="Min seconds between timeline requests for a company",
+                        type=float,
+                        default=300)
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="sub-template {ver}".format(ver=__version__))
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO)
+
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG)
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel, stream=sys.stdout,
+                        format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    if args.loglevel:
+        setup_logging(args.loglevel)
+    else:
+        setup_logging(loglevel=logging.WARNING)
+
+    _logger.debug("Starting debounce timeline subscriber")
+    elasticsearch_hosts = args.elasticsearch_hosts.split(',')
+    es = elasticsearch.Elasticsearch(elasticsearch_hosts)
+    debounce_timeline_subscribe(es=es, sub_topic=args.sub_topic, pub_topic=args.pub_topic,
+                                pulsar_connection_string=args.pulsar_connection_string,
+                                window_secs=args.window_secs)
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, versioned encoding of the sentence messages passed between pipeline stages i.e. classify-sentence and
+cap-alloc-event. The small request topics stay JSON.
+
+Each message type has a schema listing its fields in order. A message is a fixed size header packed with struct
+(magic byte, schema id, version, the fields present and the numbers) followed by the utf-8 strings, so field names are
+never sent. The capital allocation categories are sent as a byte and the probabilities as float64 in category order
+so they arrive exactly as the classifier produced them.
+text_line_id is left out when it is the usual {text_source_id}-{line_number}.
+
+decode reads both these and plain JSON messages so stages can be upgraded one at a time. A message that doesn't fit
+its schema e.g. an extra field or a cik sent as a string is sent as JSON instead.
+
+Add a field by adding a new version of the schema and keeping the old one in SCHEMA_VERSIONS so messages still in
+the topics can be read.
+
+Benchmark bytes per message and encode/decode cost against JSON:
+    python message_schema.py -n 100000
+    python message_schema.py -i messages.json
+"""
+
+import argparse
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+import itertools
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = 0xCA
+# JSON messages start with { so they never start with the magic byte
+MAGIC_BYTE = bytes([MAGIC])
+CATEGORIES = ['debt_reduction', 'dividend', 'mergers_acquisitions', 'organic_growth', 'share_repurchase']
+
+# struct format of each kind of field. Strings are packed as their length and appended after the header.
+KINDS = {'int32': 'i',
+         'int64': 'q',
+         'float32': 'f',
+         'float64': 'd',
+         'str': 'H',
+         'category': 'B',
+         'probs': '{0}d'.format(len(CATEGORIES)),
+         # Version 1 of cap_alloc_event rounded the probabilities to float32
+         'probs32': '{0}f'.format(len(CATEGORIES))}
+PROBS_KINDS = {'probs', 'probs32'}
+
+ENCODE_ERRORS = (struct.error, TypeError, ValueError, KeyError, AttributeError)
+
+
+class MessageSchema:
+
+    def __init__(self, name: str, schema_id: int, version: int, fields: list, derived: dict = None):
+        """
+        :param name:
+        :param schema_id: Unique per schema. Sent in every message.
+        :param version:
+        :param fields: list of (field name, kind)
+        :param derived: field name to a function of the message giving its usual value which is then not sent
+        """
+        self.name = name
+        self.schema_id = schema_id
+        self.version = version
+        self.fields = fields
+        self.derived = derived or {}
+        self.names = {name for name, _ in fields}
+        self.header = struct.Struct('<BBBHH' + ''.join(KINDS[kind] for _, kind in fields))
+        self.missing = {'str': [0], 'category': [0], 'probs': [0.0] * len(CATEGORIES),
+                        'probs32': [0.0] * len(CATEGORIES)}
+
+    def encode(self, doc: dict):
+        """
+        :param doc:
+        :return:
+        :raises: One of ENCODE_ERRORS when the message doesn't fit the schema
+        """
+        if not self.names.issuperset(doc):
+            raise ValueError("Fields {0} are not in {1} v{2}".format(sorted(set(doc) - self.names), self.name,
+                                                                    self.version))
+        present = 0
+        derived = 0
+        values = []
+        strings = []
+        for i, (name, kind) in enumerate(self.fields):
+            if name not in doc:
+                values.extend(self.missing.get(kind, [0]))
+                continue
+            present |= 1 << i
+            value = doc[name]
+            if kind == 'str':
+                if name in self.derived and value == self.derived[name](doc):
+                    derived |= 1 << i
+                    values.append(0)
+                    continue
+                raw = value.encode('utf-8')
+                values.append(len(raw))
+                strings.append(raw)
+            elif kind == 'category':
+                values.append(CATEGORIES.index(value))
+            elif kind in PROBS_KINDS:
+                if len(value) != len(CATEGORIES):
+                    raise ValueError("Categories {0} don't match {1}".format(sorted(value), CATEGORIES))
+                values.extend(value[category] for category in CATEGORIES)
+            else:
+                values.append(value)
+        return self.header.pack(MAGIC, self.schema_id, self.version, present, derived, *values) + b''.join(strings)
+
+    def decode(self, data: bytes):
+        unpacked = self.header.unpack_from(data)
+        present, derived = unpacked[3], unpacked[4]
+        values = iter(unpacked[5:])
+        offset = self.header.size
+        doc = {}
+        derived_names = []
+        for i, (name, kind) in enumerate(self.fields):
+            if kind in PROBS_KINDS:
+                value = dict(zip(CATEGORIES, itertools.islice(values, len(CATEGORIES))))
+            else:
+                value = next(values)
+            if not present >> i & 1:
+                continue
+            if kind == 'str':
+                if derived >> i & 1:
+                    derived_names.append(name)
+                    continue
+                end = offset + value
+                value = data[offset:end].decode('utf-8')
+                offset = end
+            elif kind == 'category':
+                value = CATEGORIES[value]
+            doc[name] = value
+        for name in derived_names:
+            doc[name] = self.derived[name](doc)
+        return doc
+
+
+def text_line_id(doc: dict):
+    return "{0}-{1}".format(doc.get('text_source_id'), doc.get('line_number'))
+
+
+SENTENCE_FIELDS = [('content', 'str'),
+                   ('line_number', 'int32'),
+                   ('as_of_date', 'str'),
+                   ('cik', 'int32'),
+                   ('form_type', 'str'),
+                   ('text_source_id', 'str'),
+                   ('hit_score', 'float64'),
+                   ('text_line_id', 'str'),
+                   ('search_term', 'str'),
+                   ('search_term_category', 'category')]
+
+# Search hits published to classify-sentence
+SENTENCE = MessageSchema('sentence', 1, 1, SENTENCE_FIELDS, derived={'text_line_id': text_line_id})
+# Classified sentences published to cap-alloc-event
+CAP_ALLOC_EVENT_V1 = MessageSchema('cap_alloc_event', 2, 1,
+                                   SENTENCE_FIELDS + [('capital_allocation', 'probs32'), ('classifier_version', 'str')],
+                                   derived={'text_line_id': text_line_id})
+CAP_ALLOC_EVENT = MessageSchema('cap_alloc_event', 2, 2,
+                                SENTENCE_FIELDS + [('capital_allocation', 'probs'), ('classifier_version', 'str')],
+                                derived={'text_line_id': text_line_id})
+
+# The latest version of each schema
+SCHEMAS = {schema.name: schema for schema in [SENTENCE, CAP_ALLOC_EVENT]}
+# Every version that can still be in a topic
+SCHEMA_VERSIONS = {(schema.schema_id, schema.version): schema
+                   for schema in [SENTENCE, CAP_ALLOC_EVENT_V1, CAP_ALLOC_EVENT]}
+
+
+def encode(schema_name: str, doc: dict, compact: bool = True):
+    """
+    :param schema_name: One of SCHEMAS
+    :param doc:
+    :param compact: False to send JSON e.g. while there are still consumers that only read JSON
+    :return:
+    """
+    if compact:
+        try:
+            return SCHEMAS[schema_name].encode(doc)
+        except ENCODE_ERRORS as e:
+            _logger.debug("Sending {schema} as JSON: {error}".format(schema=schema_name, error=e))
+    return json.dumps(doc).encode('utf-8')
+
+
+def decode(data: bytes):
+    """
+    :param data: A compact or JSON message
+    :return:
+    """
+    if data[:1] == MAGIC_BYTE:
+        return SCHEMA_VERSIONS[(data[1], data[2])].decode(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def synthetic_messages(count: int):
+    """
+    cap-alloc-event messages shaped like the ones search_filings.py and classify_sentence.py publish
+    """
+    messages = []
+    for i in range(count):
+        text_source_id = 'dataengine-xyz-edgar-raw-data|{0}|8-K|2019{1:04d}|0001564590-19-{2:06d}.txt'.format(
+            315852 + i % 500, i % 1231, i)
+        line_number = i % 400
+        category = CATEGORIES[i % len(CATEGORIES)]
+        probs = [((i * 7 + j * 13) % 100 + 1) / 101 for j in range(len(CATEGORIES))]
+        messages.append({'content': 'On October {0}, 2019 the Board of Directors approved a share repurchase program '
+                                    'of up to ${1} million of the outstanding common stock.'.format(i % 28 + 1, i % 900),
+                         'line_number': line_number,
+                         'as_of_date': '2019-10-{0:02d}'.format(i % 28 + 1),
+                         'cik': 315852 + i % 500,
+                         'form_type': '8-K',
+                         'text_source_id': text_source_id,
+                         'hit_score': 12.5 + i % 17,
+                         'text_line_id': '{0}-{1}'.format(text_source_id, line_number),
+                         'search_term': 'announced authorized approved new equity shares stock repurchase program',
+                         'search_term_category': category,
+                         'capital_allocation': dict(zip(CATEGORIES, probs)),
+                         'classifier_version': 'corp_alloc_bal-2.0.0'})
+    return messages
+
+
+def benchmark(messages: list, schema_name: str, batch_size: int = 1000):
+    """
+    :param messages:
+    :param schema_name:
+    :param batch_size: Messages per producer batch when measuring compression
+    :return: dict of encoding to bytes/msg, compressed bytes/msg, encode and decode microseconds/msg
+    """
+    results = {}
+    for encoding, compact in [('json', False), ('compact', True)]:
+        start = time.perf_counter()
+        encoded = [encode(schema_name, message, compact=compact) for message in messages]
+        encode_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = [decode(data) for data in encoded]
+        decode_secs = time.perf_counter() - start
+        assert decoded == messages
+
+        # Pulsar compresses the whole batch so fields repeated across messages are compressed too
+        compressed = sum(len(zlib.compress(b''.join(encoded[i:i + batch_size])))
+                         for i in range(0, len(encoded), batch_size))
+        results[encoding] = {'bytes': sum(map(len, encoded)) / len(messages),
+                             'compressed_bytes': compressed / len(messages),
+                             'encode_us': encode_secs / len(messages) * 1e6,
+                             'decode_us': decode_secs / len(messages) * 1e6}
+    return results
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the compact message encoding against JSON")
+    parser.add_argument(
+        "-n",
+        dest="count",
+        help="Number of synthetic cap-alloc-event messages",
+        type=int,
+        default=100000)
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="File of JSON messages one per line to benchmark instead",
+        type=str)
+    parser.add_argument(
+        "-s",
+        "--schema",
+        help="Schema of the messages in the input file",
+        choices=sorted(SCHEMAS),
+        default='cap_alloc_event')
+    parser.add_argument(
+        "-bs",
+        "--batch_size",
+        help="Messages per producer batch when measuring compression",
+        type=int,
+        default=1000)
+    return parser.parse_args(args)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    if args.input:
+        with open(args.input, 'r') as f:
+            messages = [json.loads(line) for line in f if line.strip()]
+    else:
+        messages = synthetic_messages(args.count)
+
+    results = benchmark(messages, args.schema, args.batch_size)
+    print("Messages:  {0}".format(len(messages)))
+    print("{0:<10}{1:>12}{2:>18}{3:>14}{4:>14}".format('encoding', 'bytes/msg', 'zlib bytes/msg', 'encode us',
+                                                       'decode us'))
+    for encoding, result in results.items():
+        print("{0:<10}{1:>12.1f}{2:>18.1f}{3:>14.2f}{4:>14.2f}".format(encoding, result['bytes'],
+                                                                       result['compressed_bytes'],
+                                                                       result['encode_us'], result['decode_us']))
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Subscribes to the sentences of newly extracted 8-K filings and matches them against the capital allocation search
+terms registered as stored percolator queries. Matches are published straight to classify-sentence so each filing is
+matched once when it is extracted instead of being searched again on every run of search_filings.
+"""
+
+import argparse
+import sys
+import logging
+import elasticsearch
+import pulsar
+import json
+import os
+import socket
+import search_filings
+from async_publisher import AsyncPublisher
+from graceful_stop import GracefulStop, receive_until_stopped
+import message_schema
+
+__author__ = "Phat Loc"
+__copyright__ = "Phat Loc"
+__license__ = "mit"
+__version__ = "0.0.1"
+
+_logger = logging.getLogger(__name__)
+
+# A percolated sentence is scored on its own rather than against the whole text_line index so the search min_score
+# does not carry over. Requiring a few of the search term words plays the same role.
+PERCOLATE_MIN_TERMS = 3
+
+
+def init_els_index(es: elasticsearch.Elasticsearch, min_terms: int = PERCOLATE_MIN_TERMS):
+    """
+    Use this to define the elsaticsearch index otherwise the system just guesses the data types.
+    Registers the capital allocation search terms as stored queries.
+
+    :param es:
+    :param min_terms:
+    :return:
+    """
+    if not es.indices.exists("cap_alloc_query"):
+        cap_alloc_query_def = {"mappings": {
+            "properties": {
+                "query": {"type": "percolator"},
+                "content": {"type": "text"},
+                "search_term": {"type": "keyword"},
+                "search_term_category": {"type": "keyword"}
+            }
+        }}
+
+        es.indices.create(index="cap_alloc_query", body=cap_alloc_query_def)
+
+    # Re-register every time so changes to the search terms are picked up
+    query_ids = []
+    for search_term_category, search_term in search_filings.capital_allocation_terms():
+        minimum_should_match = min(min_terms, len(search_term.split()))
+        stored_query = {"query": search_filings.cap_alloc_query(search_term, minimum_should_match).to_dict(),
+                        "search_term": search_term,
+                        "search_term_category": search_term_category}
+        query_id = "{category}|{term}".format(category=search_term_category, term=search_term)
+        es.index(index="cap_alloc_query", body=stored_query, id=query_id)
+        query_ids.append(query_id)
+    # Drop the queries of search terms that were removed or changed
+    stale = {"query": {"bool": {"must_not": {"ids": {"values": query_ids}}}}}
+    res = es.delete_by_query(index="cap_alloc_query", body=stale, refresh=True, request_timeout=300)
+    if res.get('deleted', 0) > 0:
+        _logger.critical("Deleted {count} stale search terms from cap_alloc_query".format(count=res['deleted']))
+    es.indices.refresh(index="cap_alloc_query")
+
+
+def percolate_sentences(es: elasticsearch.Elasticsearch, sentences: list, batch_limit: int = 500):
+    """
+    Match a filing's sentences against the stored capital allocation queries.
+    :param es:
+    :param sentences: text_line like dicts with at least content
+    :param batch_limit: Number of sentences sent in one percolate request
+    :return: Yields (sentence, search_term, search_term_category, score) for each match
+    """
+    query_count = len(search_filings.capital_allocation_terms())
+    for i in range(0, len(sentences), batch_limit):
+        batch = sentences[i:i + batch_limit]
+        body = {"query": {"percolate": {"field": "query",
+                                        "documents": [{"content": sentence['content']} for sentence in batch]}},
+                "_source": ["search_term", "search_term_category"],
+                "size": query_count}
+        res = es.search(index="cap_alloc_query", body=body, request_timeout=300)
+        for hit in res['hits']['hits']:
+            for slot in hit['fields']['_percolator_document_slot']:
+                yield batch[slot], hit['_source']['search_term'], hit['_source']['search_term_category'], hit['_score']
+
+
+def process_filing(filing: dict, publisher: AsyncPublisher, es: elasticsearch.Elasticsearch, compact: bool = True):
+    """
+    Percolate the sentences of one filing and publish the matches in the same format as search_filings.
+    The matches are only queued. Flush the publisher before acking the filing.
+    :param filing:
+    :param publisher:
+    :param es:
+    :param compact: Send the compact message_schema encoding instead of JSON
+    :return:
+    """
+    sentences = []
+    for line in filing['lines']:
+        words = line['content'].split()
+        if len(words) < 5 or len(words) > 50:
+            # Probably a header or non pulverized
+            continue
+        sentences.append(line)
+
+    for sentence, search_term, search_term_category, score in percolate_sentences(es, sentences):
+        hit = {"content": sentence['content'],
+               "line_number": sentence['line_number'],
+               "as_of_date": filing['as_of_date'],
+               "cik": filing['cik'],
+               "form_type": filing['form_type'],
+               "text_source_id": filing['text_source_id'],
+               "hit_score": score,
+               "text_line_id": sentence['text_line_id'],
+               "search_term": search_term,
+               "search_term_category": search_term_category}
+        msg = message_schema.encode('sentence', hit, compact=compact)
+        publisher.send(msg)
+
+
+def percolate_sentences_subscribe(es: elasticsearch.Elasticsearch,
+                                  sub_topic: str = "percolate-8-K",
+                                  pub_topic: str = "classify-sentence",
+                                  pulsar_connection_string: str = "pulsar://localhost:6650",
+                                  min_terms: int = PERCOLATE_MIN_TERMS,
+                                  max_in_flight: int = 1000,
+                                  compact: bool = True):
+    """
+
+    :param es:
+    :param sub_topic:
+    :param pub_topic:
+    :param pulsar_connection_string:
+    :param min_terms:
+    :param max_in_flight: Max number of matched sentences waiting on the broker
+    :param compact: Send the compact message_schema encoding instead of JSON
+    :return:
+    """
+    stop = GracefulStop()
+    init_els_index(es, min_terms)
+    client = pulsar.Client(pulsar_connection_string)
+    producer = client.create_producer(topic=pub_topic,
+                                      block_if_queue_full=True,
+                                      batching_enabled=True,
+                                      send_timeout_millis=300000,
+                                      batching_max_publish_delay_ms=120000,
+                                      compression_type=pulsar.CompressionType.LZ4)
+    publisher = AsyncPublisher(producer, max_in_flight=max_in_flight)
+
+    # Subscribe so the messages don't get delete if there are no live subscribers before you start
+    pub_subscription = '{pulsar_topics}-worker'.format(pulsar_topics=pub_topic)
+    consumer_name = "pid: {pid} on {hostname}".format(pid=os.getpid(), hostname=socket.gethostname())
+    pub_consumer = client.subscribe(topic=pub_topic,
+                                    subscription_name=pub_subscription,
+                                    receiver_queue_size=1,
+                                    max_total_receiver_queue_size_across_partitions=1,
+                                    consumer_type=pulsar.ConsumerType.Shared,
+                                    initial_position=pulsar.InitialPosition.Earliest,
+                                    consumer_name=consumer_name)
+    _logger.info("Subscribed to {topic} with {subscription}".format(topic=pub_topic, subscription=pub_subscription))
+
+    sub_subscription = '{pulsar_topics}-worker'.format(pulsar_topics=sub_topic)
+    filing_consumer = client.subscribe(topic=sub_topic,
+                                       subscription_name=sub_subscription,
+                                       consumer_type=pulsar.ConsumerType.Shared,
+                                       initial_position=pulsar.InitialPosition.Earliest,
+                                       consumer_name=consumer_name)
+
+    _logger.info("Waiting for message on {topic}".format(topic=sub_topic))
+    while not stop.is_set():
+        msg = receive_until_stopped(filing_consumer, stop)
+        if msg is None:
+            break
+        content = msg.data().decode('utf-8')
+        filing = json.loads(content)
+        try:
+            process_filing(filing=filing, publisher=publisher, es=es, compact=compact)
+            if pub_consumer is not None:
+                # Close it because we just started it to create a subscription if there wasn't one already.
+                pub_consumer.close()
+                pub_consumer = None
+
+        except Exception as e:
+            _logger.error("Error percolating text_source:{text_source_id}".format(
+                text_source_id=filing.get('text_source_id')) + "\n{0}".format(e))
+        try:
+            # Ack the filing only once its matches are persisted
+            publisher.flush()
+        except RuntimeError as e:
+            _logger.error("Error publishing the matches of text_source:{text_source_id}".format(
+                text_source_id=filing.get('text_source_id')) + "\n{0}".format(e))
+            filing_consumer.negative_acknowledge(msg)
+            continue
+        filing_consumer.acknowledge(msg)
+
+    # Drained. Every filing received was flushed and acked before the loop checked stop.
+    filing_consumer.close()
+    client.close()
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Match newly extracted sentences against the capital allocation search terms")
+
+    parser.add_argument("-pt",
+                        "--pub_topic",
+                        help="The topic to publish matching sentences to be classified",
+                        type=str,
+                        default="classify-sentence")
+
+    parser.add_argument("-st",
+                        "--sub_topic",
+                        help="The topic to subscribe to for the sentences of newly extracted filings",
+                        type=str,
+                        default="percolate-8-K")
+
+    parser.add_argument("-pcs",
+                        "--pulsar_connection_string",
+                        help="Pulsar connection string e.g. pulsar://localhost:6650",
+                        type=str,
+                        default="pulsar://10.0.0.11:6650,pulsar://10.0.0.12:6650,pulsar://10.0.0.13:6650"
+                        )
+
+    parser.add_argument("-els",
+                        "--elasticsearch_hosts",
+                        help="Comma separated elasticsearch hosts e.g. host1,host2,host3",
+                        type=str,
+                        default='10.0.0.11,10.0.0.12,10.0.0.13'
+                        )
+
+    parser.add_argument("-mt",
+                        "--min_terms",
+                        help="Number of words of a search term a sentence must contain to match",
+                        type=int,
+                        default=PERCOLATE_MIN_TERMS)
+
+    parser.add_argument("-mif",
+                        "--max_in_flight",
+                        help="Max number of matched sentences waiting on the broker before sends block",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument("-enc",
+                        "--encoding",
+                        help="Encoding of the published sentences. Use json until every classify_sentence.py reads "
+                             "the compact encoding.",
+                        choices=['compact', 'json'],
+                        default='compact')
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="sub-template {ver}".format(ver=__version__))
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO)
+
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG)
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel, stream=sys.stdout,
+                        format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    if args.loglevel:
+        setup_logging(args.loglevel)
+    else:
+        setup_logging(loglevel=logging.WARNING)
+
+    _logger.debug("Starting percolate sentences subscriber")
+    elasticsearch_hosts = args.elasticsearch_hosts.split(',')
+    es = elasticsearch.Elasticsearch(elasticsearch_hosts)
+    percolate_sentences_subscribe(es=es, sub_topic=args.sub_topic, pub_topic=args.pub_topic,
+                                  pulsar_connection_string=args.pulsar_connection_string,
+                                  min_terms=args.min_terms, max_in_flight=args.max_in_flight,
+                                  compact=args.encoding == 'compact')
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -7,11 +7,20 @@ import argparse
 import sys
 import logging
 import elasticsearch
-from elasticsearch_dsl import Search
+from elasticsearch_dsl import Search, Q
 import pulsar
 import json
+import numpy as np
 import os
 import socket
+import itertools
+from datetime import datetime, timedelta
+import bm25_index
+import sentence_vectors
+from sentence_vectors import parse_datetime
+from async_publisher import AsyncPublisher
+from graceful_stop import GracefulStop, receive_until_stopped
+import message_schema
 
 __author__ = "Phat Loc"
 __copyright__ = "Phat Loc"
@@ -38,127 +47,551 @@ DEBT_REDUCTION_TERMS = ["reduce redemption extinguish lower debt borrowing cost
                         "reduction salaries annual bonus layoff",
                         "reduction in force", "lower reduce sg&a"]
 
+EXCLUDE_TERMS = ["suspended", "terminated", "completed", "bonus", "incentive plan", "annual meeting"]
 
-def search_terms(cik: int, es: elasticsearch.Elasticsearch, min_score=12):
+# parse_date is stamped before extract_text.py writes the text_line so a slow write can show up with a parse_date older
+# than lines already searched. The watermark stays this far behind the clock and the overlap is deduplicated.
+WATERMARK_LAG_SECS = 900
+
+# The search_watermark doc listing the search terms the workers search
+SEARCH_TERMS_ID = "search_terms"
+
+
+def capital_allocation_terms():
     """
-    Search indexed sentences for search terms related to capital allocation
+    Every search term paired with the capital allocation category it searches for.
+    :return: list of (search_term_category, search_term)
+    """
+
+    def add_search_term_category(search_term_category: str, search_terms: list):
+        return [(search_term_category, search_term) for search_term in search_terms]
+
+    return add_search_term_category('share_repurchase', SHARE_REPURCHASE_TERMS) + \
+        add_search_term_category('mergers_acquisitions', MERGERS_ACQUISITIONS_TERMS) + \
+        add_search_term_category('dividend', DIVIDEND_TERMS) + \
+        add_search_term_category('organic_growth', ORGANIC_GROWTH_TERMS) + \
+        add_search_term_category('debt_reduction', DEBT_REDUCTION_TERMS)
+
+
+def cap_alloc_query(search_term: str, minimum_should_match: int = None):
+    """
+    The full text query for a search term. Shared by the search and the stored percolator queries.
+    :param search_term:
+    :param minimum_should_match: Number of the search term words a sentence must contain. None for any.
+    :return:
+    """
+    match = {"query": search_term}
+    if minimum_should_match is not None:
+        match["minimum_should_match"] = minimum_should_match
+    return Q("bool",
+             must=[Q("match", content=match)],
+             must_not=[Q("match", content=exclude_term) for exclude_term in EXCLUDE_TERMS])
+
+
+def init_els_index(es: elasticsearch.Elasticsearch):
+    """
+    Use this to define the elsaticsearch index otherwise the system just guesses the data types
+
+    :param es:
+    :return:
+    """
+    if not es.indices.exists("search_watermark"):
+        search_watermark_def = {"mappings": {
+            "properties": {
+                "cik": {"type": "integer"},
+                "parse_date": {"type": "date"},
+                "search_date": {"type": "date"},
+                "search_terms": {"type": "keyword"},
+                "published": {"type": "object", "enabled": False}
+            }
+        }}
+
+        es.indices.create(index="search_watermark", body=search_watermark_def)
+
+
+def get_search_watermark(es: elasticsearch.Elasticsearch, cik: int):
+    """
+    The watermark of the last successful pass or None if never searched.
+    :param es:
     :param cik:
+    :return: dict with the parse_date to search after and the published sentences parsed after it
+    """
+    try:
+        res = es.get(index="search_watermark", id=cik)
+        return res['_source']
+    except elasticsearch.exceptions.NotFoundError:
+        return None
+
+
+def save_search_watermark(es: elasticsearch.Elasticsearch, cik: int, parse_date: str, published: dict = None,
+                          search_terms: list = None):
+    """
+    Record where the next pass starts searching.
     :param es:
-    :param min_score:
+    :param cik:
+    :param parse_date:
+    :param published: sentence_key to parse_date of the sentences already published that were parsed after parse_date
+    :param search_terms: term_key of every search term searched up to parse_date
     :return:
     """
+    watermark = {"cik": cik,
+                 "parse_date": parse_date,
+                 "search_date": datetime.now(),
+                 "search_terms": search_terms or [],
+                 "published": [{"key": key, "parse_date": published_parse_date}
+                               for key, published_parse_date in (published or {}).items()]}
+    es.index(index="search_watermark", body=watermark, id=cik)
 
-    def create_search_for_term(search_term: str):
+
+def term_key(search_term_category: str, search_term: str):
+    return "{0}|{1}".format(search_term_category, search_term)
+
+
+def save_search_terms(es: elasticsearch.Elasticsearch):
+    """
+    Record the search terms this worker searches so corp_cmd.py --delta can tell when terms were added
+    :param es:
+    :return:
+    """
+    es.index(index="search_watermark", id=SEARCH_TERMS_ID,
+             body={"search_terms": [term_key(*term) for term in capital_allocation_terms()],
+                   "search_date": datetime.now()})
+
+
+def lagged_watermark(until: str, now: datetime = None, lag_secs: float = WATERMARK_LAG_SECS):
+    """
+    :param until: The newest parse_date searched
+    :param now:
+    :param lag_secs:
+    :return: until or now - lag_secs if that is earlier, as an ISO 8601 string
+    """
+    now = datetime.now() if now is None else now
+    return min(parse_datetime(until), now - timedelta(seconds=lag_secs)).isoformat()
+
+
+def sentence_key(sentence: dict):
+    return "{0}|{1}".format(sentence['text_line_id'], sentence['search_term'])
+
+
+def latest_parse_date(es: elasticsearch.Elasticsearch, cik: int):
+    """
+    The parse_date of the newest 8-K text_line for the company or None if no text_line has a parse_date.
+    :param es:
+    :param cik:
+    :return:
+    """
+    s = Search(using=es, index="text_line") \
+        .filter("term", cik=cik) \
+        .filter("term", form_type='8-K') \
+        .extra(size=0) \
+        .params(request_timeout=300)
+    s.aggs.metric('latest_parse_date', 'max', field='parse_date')
+    latest = s.execute().aggregations.latest_parse_date
+    if latest.value is None:
+        return None
+    return latest.value_as_string
+
+
+class ElasticsearchBackend:
+    """
+    Searches the text_line index of the Elasticsearch cluster.
+    """
+
+    def __init__(self, es: elasticsearch.Elasticsearch, batch_limit: int = 100):
+        self.es = es
+        self.batch_limit = batch_limit
+
+    def search(self, cik: int, search_term: str, since: str = None, until: str = None):
         """
-        The name says it all create search term for query.
+        Query in batches because scan doesn't produce a score.
+        :param cik:
         :param search_term:
-        :return:
+        :param since: Only search text_line parsed after this parse_date. None searches the whole history.
+        :param until: Only search text_line parsed on or before this parse_date. Only applies with since.
+        :return: Yields text_line hits ordered by descending score
         """
-        s = Search(using=es, index="text_line") \
+        s = Search(using=self.es, index="text_line") \
             .filter("term", cik=cik) \
             .filter("term", form_type='8-K') \
-            .query("match", content=search_term) \
-            .exclude("match", content="suspended") \
-            .exclude("match", content="terminated") \
-            .exclude("match", content="completed") \
-            .exclude("match", content="bonus") \
-            .exclude("match", content="incentive plan") \
-            .exclude("match", content="annual meeting") \
+            .query(cap_alloc_query(search_term)) \
             .params(request_timeout=300)
-        return s, search_term
+        if since is not None:
+            parse_date_range = {"gt": since}
+            if until is not None:
+                parse_date_range["lte"] = until
+            s = s.filter("range", parse_date=parse_date_range)
 
-    def execute_search(s: Search, search_term: str, search_term_category: str, batch_limit=100):
-        """
-        Query in batches because scan doesn't produce a score. Yield only the ones that have high scores.
-        :param s:
-        :param search_term:
-        :param search_term:
-        :param batch_limit:
-        :return:
-        """
         count = s.count()
         if count == 0:
             return
 
-        batch_size = min(count, batch_limit)
+        batch_size = min(count, self.batch_limit)
         i = 0
         while i < count:
             batch = s[i:i + batch_size]
             results = batch.execute()
             for hit in results:
                 i += 1
-                if hit.meta.score > min_score:
-                    words = hit.content.split()
-                    if len(words) < 5 or len(words) > 50:
-                        # Probably a header or non pulverized
-                        pass
-                    else:
-                        yield {"content": hit.content,
-                               "line_number": hit.line_number,
-                               "as_of_date": hit.as_of_date,
-                               "cik": hit.cik,
-                               "form_type": hit.form_type,
-                               "text_source_id": hit.text_source_id,
-                               "hit_score": hit.meta.score,
-                               "text_line_id": hit.meta.id,
-                               "search_term": search_term,
-                               "search_term_category": search_term_category}
-                else:
-                    return
-        return
+                yield {"content": hit.content,
+                       "line_number": hit.line_number,
+                       "as_of_date": hit.as_of_date,
+                       "cik": hit.cik,
+                       "form_type": hit.form_type,
+                       "text_source_id": hit.text_source_id,
+                       "score": hit.meta.score,
+                       "text_line_id": hit.meta.id,
+                       "parse_date": getattr(hit, 'parse_date', None)}
+
+
+class InMemoryBackend:
+    """
+    Loads a company's 8-K sentences once into an in-memory BM25 index and runs every search term against it.
+    """
 
-    def add_search_term_category(search_term_category: str, search_terms: list):
-        return [(search_term_category, search_term) for search_term in search_terms]
+    def __init__(self, load_text_lines, corpus_statistics=None):
+        """
+
+        :param load_text_lines: function of (cik, since, until) returning the company's 8-K text_line documents
+        :param corpus_statistics: function of the search term returning the text_line statistics Elasticsearch scores
+        it with so min_score means the same thing. None scores with the statistics of the loaded sentences.
+        """
+        self.load_text_lines = load_text_lines
+        self.corpus_statistics = corpus_statistics
+        self.index_key = None
+        self.index = None
+
+    def search(self, cik: int, search_term: str, since: str = None, until: str = None):
+        """
+        Same semantics as cap_alloc_query
+        :param cik:
+        :param search_term:
+        :param since:
+        :param until:
+        :return: Yields text_line hits ordered by descending score
+        """
+        if self.index_key != (cik, since, until):
+            # Every search term of a company is run against the same index so only keep the last one
+            self.index = bm25_index.InMemoryBM25Index(list(self.load_text_lines(cik, since, until)))
+            self.index_key = (cik, since, until)
+            _logger.info("Indexed {count} text_line for cik:{cik}".format(count=len(self.index), cik=cik))
+
+        stats = None if self.corpus_statistics is None else self.corpus_statistics(search_term)
+        for doc, score in self.index.search(search_term, exclude=EXCLUDE_TERMS, stats=stats):
+            yield dict(doc, score=score)
+
+
+def corpus_statistics_from_elasticsearch(es: elasticsearch.Elasticsearch):
+    """
+    The shard statistics of the text_line content field from the term vectors of the search term as a document
+    :param es:
+    :return: function of the search term for InMemoryBackend
+    """
+    cache = {}
+
+    def corpus_statistics(search_term: str):
+        if search_term not in cache:
+            body = {"doc": {"content": search_term},
+                    "fields": ["content"],
+                    "term_statistics": True,
+                    "field_statistics": True,
+                    "positions": False,
+                    "offsets": False}
+            content = es.termvectors(index="text_line", body=body, request_timeout=300)['term_vectors']['content']
+            field_statistics = content['field_statistics']
+            cache[search_term] = {"doc_count": field_statistics['doc_count'],
+                                  "avg_doc_length": field_statistics['sum_ttf'] / max(field_statistics['doc_count'], 1),
+                                  "doc_freqs": {token: term.get('doc_freq', 0)
+                                                for token, term in content['terms'].items()}}
+        return cache[search_term]
+
+    return corpus_statistics
+
+
+def corpus_statistics_from_dir(text_line_dir: str):
+    """
+    The statistics saved by dump_text_lines to {text_line_dir}/corpus_statistics.json
+    :param text_line_dir:
+    :return: function of the search term for InMemoryBackend or None if they were never dumped
+    """
+    path = os.path.join(text_line_dir, "corpus_statistics.json")
+    if not os.path.exists(path):
+        _logger.warning("No {path} so scores use the statistics of the loaded sentences".format(path=path))
+        return None
+    with open(path, 'r') as stats_file:
+        stats = json.load(stats_file)
+    return stats.get
+
+
+def text_lines_from_elasticsearch(es: elasticsearch.Elasticsearch):
+    """
+    Loads a company's 8-K sentences with a single scan of the text_line index
+    :param es:
+    :return: function of (cik, since, until) for InMemoryBackend
+    """
+
+    def load_text_lines(cik: int, since: str = None, until: str = None):
+        s = Search(using=es, index="text_line") \
+            .filter("term", cik=cik) \
+            .filter("term", form_type='8-K') \
+            .params(request_timeout=300)
+        if since is not None:
+            parse_date_range = {"gt": since}
+            if until is not None:
+                parse_date_range["lte"] = until
+            s = s.filter("range", parse_date=parse_date_range)
+
+        for hit in s.scan():
+            yield {"content": hit.content,
+                   "line_number": hit.line_number,
+                   "as_of_date": hit.as_of_date,
+                   "cik": hit.cik,
+                   "form_type": hit.form_type,
+                   "text_source_id": hit.text_source_id,
+                   "text_line_id": hit.meta.id,
+                   "parse_date": getattr(hit, 'parse_date', None)}
+
+    return load_text_lines
+
+
+def text_lines_from_dir(text_line_dir: str):
+    """
+    Loads a company's 8-K sentences from {text_line_dir}/{cik}.jsonl written by dump_text_lines for offline reruns
+    :param text_line_dir:
+    :return: function of (cik, since, until) for InMemoryBackend
+    """
+
+    def load_text_lines(cik: int, since: str = None, until: str = None):
+        with open(os.path.join(text_line_dir, "{cik}.jsonl".format(cik=cik)), 'r') as text_line_file:
+            for line in text_line_file:
+                text_line = json.loads(line)
+                if text_line['form_type'] != '8-K':
+                    continue
+                if since is not None and not sentence_vectors.parsed_between(text_line.get('parse_date'), since, until):
+                    continue
+                yield text_line
+
+    return load_text_lines
+
+
+def dump_text_lines(es: elasticsearch.Elasticsearch, cik: int, text_line_dir: str):
+    """
+    Save a company's 8-K sentences to {text_line_dir}/{cik}.jsonl so the search can be rerun offline. The statistics
+    each search term is scored with are saved to {text_line_dir}/corpus_statistics.json.
+    :param es:
+    :param cik:
+    :param text_line_dir:
+    :return:
+    """
+    corpus_statistics = corpus_statistics_from_elasticsearch(es)
+    with open(os.path.join(text_line_dir, "corpus_statistics.json"), 'w') as stats_file:
+        json.dump({term: corpus_statistics(term) for _, term in capital_allocation_terms()}, stats_file)
+
+    s = Search(using=es, index="text_line") \
+        .filter("term", cik=cik) \
+        .filter("term", form_type='8-K') \
+        .params(request_timeout=300)
+
+    with open(os.path.join(text_line_dir, "{cik}.jsonl".format(cik=cik)), 'w') as text_line_file:
+        for hit in s.scan():
+            text_line = hit.to_dict()
+            text_line['text_line_id'] = hit.meta.id
+            text_line_file.write(json.dumps(text_line) + '\n')
 
-    terms = add_search_term_category('share_repurchase', SHARE_REPURCHASE_TERMS) + \
-            add_search_term_category('mergers_acquisitions', MERGERS_ACQUISITIONS_TERMS) + \
-            add_search_term_category('dividend', DIVIDEND_TERMS) + \
-            add_search_term_category('organic_growth', ORGANIC_GROWTH_TERMS) + \
-            add_search_term_category('debt_reduction', DEBT_REDUCTION_TERMS)
 
-    for term_category, term in terms:
+def search_terms(cik: int, es: elasticsearch.Elasticsearch = None, min_score=12, since: str = None,
+                 until: str = None, backend=None, terms: list = None):
+    """
+    Search indexed sentences for search terms related to capital allocation
+    :param cik:
+    :param es:
+    :param min_score:
+    :param since: Only search text_line parsed after this parse_date. None searches the whole history.
+    :param until: Only search text_line parsed on or before this parse_date. Only applies with since.
+    :param backend: ElasticsearchBackend or InMemoryBackend. Defaults to searching es.
+    :param terms: list of (search_term_category, search_term). Defaults to capital_allocation_terms.
+    :return:
+    """
+    if backend is None:
+        backend = ElasticsearchBackend(es)
+
+    def execute_search(search_term: str, search_term_category: str):
+        """
+        Yield only the ones that have high scores.
+        :param search_term:
+        :param search_term_category:
+        :return:
+        """
+        for hit in backend.search(cik, search_term, since=since, until=until):
+            if hit['score'] > min_score:
+                words = hit['content'].split()
+                if len(words) < 5 or len(words) > 50:
+                    # Probably a header or non pulverized
+                    pass
+                else:
+                    yield {"content": hit['content'],
+                           "line_number": hit['line_number'],
+                           "as_of_date": hit['as_of_date'],
+                           "cik": hit['cik'],
+                           "form_type": hit['form_type'],
+                           "text_source_id": hit['text_source_id'],
+                           "hit_score": hit['score'],
+                           "text_line_id": hit['text_line_id'],
+                           "search_term": search_term,
+                           "search_term_category": search_term_category,
+                           "parse_date": hit.get('parse_date')}
+            else:
+                return
+        return
+
+    for term_category, term in (capital_allocation_terms() if terms is None else terms):
         _logger.info("Executing search for {term} filter by {cik}".format(term=term, cik=cik))
-        cap_alloc_search, qry_term = create_search_for_term(term)
-        for sentence in execute_search(cap_alloc_search, qry_term, term_category):
+        for sentence in execute_search(term, term_category):
             yield sentence
 
     return
 
 
-def process_cik(cik: int, producer: pulsar.Producer, es: elasticsearch.Elasticsearch, min_score=10):
+def vector_search(cik: int, vector_dir: str, min_similarity: float = 0.2, since: str = None, until: str = None):
     """
-    For an individual company search all the search terms.
+    Score every saved sentence vector of a company against the category prototypes in one pass instead of running a
+    query per search term.
     :param cik:
-    :param producer:
+    :param vector_dir: Directory the extract_text workers save sentence vectors to
+    :param min_similarity: Min cosine similarity to the closest category prototype
+    :param since: Only search filings parsed after this parse_date. None searches the whole history.
+    :param until: Only search filings parsed on or before this parse_date. Only applies with since.
+    :return:
+    """
+    categories, prototypes = sentence_vectors.category_prototypes(capital_allocation_terms())
+    vectors, sentences = sentence_vectors.load_cik_vectors(vector_dir, cik, since=since, until=until)
+    _logger.info("Scoring {count} sentence vectors for cik:{cik}".format(count=len(sentences), cik=cik))
+    if len(sentences) == 0:
+        return
+
+    best, similarity = sentence_vectors.best_categories(vectors, prototypes)
+    exclude_words = set(sentence_vectors.TOKEN_PATTERN.findall(' '.join(EXCLUDE_TERMS)))
+    for i in np.nonzero(similarity > min_similarity)[0]:
+        sentence = sentences[i]
+        words = sentence['content'].split()
+        if len(words) < 5 or len(words) > 50:
+            # Probably a header or non pulverized
+            continue
+        if not exclude_words.isdisjoint(sentence_vectors.TOKEN_PATTERN.findall(sentence['content'].lower())):
+            continue
+        yield {"content": sentence['content'],
+               "line_number": sentence['line_number'],
+               "as_of_date": sentence['as_of_date'],
+               "cik": sentence['cik'],
+               "form_type": sentence['form_type'],
+               "text_source_id": sentence['text_source_id'],
+               "hit_score": float(similarity[i]),
+               "text_line_id": sentence['text_line_id'],
+               "search_term": "vector_similarity",
+               "search_term_category": categories[best[i]],
+               "parse_date": sentence.get('parse_date')}
+
+
+def process_cik(cik: int, publisher: AsyncPublisher, es: elasticsearch.Elasticsearch, min_score=10, full=False,
+                backend=None, vector_dir: str = None, min_similarity: float = 0.2, compact: bool = True,
+                lag_secs: float = WATERMARK_LAG_SECS):
+    """
+    For an individual company search all the search terms added since the last successful pass.
+    The watermark stays lag_secs behind the clock so text_line written late are still searched. Sentences in the
+    overlap that were published by the last pass are skipped. Search terms added since the last pass search the
+    whole history. The vector search doesn't use the terms one at a time so it only picks them up going forward.
+    :param cik:
+    :param publisher:
     :param es:
     :param min_score:
+    :param full: Ignore the watermark and search the whole history
+    :param backend: ElasticsearchBackend or InMemoryBackend. Defaults to searching es.
+    :param vector_dir: Score the saved sentence vectors in this directory instead of running the term searches
+    :param min_similarity: Min cosine similarity to a category prototype when using vector_dir
+    :param compact: Send the compact message_schema encoding instead of JSON
+    :param lag_secs: How far the watermark stays behind the clock
     :return:
     """
+    now = datetime.now()
+    watermark = None if full else get_search_watermark(es, cik)
+    since = None if watermark is None else watermark['parse_date']
+    published = {} if watermark is None else {p['key']: p['parse_date'] for p in watermark.get('published', [])}
+    terms = capital_allocation_terms()
+    # Watermarks saved before the terms were recorded count as having searched every term
+    searched = None if watermark is None else watermark.get('search_terms')
+    new_terms = [] if not searched else [term for term in terms if term_key(*term) not in set(searched)]
+    until = latest_parse_date(es, cik)
+    new_text = since is None or (until is not None and parse_datetime(until) > parse_datetime(since))
+    if not new_text and (len(new_terms) == 0 or vector_dir is not None):
+        _logger.info("No new text_line for cik:{cik} since {since}".format(cik=cik, since=since))
+        return
 
-    for sentence in search_terms(cik, es, min_score):
-        msg = json.dumps(sentence).encode('utf-8')
-        producer.send(msg)
+    if vector_dir is not None:
+        sentences = vector_search(cik, vector_dir, min_similarity, since=since, until=until)
+    else:
+        old_terms = [term for term in terms if term not in new_terms]
+        sentences = search_terms(cik, es, min_score, since=since, until=until, backend=backend,
+                                 terms=old_terms if new_text else [])
+        if len(new_terms) > 0:
+            _logger.info("Searching the whole history of cik:{cik} for {count} new search terms".format(
+                cik=cik, count=len(new_terms)))
+            sentences = itertools.chain(sentences, search_terms(cik, es, min_score, backend=backend,
+                                                                terms=new_terms))
+
+    for sentence in sentences:
+        parse_date = sentence.pop('parse_date')
+        key = sentence_key(sentence)
+        if key in published:
+            continue
+        msg = message_schema.encode('sentence', sentence, compact=compact)
+        publisher.send(msg)
+        if parse_date is not None:
+            published[key] = parse_date
+
+    # Raises if any sentence failed to publish so the next pass searches them again
+    publisher.flush()
+    if until is not None:
+        # Only move the watermark once every sentence has been published
+        next_since = lagged_watermark(until, now, lag_secs)
+        overlap = {key: parse_date for key, parse_date in published.items()
+                   if parse_datetime(parse_date) > parse_datetime(next_since)}
+        save_search_watermark(es, cik, next_since, overlap, [term_key(*term) for term in terms])
 
 
 def search_sentences_subscribe(es: elasticsearch.Elasticsearch,
                                sub_topic: str = "search_filings-8-K",
                                pub_topic: str = "classify-sentence",
-                               pulsar_connection_string: str = "pulsar://localhost:6650"):
+                               pulsar_connection_string: str = "pulsar://localhost:6650",
+                               full: bool = False,
+                               backend=None,
+                               vector_dir: str = None,
+                               min_similarity: float = 0.2,
+                               compact: bool = True,
+                               lag_secs: float = WATERMARK_LAG_SECS):
     """
 
     :param es:
     :param sub_topic:
     :param pub_topic:
     :param pulsar_connection_string:
+    :param full: Search every company's whole history instead of what was added since the last pass
+    :param backend: ElasticsearchBackend or InMemoryBackend. Defaults to searching es.
+    :param vector_dir: Score the saved sentence vectors in this directory instead of running the term searches
+    :param min_similarity: Min cosine similarity to a category prototype when using vector_dir
+    :param compact: Send the compact message_schema encoding instead of JSON
+    :param lag_secs: How far the search watermarks stay behind the clock
     :return:
     """
-
+    init_els_index(es)
+    save_search_terms(es)
+    stop = GracefulStop()
     client = pulsar.Client(pulsar_connection_string)
     producer = client.create_producer(topic=pub_topic,
                                       block_if_queue_full=True,
                                       batching_enabled=True,
                                       send_timeout_millis=300000,
-                                      batching_max_publish_delay_ms=120000)
+                                      batching_max_publish_delay_ms=120000,
+                                      compression_type=pulsar.CompressionType.LZ4)
+    publisher = AsyncPublisher(producer)
 
     # Subscribe so the messages don't get delete if there are no live subscribers before you start
     pub_subscription = '{pulsar_topics}-worker'.format(pulsar_topics=pub_topic)
@@ -183,15 +616,18 @@ def search_sentences_subscribe(es: elasticsearch.Elasticsearch,
                                     consumer_name=consumer_name)
 
     _logger.critical("Waiting for message to arrive on {sub_topic}".format(sub_topic=sub_topic))
-    while True:
-        msg = cik_consumer.receive()
+    while not stop.is_set():
+        msg = receive_until_stopped(cik_consumer, stop)
+        if msg is None:
+            continue
         content = msg.data().decode('utf-8')
         _logger.critical("%s received message '%s' id='%s'", consumer_name, content, msg.message_id())
         req = json.loads(content)
         cik = req.get('cik')
         _logger.critical("Processing cik:{cik}'".format(cik=cik))
         try:
-            process_cik(cik=cik, producer=producer, es=es)
+            process_cik(cik=cik, publisher=publisher, es=es, full=full or req.get('full', False), backend=backend,
+                        vector_dir=vector_dir, min_similarity=min_similarity, compact=compact, lag_secs=lag_secs)
             if pub_consumer is not None:
                 pub_consumer.close()
                 pub_consumer = None
@@ -200,6 +636,10 @@ def search_sentences_subscribe(es: elasticsearch.Elasticsearch,
             _logger.error("Error processing bucket:{bucket}".format(bucket=cik) + "\n{0}".format(e))
         cik_consumer.acknowledge(msg)
 
+    # Drained. process_cik flushed the sentences of the company it finished.
+    cik_consumer.close()
+    client.close()
+
 
 def parse_args(args):
     """Parse command line parameters
@@ -239,6 +679,59 @@ def parse_args(args):
                         default='10.0.0.11,10.0.0.12,10.0.0.13'
                         )
 
+    parser.add_argument("-full",
+                        "--full",
+                        help="Ignore the search watermarks and rebuild from the whole filing history",
+                        action="store_true")
+
+    parser.add_argument("-wl",
+                        "--watermark_lag",
+                        help="Seconds the search watermark stays behind the clock so text_line written late by "
+                             "extract_text.py are still searched",
+                        type=float,
+                        default=WATERMARK_LAG_SECS)
+
+    parser.add_argument("-b",
+                        "--backend",
+                        help="Search with the elasticsearch cluster or load each company into an in-memory index",
+                        choices=["elasticsearch", "memory"],
+                        default="elasticsearch")
+
+    parser.add_argument("-tld",
+                        "--text_line_dir",
+                        help="Directory of {cik}.jsonl text_line dumps for the in-memory backend to run offline",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("-vd",
+                        "--vector_dir",
+                        help="Retrieve by scoring the sentence vectors saved by extract_text in this directory "
+                             "against the category prototypes instead of running the term searches",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("-ms",
+                        "--min_similarity",
+                        help="Min cosine similarity to a category prototype for vector retrieval",
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument("-enc",
+                        "--encoding",
+                        help="Encoding of the published sentences. Use json until every classify_sentence.py reads "
+                             "the compact encoding.",
+                        choices=['compact', 'json'],
+                        default='compact')
+
+    parser.add_argument("-cik",
+                        help="Search a single company and print the hits instead of subscribing",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("-dump",
+                        help="Dump the text_line of -cik into --text_line_dir for offline reruns",
+                        action="store_true")
+
     parser.add_argument(
         "--version",
         action="version",
@@ -259,7 +752,10 @@ def parse_args(args):
         help="set loglevel to DEBUG",
         action="store_const",
         const=logging.DEBUG)
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+    if parsed_args.dump and (parsed_args.cik is None or parsed_args.text_line_dir is None):
+        parser.error("-dump needs -cik and --text_line_dir")
+    return parsed_args
 
 
 def setup_logging(loglevel):
@@ -288,8 +784,33 @@ def main(args):
     _logger.debug("Starting search filings subscriber")
     elasticsearch_hosts = args.elasticsearch_hosts.split(',')
     es = elasticsearch.Elasticsearch(elasticsearch_hosts)
+
+    if args.dump:
+        dump_text_lines(es, args.cik, args.text_line_dir)
+        return
+
+    if args.backend == "memory":
+        if args.text_line_dir is not None:
+            backend = InMemoryBackend(text_lines_from_dir(args.text_line_dir),
+                                      corpus_statistics_from_dir(args.text_line_dir))
+        else:
+            backend = InMemoryBackend(text_lines_from_elasticsearch(es), corpus_statistics_from_elasticsearch(es))
+    else:
+        backend = ElasticsearchBackend(es)
+
+    if args.cik is not None:
+        if args.vector_dir is not None:
+            sentences = vector_search(args.cik, args.vector_dir, args.min_similarity)
+        else:
+            sentences = search_terms(args.cik, es, min_score=10, backend=backend)
+        for sentence in sentences:
+            print(json.dumps(sentence))
+        return
+
     search_sentences_subscribe(es=es, sub_topic=args.sub_topic, pub_topic=args.pub_topic,
-                               pulsar_connection_string=args.pulsar_connection_string)
+                               pulsar_connection_string=args.pulsar_connection_string, full=args.full,
+                               backend=backend, vector_dir=args.vector_dir, min_similarity=args.min_similarity,
+                               compact=args.encoding == 'compact', lag_secs=args.watermark_lag)
 
 
 def run():
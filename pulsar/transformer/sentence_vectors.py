@@ -0,0 +1 @@
+../sink/sentence_vectors.py
\ No newline at end of file
@@ -0,0 +1,66 @@
+import types
+import pytest
+import pulsar.pub.async_publisher as async_publisher
+
+Result = types.SimpleNamespace(Ok='Ok', Timeout='Timeout')
+
+
+class FakeProducer:
+    """
+    Holds on to the callbacks until flush like a producer waiting for its batch to fill
+    """
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.pending = []
+        self.persisted = []
+        self.flushes = 0
+
+    def topic(self):
+        return 'fake-topic'
+
+    def send_async(self, data, callback, partition_key=None):
+        self.pending.append((data, callback))
+
+    def flush(self):
+        self.flushes += 1
+        pending, self.pending = self.pending, []
+        for data, callback in pending:
+            if data in self.fail:
+                callback(Result.Timeout, None)
+            else:
+                self.persisted.append(data)
+                callback(Result.Ok, data)
+
+
+@pytest.fixture(autouse=True)
+def pulsar_result(monkeypatch):
+    monkeypatch.setattr(async_publisher.pulsar, 'Result', Result, raising=False)
+
+
+def test_send_acks_on_delivery():
+    producer = FakeProducer(fail={b'2'})
+    publisher = async_publisher.AsyncPublisher(producer, max_in_flight=2)
+    delivered = []
+    for data in [b'1', b'2', b'3']:
+        publisher.send(data, on_delivery=lambda ok, data=data: delivered.append((data, ok)), partition_key='1')
+    # The third send found the window full and pushed out the first two
+    assert producer.flushes == 1
+    assert delivered == [(b'1', True), (b'2', False)]
+    assert publisher.in_flight == 1
+
+    with pytest.raises(RuntimeError):
+        publisher.flush()
+    assert delivered == [(b'1', True), (b'2', False), (b'3', True)]
+    assert publisher.in_flight == 0
+    # The failure is reported once
+    assert publisher.flush() == 2
+
+
+def test_flush_timeout():
+    producer = FakeProducer()
+    publisher = async_publisher.AsyncPublisher(producer)
+    publisher.send(b'1')
+    producer.flush = lambda: None
+    with pytest.raises(RuntimeError):
+        publisher.flush(timeout=0.01)
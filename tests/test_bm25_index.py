@@ -0,0 +1,29 @@
+import pulsar.transformer.bm25_index as bm25
+
+
+def test_search_bm25_index():
+    docs = [{'content': 'The board approved a new share repurchase program.'},
+            {'content': 'The company completed the share repurchase program.'},
+            {'content': 'Revenue increased in the fourth quarter.'},
+            {'content': 'The board authorized a stock buyback and a new share repurchase program of $500 million.'}]
+    index = bm25.InMemoryBM25Index(docs)
+    hits = list(index.search("authorized approved new stock repurchase buyback program", exclude=["completed"]))
+
+    assert [doc['content'] for doc, score in hits] == [docs[3]['content'], docs[0]['content']]
+    assert hits[0][1] > hits[1][1] > 0
+
+
+def test_lucene_doc_length():
+    assert [bm25.lucene_doc_length(length) for length in [23, 24, 40, 41, 51, 100]] == [23, 24, 40, 40, 50, 96]
+
+
+def test_score_with_shard_statistics():
+    docs = [{'content': 'The board approved a new stock repurchase program.'},
+            {'content': ' '.join(['repurchase'] * 2 + ['word'] * 49)}]
+    index = bm25.InMemoryBM25Index(docs)
+    stats = {'doc_count': 1000, 'avg_doc_length': 20.0, 'doc_freqs': {'repurchase': 10, 'program': 50, 'stock': 100}}
+    hits = list(index.search("stock repurchase program", stats=stats))
+
+    # Elasticsearch 7 explain: 2.2 * idf * freq / (freq + 1.2 * (0.25 + 0.75 * dl / avgdl)) per query token with
+    # idf = log(1 + (N - n + 0.5) / (n + 0.5)) and a 51 token dl stored as 50
+    assert [round(score, 4) for _, score in hits] == [13.0446, 4.4071]
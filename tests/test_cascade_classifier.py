@@ -0,0 +1,38 @@
+import frontend.cascade_classifier as cascade
+
+
+def test_cascade_classify():
+    sentences = ['The board declared a quarterly cash dividend {0}.'.format(i) for i in range(100)] + \
+                ['The company repaid debt to reduce leverage {0}.'.format(i) for i in range(100)]
+    labels = ['dividend'] * 100 + ['debt_reduction'] * 100
+    model = cascade.HashedLinearModel(['dividend', 'debt_reduction']).fit(sentences, labels, epochs=10)
+
+    slow_calls = []
+
+    def slow_classify(uncertain):
+        slow_calls.extend(uncertain)
+        return [{'dividend': 0.5, 'debt_reduction': 0.5} for _ in uncertain]
+
+    cats, fast_count = cascade.cascade_classify(model, ['The board declared a cash dividend.', 'Hello world.'],
+                                                slow_classify, margin=0.3)
+    assert fast_count == 1 and slow_calls == ['Hello world.']
+    assert cascade.top_label(cats[0]) == 'dividend' and set(cats[0].keys()) == {'dividend', 'debt_reduction'}
+
+
+def test_calibrate_matches_target_scores(tmp_path):
+    sentences = ['The board declared a quarterly cash dividend {0}.'.format(i) for i in range(100)] + \
+                ['The company repaid debt to reduce leverage {0}.'.format(i) for i in range(100)]
+    labels = ['dividend'] * 100 + ['debt_reduction'] * 100
+    model = cascade.HashedLinearModel(['dividend', 'debt_reduction']).fit(sentences, labels, epochs=10)
+
+    # Scores softer than the linear model's own softmax
+    model.temperature = 2.0
+    target_cats = [dict(zip(model.labels, map(float, probs))) for probs in model.predict_proba(sentences)]
+    model.temperature = 1.0
+    identity = model.identity
+    model.calibrate(sentences, target_cats)
+    assert abs(model.temperature - 2.0) < 0.1 and model.identity != identity
+
+    model.save(str(tmp_path / 'cascade.npz'))
+    loaded = cascade.HashedLinearModel.load(str(tmp_path / 'cascade.npz'))
+    assert loaded.temperature == model.temperature and loaded.identity == model.identity
@@ -0,0 +1,59 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import frontend.classify_service as service
+
+
+def test_micro_batcher_merges_requests():
+    batches = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def classify(sentences):
+        started.set()
+        release.wait(5)
+        batches.append(list(sentences))
+        return [{'sentence': sentence} for sentence in sentences]
+
+    batcher = service.MicroBatcher(classify, ThreadPoolExecutor(1), workers=1, batch_size=64, max_wait_ms=5).start()
+    results = {}
+
+    def client(i):
+        results[i] = batcher.classify(['a{0}'.format(i), 'b{0}'.format(i)], timeout=10)
+
+    # The first request occupies the only worker so the rest queue up and go out together
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while batcher.queue.qsize() < 4:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(batches) == 2 and len(batches[1]) == 8
+    assert all(results[i] == [{'sentence': 'a{0}'.format(i)}, {'sentence': 'b{0}'.format(i)}] for i in range(5))
+    stats = batcher.stats()
+    assert stats['requests'] == 5 and stats['sentences'] == 10 and stats['mean_batch_size'] == 5
+
+
+def test_micro_batcher_queue_full_and_timeout():
+    release = threading.Event()
+
+    def classify(sentences):
+        release.wait(5)
+        return [{} for _ in sentences]
+
+    batcher = service.MicroBatcher(classify, ThreadPoolExecutor(1), workers=1, max_queue=1)
+    batcher.submit(['waiting'], timeout=0.05)
+    with pytest.raises(queue.Full):
+        batcher.submit(['rejected'], timeout=1)
+
+    batcher.start()
+    with pytest.raises(TimeoutError):
+        batcher.classify(['slow'], timeout=0.05)
+    release.set()
+    assert batcher.stats()['rejected'] == 1 and batcher.stats()['timeouts'] == 1
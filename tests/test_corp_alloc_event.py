@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import types
+
+# corp_alloc_event.py imports message_schema from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'sink'))
+import message_schema
+from async_publisher import AsyncPublisher
+import pulsar.sink.corp_alloc_event as corp_alloc_event
+
+Result = types.SimpleNamespace(Ok='Ok', Timeout='Timeout')
+
+
+class FakeEs:
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requests = []
+
+    def bulk(self, body, request_timeout=None):
+        docs = body[1::2]
+        self.requests.append(docs)
+        return {'items': [{'index': {'status': self.statuses[doc['content']].pop(0), 'error': 'failed'}}
+                          for doc in docs]}
+
+
+class FakeMsg:
+
+    def __init__(self, doc, compact=True):
+        """
+        :param doc: The message or raw bytes
+        :param compact: Send the compact encoding rather than JSON like old producers
+        """
+        self.doc = doc
+        self.compact = compact
+
+    def data(self):
+        if not isinstance(self.doc, dict):
+            return self.doc
+        return message_schema.encode('cap_alloc_event', self.doc, compact=self.compact)
+
+    def message_id(self):
+        return id(self)
+
+
+class FakeConsumer:
+
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+
+    def acknowledge(self, msg):
+        self.acked.append(msg)
+
+    def negative_acknowledge(self, msg):
+        self.nacked.append(msg)
+
+
+class FakeProducer:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, properties=None, partition_key=None):
+        self.sent.append((data, properties))
+
+
+class FakeAsyncProducer:
+    """
+    Holds on to the sends until flush like a producer waiting for its batch to fill
+    """
+
+    def __init__(self, result='Ok'):
+        self.result = result
+        self.pending = []
+        self.sent = []
+
+    def topic(self):
+        return 'cik-changed'
+
+    def send_async(self, data, callback, partition_key=None):
+        self.pending.append((data, callback))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for data, callback in pending:
+            self.sent.append(data)
+            callback(self.result, None)
+
+
+def test_process_batch(monkeypatch):
+    monkeypatch.setattr(corp_alloc_event.time, 'sleep', lambda secs: None)
+    monkeypatch.setattr(corp_alloc_event.pulsar, 'Result', Result, raising=False)
+    es = FakeEs({'ok': [201],
+                 'retried': [429, 201],
+                 'overloaded': [429, 429],
+                 'bad': [400]})
+    # Old producers send JSON
+    msgs = [FakeMsg({'content': content, 'as_of_date': '2020-02-01', 'cik': len(content)}, compact=content != 'ok')
+            for content in ['ok', 'retried', 'overloaded', 'bad']] + [FakeMsg(b'not json')]
+    consumer = FakeConsumer()
+    producer = FakeProducer()
+    changed_producer = FakeAsyncProducer()
+    changed_publisher = AsyncPublisher(changed_producer)
+
+    indexed, dead_lettered, redelivered = corp_alloc_event.process_batch(es, consumer, producer, msgs, max_retries=1,
+                                                                         changed_publisher=changed_publisher)
+    assert (indexed, dead_lettered, redelivered) == (2, 2, 1)
+    assert [len(docs) for docs in es.requests] == [4, 2]
+    assert consumer.nacked == [msgs[2]]
+    assert set(consumer.acked) == {msgs[0], msgs[1], msgs[3], msgs[4]}
+    assert [data for data, _ in producer.sent] == [b'not json', msgs[3].data()]
+    # Flushed before the batch was acked
+    assert changed_producer.pending == []
+    assert sorted(json.loads(data)['cik'] for data in changed_producer.sent) == [2, 7]
+
+
+def test_process_batch_redelivers_unsignalled_events(monkeypatch):
+    monkeypatch.setattr(corp_alloc_event.pulsar, 'Result', Result, raising=False)
+    es = FakeEs({'ok': [201]})
+    msgs = [FakeMsg({'content': 'ok', 'as_of_date': '2020-02-01', 'cik': 2})]
+    consumer = FakeConsumer()
+
+    indexed, dead_lettered, redelivered = corp_alloc_event.process_batch(
+        es, consumer, FakeProducer(), msgs, changed_publisher=AsyncPublisher(FakeAsyncProducer(Result.Timeout)))
+    assert (indexed, dead_lettered, redelivered) == (0, 0, 1)
+    assert consumer.acked == [] and consumer.nacked == msgs
+
+
+def test_compact_cap_alloc_events(monkeypatch):
+    doc = {'cik': 1, 'text_line_id': 'a-1', 'search_term': 'cash dividend', 'search_term_category': 'dividend',
+           'classifier_version': 'm-2', 'indexed_at': '2020-02-02'}
+    doc_id = corp_alloc_event.cap_alloc_event_id(doc)
+    assert doc_id == 'a-1|dividend'
+    assert corp_alloc_event.cap_alloc_event_id(dict(doc, classifier_version='m-1')) == doc_id
+    # Another term of the same category finds the same event
+    assert corp_alloc_event.cap_alloc_event_id(dict(doc, search_term='special dividend')) == doc_id
+    hits = [{'_id': 'auto1', '_source': dict(doc, classifier_version='m-1')},
+            {'_id': doc_id, '_source': doc},
+            {'_id': 'a-1|dividend|m-1', '_source': dict(doc, classifier_version='m-1')},
+            {'_id': 'auto3', '_source': dict(doc, text_line_id='b-2', indexed_at='2020-02-01')},
+            {'_id': 'auto4', '_source': dict(doc, text_line_id='b-2', indexed_at='2020-02-03')},
+            {'_id': 'auto5', '_source': dict(doc, text_line_id='c-3')},
+            {'_id': 'auto6', '_source': dict(doc, text_line_id='d-4')},
+            {'_id': 'auto7', '_source': dict(doc, search_term='special dividend')}]
+    for seq_no, hit in enumerate(hits):
+        hit.update(_seq_no=seq_no, _primary_term=1)
+    bulk_actions = []
+
+    def bulk(es, actions, **kwargs):
+        bulk_actions.extend(actions)
+        # The sink wrote c-3 after the scan and d-4 can't be created
+        statuses = {'c-3|dividend': 409, 'd-4|dividend': 500}
+        return 0, [{action['_op_type']: {'_id': action['_id'], 'status': statuses[action['_id']]}}
+                   for action in actions if action['_id'] in statuses]
+
+    monkeypatch.setattr(corp_alloc_event.helpers, 'scan', lambda es, index, query: iter(hits))
+    monkeypatch.setattr(corp_alloc_event.helpers, 'bulk', bulk)
+
+    kept, deleted = corp_alloc_event.compact_cap_alloc_events(None, ciks=[1])
+    assert (kept, deleted) == (4, 6)
+    creates = [action for action in bulk_actions if action['_op_type'] == 'create']
+    # The newest copy is moved
+    assert [(action['_id'], action['_source']['indexed_at']) for action in creates] == [
+        ('b-2|dividend', '2020-02-03'), ('c-3|dividend', '2020-02-02'), ('d-4|dividend', '2020-02-02')]
+    deletes = [action for action in bulk_actions if action['_op_type'] == 'delete']
+    assert [(action['_id'], action['if_seq_no']) for action in deletes] == [
+        ('auto1', 0), ('a-1|dividend|m-1', 2), ('auto7', 7), ('auto3', 3), ('auto4', 4), ('auto5', 5)]
+
+
+def test_backfill_top_category_filters_ciks():
+    class UpdateEs:
+        def update_by_query(self, index, body, conflicts, request_timeout):
+            self.body = body
+            return {'updated': 2}
+
+    es = UpdateEs()
+    assert corp_alloc_event.backfill_top_category(es, ciks=[1, 2]) == 2
+    assert es.body['query']['bool']['filter'] == {'terms': {'cik': [1, 2]}}
+    assert 'probs == null' in es.body['script']['source']
+
+    corp_alloc_event.backfill_top_category(es)
+    assert 'filter' not in es.body['query']['bool']
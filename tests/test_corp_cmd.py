@@ -0,0 +1,86 @@
+from datetime import datetime
+import pulsar.pub.corp_cmd as corp_cmd
+
+
+class FakeEs:
+
+    def __init__(self, ciks_by_index, corp_desc):
+        self.ciks_by_index = ciks_by_index
+        self.corp_desc = corp_desc
+        self.searches = []
+
+    def search(self, index, body, request_timeout=None):
+        self.searches.append((index, body['query']['range']))
+        composite = body['aggs']['ciks']['composite']
+        ciks = [cik for cik in self.ciks_by_index[index] if cik > composite.get('after', {}).get('cik', -1)]
+        page = ciks[:composite['size']]
+        ciks = {'buckets': [{'key': {'cik': cik}} for cik in page]}
+        if len(page) > 0:
+            ciks['after_key'] = {'cik': page[-1]}
+        return {'aggregations': {'ciks': ciks}}
+
+    def mget(self, index, body):
+        return {'docs': [{'_id': cik, 'found': True, '_source': self.corp_desc[cik]} if cik in self.corp_desc
+                         else {'_id': cik, 'found': False} for cik in body['ids']]}
+
+
+def test_corp_desc_delta():
+    corp_desc = {cik: {'symbol': 'S{0}'.format(cik), 'name': 'Company {0}'.format(cik)} for cik in [1, 2, 3, 5, 8]}
+    es = FakeEs({'text_source': [1, 3, 4, 5], 'cap_alloc_event': [2, 3, 8, 9]}, corp_desc)
+
+    corps = list(corp_cmd.corp_desc_delta(es, {'text_source': '2020-01-01'},
+                                          {'text_source': '2020-02-01', 'cap_alloc_event': '2020-02-02'},
+                                          page_size=2))
+    assert [corp['cik'] for corp in corps] == [1, 2, 3, 5, 8]
+    assert corps[0] == {'cik': 1, 'symbol': 'S1', 'company_name': 'Company 1'}
+    assert ('text_source', {'parse_date': {'gt': '2020-01-01', 'lte': '2020-02-01'}}) in es.searches
+    assert ('cap_alloc_event', {'indexed_at': {'lte': '2020-02-02'}}) in es.searches
+
+
+def test_publish_delta(monkeypatch):
+    class DeltaEs(FakeEs):
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.docs = {('search_watermark', 'search_terms'): {'search_terms': ['dividend|dividend']}}
+
+        def get(self, index, id):
+            if (index, id) not in self.docs:
+                raise corp_cmd.elasticsearch.exceptions.NotFoundError(404, 'not found', {})
+            return {'_source': self.docs[(index, id)]}
+
+        def index(self, index, id, body):
+            self.docs[(index, id)] = body
+
+    published = []
+
+    def publish_companies(corps, pub_topic, pulsar_connection_string, full):
+        published.append(([corp['cik'] for corp in corps], full))
+        return len(published[-1][0])
+
+    corp_desc = {cik: {'symbol': 'S{0}'.format(cik), 'name': 'Company {0}'.format(cik)} for cik in [1, 2, 3]}
+    es = DeltaEs({'text_source': [1], 'cap_alloc_event': [2]}, corp_desc)
+    monkeypatch.setattr(corp_cmd, 'init_els_index', lambda es: None)
+    monkeypatch.setattr(corp_cmd, 'latest_date', lambda es, index, field: '2020-02-01T00:00:00.000Z')
+    monkeypatch.setattr(corp_cmd, 'publish_companies', publish_companies)
+    monkeypatch.setattr(corp_cmd, 'corp_desc_list_cik', lambda es: ({'cik': cik} for cik in corp_desc))
+
+    # The search topic ignores the events the last search indexed and passes --full on
+    assert corp_cmd.publish_delta(es, full=True) == 1
+    assert published[-1] == ([1], True)
+    assert set(index for index, _ in es.searches) == {'text_source'}
+    watermark = es.docs[('publish_watermark', 'search_filings-8-K')]
+    assert watermark['watermarks'] == {'text_source': '2020-02-01T00:00:00'}
+    assert watermark['search_terms'] == ['dividend|dividend']
+
+    # New search terms need every company searched
+    es.docs[('search_watermark', 'search_terms')] = {'search_terms': ['dividend|dividend', 'dividend|special']}
+    assert corp_cmd.publish_delta(es) == 3
+    assert published[-1] == ([1, 2, 3], False)
+
+    # The timeline topic only follows the events
+    corp_cmd.publish_delta(es, pub_topic='create-timeline')
+    assert published[-1] == ([2], False)
+    assert es.searches[-1][0] == 'cap_alloc_event'
+
+    # The watermark stays behind the clock
+    assert corp_cmd.lagged_date('2020-02-01T00:00:00.000Z', datetime(2020, 2, 1, 0, 10)) == '2020-01-31T23:55:00'
@@ -1,3 +1,9 @@
+import os
+import sys
+import json
+
+# create_timeline.py imports its helpers from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'sink'))
 import pulsar.sink.create_timeline as timeline
 
 
@@ -17,3 +23,95 @@ def test_do_create_timeline():
              }]
     timeline_doc = timeline.do_create_timeline(999, docs)
     assert timeline_doc['first_date'] == '2020-02-01' and timeline_doc['last_date'] == '2020-02-11'
+
+
+def test_timeline_builder_resumes_from_state():
+    categories = ['dividend', 'dividend', 'share_repurchase', 'dividend', 'debt_reduction', 'debt_reduction']
+    docs = [{'content': 'Sentence {0}'.format(i % 5),
+             'search_term_category': category,
+             'as_of_date': '2020-02-{0:02d}'.format(i + 1),
+             'text_source_id': 'ts{0}'.format(i),
+             'line_number': i,
+             'capital_allocation': {category: 0.9, 'unknown': 0.1}} for i, category in enumerate(categories)]
+
+    for split in range(len(docs) + 1):
+        builder = timeline.TimelineBuilder(999)
+        for doc in docs[:split]:
+            builder.add(doc)
+        resumed = timeline.TimelineBuilder(999, json.loads(json.dumps(builder.state())))
+        for doc in docs[split:]:
+            resumed.add(doc)
+        assert resumed.timeline() == timeline.do_create_timeline(999, docs)
+
+
+def test_timeline_builder_detects_reclassified_sentences():
+    def doc(content, as_of_date, classifier_version='v1'):
+        return {'content': content, 'search_term_category': 'dividend', 'as_of_date': as_of_date,
+                'classifier_version': classifier_version, 'capital_allocation': {'dividend': 0.9}}
+
+    builder = timeline.TimelineBuilder(999)
+    builder.add(doc('Boilerplate', '2018-01-01'))
+    builder.add(doc('New sentence', '2020-01-01', 'v2'))
+    resumed = timeline.TimelineBuilder(999, json.loads(json.dumps(builder.state())))
+    assert resumed.seen(doc('Boilerplate', '2018-01-01'))
+    # A reclassified sentence is a new event
+    assert not resumed.seen(doc('Boilerplate', '2018-01-01', 'v2'))
+
+    # A repeated sentence only counts once however far apart and whatever model classified it
+    resumed.add(doc('Boilerplate', '2021-01-01'))
+    resumed.add(doc('New sentence', '2021-02-01', 'v1'))
+    assert resumed.timeline()['events'][0]['sentence_count'] == 2
+
+
+def test_aggregate_timeline():
+    def states(buckets):
+        return {'states': {'buckets': [{'key': key, 'doc_count': count,
+                                        'sentence': {'hits': {'hits': [{'sort': [prob],
+                                                                        '_source': {'content': text}}]}}}
+                                       for key, count, prob, text in buckets]}}
+
+    pages = [{'aggregations': {'days': {'after_key': {'day': '2020-02-02'}, 'buckets': [
+        {'key': {'day': '2020-02-01'}, 'confident': states([('dividend', 2, 0.9, 'Dividend')]),
+         'unsure': states([('dividend', 1, 0.6, 'Maybe dividend')])},
+        {'key': {'day': '2020-02-02'}, 'confident': states([('dividend', 1, 0.8, 'Another dividend'),
+                                                            ('debt_reduction', 1, 0.95, 'Repaid')]),
+         'unsure': states([])}]}}},
+             {'aggregations': {'days': {'buckets': [
+                 {'key': {'day': '2020-03-01'}, 'confident': states([('share_repurchase', 3, 0.9, 'Buyback')]),
+                  'unsure': states([])}]}}}]
+    requests = []
+
+    class FakeEs:
+        def search(self, index, body, request_timeout=None):
+            requests.append(dict(body['aggs']['days']['composite']))
+            return pages[len(requests) - 1]
+
+    timeline_doc = timeline.aggregate_timeline(FakeEs(), 999)
+    assert requests[1]['after'] == {'day': '2020-02-02'}
+    assert [(event['start'], event['end'], event['corp_alloc'], event['sentence_count'], event['sentence'])
+            for event in timeline_doc['events']][:1] == [('2020-02-01', '2020-03-01', 'dividend', 4, 'Dividend')]
+    assert timeline_doc['first_date'] == '2020-02-01' and len(timeline_doc['events']) == 2
+
+
+def test_write_timelines_skips_unchanged(monkeypatch):
+    unchanged = {'cik': 1, 'last_date': '2020-02-01',
+                 'events': [{'start': '2020-01-01', 'end': '2020-02-01', 'corp_alloc': 'dividend'}]}
+    changed = {'cik': 2, 'last_date': '2020-02-01',
+               'events': [{'start': '2020-01-01', 'end': '2020-02-01', 'corp_alloc': 'dividend'}]}
+    stored_hash = timeline.events_hash(dict(unchanged, events=[dict(unchanged['events'][0], end='2019-12-31')]))
+    written = []
+
+    class FakeEs:
+        def mget(self, index, body, _source_includes=None):
+            return {'docs': [{'_id': 'A', 'found': True,
+                              '_source': {'events_hash': stored_hash, 'last_date': '2020-02-01'}},
+                             {'_id': 'B', 'found': True, '_source': {'events_hash': 'old', 'last_date': '2020-02-01'}},
+                             {'_id': 'C', 'found': False},
+                             # Same periods but written on an earlier day
+                             {'_id': 'D', 'found': True,
+                              '_source': {'events_hash': stored_hash, 'last_date': '2019-12-31'}}]}
+
+    monkeypatch.setattr(timeline.helpers, 'bulk', lambda es, actions, **kwargs: written.extend(actions))
+    assert timeline.write_timelines(FakeEs(), {'A': unchanged, 'B': changed, 'C': dict(changed),
+                                               'D': dict(unchanged)}) == (3, 1)
+    assert [action['_id'] for action in written] == ['B', 'C', 'D']
@@ -0,0 +1,16 @@
+import pulsar.transformer.debounce_timeline as debounce_timeline
+
+
+def test_debouncer_coalesces_per_cik():
+    debouncer = debounce_timeline.Debouncer(window_secs=60)
+    debouncer.add(1, 'a', now=0)
+    debouncer.add(2, 'b', now=10)
+    debouncer.add(1, 'c', now=30)
+    assert debouncer.next_due() == 60
+    assert debouncer.pop_due(now=59) == []
+    assert debouncer.pop_due(now=60) == [(1, ['a', 'c'])]
+
+    # A signal after the request opens a new window
+    debouncer.add(1, 'd', now=61)
+    assert debouncer.pop_due(now=70) == [(2, ['b'])]
+    assert debouncer.pop_due(now=121) == [(1, ['d'])] and debouncer.next_due() is None
@@ -1,3 +1,9 @@
+import os
+import sys
+import json
+
+# extract_text.py imports its helpers from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'sink'))
 import pulsar.sink.extract_text as et
 
 
@@ -6,3 +12,15 @@ def test_extract_sentences():
         raw_filing = f.read()
         sentences = et.extract_sentences(raw_filing)
     assert len(sentences) > 0
+
+
+def test_filing_chunks():
+    lines = [{'content': 'Sentence {0} of a long filing.'.format(i), 'line_number': i,
+              'text_line_id': 'ts-{0}'.format(i)} for i in range(1, 101)]
+    filing = {'text_source_id': 'ts', 'cik': 1, 'form_type': '8-K', 'as_of_date': '2019-10-24',
+              'parse_date': '2019-10-24T12:00:00', 'lines': lines}
+    chunks = list(et.filing_chunks(filing, max_bytes=1000))
+    assert len(chunks) > 1
+    assert all(len(json.dumps(chunk)) <= 1000 for chunk in chunks)
+    assert [line for chunk in chunks for line in chunk['lines']] == lines
+    assert all(chunk['text_source_id'] == 'ts' and chunk['cik'] == 1 for chunk in chunks)
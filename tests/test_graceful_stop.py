@@ -0,0 +1,44 @@
+import os
+import signal
+import pytest
+import pulsar.pub.graceful_stop as graceful_stop
+
+
+class FakeConsumer:
+
+    def __init__(self, msgs, stop=None, closed=False):
+        self.msgs = msgs
+        self.stop = stop
+        self.closed = closed
+        self.receives = 0
+
+    def receive(self, timeout_millis=None):
+        self.receives += 1
+        if self.closed:
+            raise Exception('Pulsar error: AlreadyClosed')
+        if len(self.msgs) > 0:
+            return self.msgs.pop(0)
+        if self.stop is not None and self.receives >= 3:
+            os.kill(os.getpid(), signal.SIGTERM)
+        raise Exception('Pulsar error: TimeOut')
+
+
+def test_receive_until_stopped():
+    previous = signal.getsignal(signal.SIGTERM)
+    try:
+        stop = graceful_stop.GracefulStop()
+        assert graceful_stop.receive_until_stopped(FakeConsumer(['msg']), stop) == 'msg'
+        assert graceful_stop.receive_until_stopped(FakeConsumer([]), stop, timeout_millis=5, poll_millis=1) is None
+        # A closed consumer raises instead of spinning
+        consumer = FakeConsumer([], closed=True)
+        with pytest.raises(Exception, match='AlreadyClosed'):
+            graceful_stop.receive_until_stopped(consumer, stop, poll_millis=1)
+        assert consumer.receives == 1
+
+        # Waiting without a timeout returns once SIGTERM arrives
+        consumer = FakeConsumer([], stop)
+        assert graceful_stop.receive_until_stopped(consumer, stop, poll_millis=1) is None
+        assert stop.is_set() and consumer.receives == 3
+        assert graceful_stop.receive_until_stopped(FakeConsumer(['msg']), stop) is None
+    finally:
+        signal.signal(signal.SIGTERM, previous)
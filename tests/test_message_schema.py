@@ -0,0 +1,46 @@
+import json
+import struct
+import pulsar.transformer.message_schema as message_schema
+
+
+def test_encode_decode():
+    event = message_schema.synthetic_messages(1)[0]
+    compact = message_schema.encode('cap_alloc_event', event)
+    assert compact[:1] == message_schema.MAGIC_BYTE
+    assert len(compact) < len(json.dumps(event)) / 2
+    assert message_schema.decode(compact) == event
+
+    # Old producers send JSON
+    assert message_schema.decode(json.dumps(event).encode('utf-8')) == event
+
+    # Missing fields stay missing and an unusual text_line_id is sent in full
+    sentence = {key: event[key] for key in ['content', 'cik', 'text_source_id', 'search_term_category']}
+    sentence['text_line_id'] = 'elsewhere-1'
+    assert message_schema.decode(message_schema.encode('sentence', sentence)) == sentence
+
+
+def test_probabilities_are_not_rounded():
+    event = dict(message_schema.synthetic_messages(1)[0],
+                 capital_allocation=dict(zip(message_schema.CATEGORIES, [0.1, 0.2, 0.3, 0.15, 0.25])))
+    assert message_schema.decode(message_schema.encode('cap_alloc_event', event)) == event
+
+    # Messages from version 1 still in the topic decode with float32 probabilities
+    old = message_schema.decode(message_schema.CAP_ALLOC_EVENT_V1.encode(event))
+    assert old['capital_allocation']['dividend'] == struct.unpack('f', struct.pack('f', 0.2))[0]
+
+
+def test_falls_back_to_json():
+    event = message_schema.synthetic_messages(1)[0]
+    for doc in [dict(event, cik=str(event['cik'])),
+                dict(event, full=True),
+                dict(event, classifier_version=None),
+                dict(event, capital_allocation={'other': 1.0})]:
+        data = message_schema.encode('cap_alloc_event', doc)
+        assert json.loads(data.decode('utf-8')) == doc
+        assert message_schema.decode(data) == doc
+    assert json.loads(message_schema.encode('cap_alloc_event', event, compact=False).decode('utf-8')) == event
+
+
+def test_benchmark():
+    results = message_schema.benchmark(message_schema.synthetic_messages(50), 'cap_alloc_event', batch_size=10)
+    assert results['compact']['bytes'] < results['json']['bytes']
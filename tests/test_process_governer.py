@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import pytest
+import pulsar.process_governer as governer
+
+
+def test_local_metrics(tmp_path):
+    path = tmp_path / 'stats.json'
+    path.write_text(json.dumps({'msgRateIn': 12.5,
+                                'subscriptions': {'classify-sentence-worker': {'msgBacklog': 4200,
+                                                                               'msgRateOut': 30.0}}}))
+    metrics = governer.backlog_metrics('file:' + str(path), 'classify-sentence', 'classify-sentence-worker')
+    assert metrics() == {'backlog': 4200, 'rate_out': 30.0, 'rate_in': 12.5}
+    # A missing subscription isn't an empty backlog
+    with pytest.raises(ValueError):
+        governer.backlog_metrics('file:' + str(path), 'classify-sentence', 'classify-sentence-workers')()
+    assert governer.topic_path('classify-sentence') == 'persistent/public/default/classify-sentence'
+    assert governer.topic_path('persistent://corp/alloc/cap-alloc-event') == 'persistent/corp/alloc/cap-alloc-event'
+
+
+def test_autoscaler():
+    autoscaler = governer.Autoscaler(1, 8, backlog_per_replica=1000, up_cooldown_secs=60, down_cooldown_secs=300)
+
+    def decide(replicas, backlog, now):
+        return autoscaler.decide(replicas, {'backlog': backlog, 'rate_out': 10.0, 'rate_in': 5.0}, now=now)[0]
+
+    assert decide(2, 5500, now=0) == 6
+    # Cooling down
+    assert decide(6, 20000, now=30) == 6
+    assert decide(6, 20000, now=61) == 8
+    # Between the scale down and scale up thresholds
+    assert decide(8, 5000, now=1000) == 8
+    # Scale down waits for its cooldown then goes one at a time
+    autoscaler.last_scaled = 1000
+    assert decide(8, 0, now=1100) == 8
+    assert decide(8, 0, now=1400) == 7
+    assert decide(7, 0, now=1500) == 7
+    assert decide(7, 0, now=1800) == 6
+    assert decide(0, 0, now=1801) == 1
+
+
+def handle_next_exit(events, now=None):
+    group, slot, proc, exit_code = events.get(timeout=10)
+    group.on_exit(slot, proc, exit_code, now=now)
+    return exit_code
+
+
+def test_crash_loop_backoff():
+    events = governer.queue.Queue()
+    group = governer.ProcessGroup('crash', [sys.executable, '-c', 'import sys; sys.exit(3)'], 1, events,
+                                  backoff_secs=0.1, crash_loop_failures=3)
+    slot = group.slots[0]
+    for restarts in range(1, 4):
+        time.sleep(max(slot.next_start - time.time(), 0))
+        group.tick()
+        now = time.time()
+        assert handle_next_exit(events, now=now) == 3
+        assert slot.restarts == restarts
+    assert slot.crash_looping
+    status = group.status(now=now)['slots'][0]
+    assert status == {'slot': 0, 'pid': None, 'uptime_secs': None, 'rss_mb': None, 'restarts': 3, 'failures': 3,
+                      'last_exit_code': 3, 'crash_looping': True, 'next_start_in_secs': 0.4}
+
+
+def test_scale_down_drains():
+    events = governer.queue.Queue()
+    ignores_sigterm = 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print(1, flush=True); ' \
+                      'time.sleep(30)'
+    group = governer.ProcessGroup('drain', [sys.executable, '-c', ignores_sigterm], 2, events, drain_secs=0.2,
+                                  popen_kwargs={'stdout': subprocess.PIPE})
+    group.tick()
+    # Wait for the handler to be installed
+    for slot in group.slots:
+        slot.child.stdout.readline()
+    kept = group.slots[0].child
+    stopped = group.slots[1].child
+
+    group.scale(1)
+    assert group.stopping.keys() == {stopped}
+    time.sleep(0.3)
+    group.tick()
+    assert handle_next_exit(events) == -signal.SIGKILL
+    assert group.stopping == {}
+    # Stopped processes aren't restarted
+    assert group.slots[0].child is kept and group.slots[0].restarts == 0
+
+    group.drain_secs = 0.2
+    group.stop_all()
+    assert kept.returncode == -signal.SIGKILL
+
+
+def test_load_pipeline_config(tmp_path):
+    config = {'admin_url': 'file:stats.json',
+              'stages': [{'name': 'classify_sentence', 'command': ['python', 'classify_sentence.py'],
+                          'cwd': 'transformer', 'replicas': 2, 'cpus': '0', 'memory_mb': 4096,
+                          'autoscale': {'topic': 'classify-sentence', 'max_replicas': 4}},
+                         {'name': 'corp_alloc_event', 'command': ['python', 'corp_alloc_event.py'], 'cpus': [0]}]}
+    path = tmp_path / 'pipeline.json'
+    path.write_text(json.dumps(config))
+    loaded = governer.load_pipeline_config(str(path))
+    assert loaded['admin_url'] == 'file:stats.json'
+    classify, sink = loaded['stages']
+    assert (classify['cwd'], classify['cpus'], classify['memory_mb']) == (str(tmp_path / 'transformer'), {0}, 4096)
+    assert classify['autoscale']['min_replicas'] == 1
+    assert (sink['replicas'], sink['cwd'], sink['autoscale']) == (1, str(tmp_path), None)
+
+    events = governer.queue.Queue()
+    group, autoscaler, metrics = governer.pipeline_stage(classify, loaded['admin_url'], events)
+    assert (group.replicas, autoscaler.max_replicas, metrics.subscription) == (2, 4, 'classify-sentence-worker')
+
+    assert governer.parse_cpus('0-3,6') == {0, 1, 2, 3, 6}
+    for bad_stage in [{'name': 'no_command'},
+                      {'name': 'typo', 'command': ['python'], 'replica': 2},
+                      {'name': 'too_many_cpus', 'command': ['python'], 'cpus': [1024]}]:
+        path.write_text(json.dumps({'stages': [bad_stage]}))
+        with pytest.raises(ValueError):
+            governer.load_pipeline_config(str(path))
+
+
+def test_pinning_and_memory_ceiling():
+    events = governer.queue.Queue()
+    cpu = min(os.sched_getaffinity(0))
+    group = governer.ProcessGroup('hog', [sys.executable, '-c', 'x = bytearray(64 * 1024 ** 2); print(1, flush=True);'
+                                                                 'import time; time.sleep(30)'], 1, events,
+                                  cpus={cpu}, memory_mb=32, popen_kwargs={'stdout': subprocess.PIPE})
+    group.tick()
+    slot = group.slots[0]
+    hog = slot.child
+    hog.stdout.readline()
+    assert os.sched_getaffinity(hog.pid) == {cpu}
+    assert group.status()['slots'][0]['rss_mb'] > 32
+
+    group.check_memory()
+    assert handle_next_exit(events) == -signal.SIGTERM
+    # Restarted in the same slot
+    assert (slot.restarts, slot.last_exit_code) == (1, -signal.SIGTERM)
+    group.tick(now=slot.next_start)
+    assert slot.child is not None and slot.child is not hog
+    group.stop_all()
+
+
+def test_shipped_pipeline_config(caplog):
+    path = os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'pipeline.json')
+    loaded = governer.load_pipeline_config(path)
+    # Loads on any number of cores without overlapping pins
+    assert not [record for record in caplog.records if 'share cpus' in record.getMessage()]
+    stages = {stage['name']: stage for stage in loaded['stages']}
+    # Every streaming stage runs so the percolate-8-K and cik-changed topics are consumed
+    assert set(stages) == {'extract_text', 'percolate_sentences', 'search_filings', 'classify_sentence',
+                           'corp_alloc_event', 'debounce_timeline', 'create_timeline'}
+    assert stages['extract_text']['command'][-2:] == ['-pt', 'percolate-8-K']
+    for stage in stages.values():
+        assert os.path.exists(os.path.join(os.path.dirname(path), stage['cwd'], stage['command'][1]))
+    # extract_text.py subscribes to the extract-text-.* pattern
+    _, _, metrics = governer.pipeline_stage(stages['extract_text'], loaded['admin_url'], governer.queue.Queue())
+    assert metrics.subscription == 'extract-text-.*-worker'
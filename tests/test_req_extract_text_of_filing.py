@@ -0,0 +1,114 @@
+import os
+import sys
+import threading
+
+# req_extract_text_of_filing.py imports async_publisher from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'pub'))
+import pulsar.pub.req_extract_text_of_filing as req_extract
+
+
+class FakeS3:
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.listed = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        self.listed.append(Prefix)
+        keys = sorted(key for key in self.keys if key.startswith(Prefix))
+        for i in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': key} for key in keys[i:i + 2]]}
+
+
+class FakePublisher:
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.sent = []
+
+    def send(self, data, on_delivery=None):
+        self.sent.append(data)
+        on_delivery(data not in self.fail)
+
+    def flush(self):
+        raise AssertionError("Companies must not flush the shared publisher")
+
+
+class DelayedPublisher(FakePublisher):
+    """
+    Delivers on another thread after the send returns like the pulsar client
+    """
+
+    def send(self, data, on_delivery=None):
+        self.sent.append(data)
+        threading.Timer(0.01, on_delivery, [data not in self.fail]).start()
+
+
+def test_extract_text_ciks(monkeypatch):
+    s3 = FakeS3(['1|8-K|20191024|a.txt', '1|10-K|20191024|b.txt', '1|8-K|20191025|c.txt', '1|S-1|20191024|d.txt',
+                 '2|8-K|20191024|e.txt', '3|8-K|20191024|f.txt', '11|8-K|20191024|g.txt'])
+    monkeypatch.setattr(req_extract.boto3, 'client', lambda service: s3)
+    failing = b'{"bucket": "bkt", "key": "3|8-K|20191024|f.txt"}'
+    producer_pool = {'8-K': FakePublisher(fail={failing}), '10-K': FakePublisher()}
+
+    published = list(req_extract.extract_text_ciks(['1', '2', '3'], form_types='8-K,10-K', date_str='20191024',
+                                                   bucket='bkt', producer_pool=producer_pool, concurrency=2))
+    assert sorted(published) == ['1', '2']
+    # One listing per company
+    assert sorted(s3.listed) == ['1|', '2|', '3|']
+    assert sorted(producer_pool['8-K'].sent) == [b'{"bucket": "bkt", "key": "1|8-K|20191024|a.txt"}',
+                                                 b'{"bucket": "bkt", "key": "2|8-K|20191024|e.txt"}', failing]
+    assert producer_pool['10-K'].sent == [b'{"bucket": "bkt", "key": "1|10-K|20191024|b.txt"}']
+
+
+def test_failure_only_fails_its_company(monkeypatch):
+    ciks = [str(cik) for cik in range(1, 9)]
+    s3 = FakeS3(['{0}|8-K|20191024|{0}.txt'.format(cik) for cik in ciks])
+    monkeypatch.setattr(req_extract.boto3, 'client', lambda service: s3)
+    failing = b'{"bucket": "bkt", "key": "3|8-K|20191024|3.txt"}'
+
+    published = list(req_extract.extract_text_ciks(ciks, form_types='8-K', date_str='20191024', bucket='bkt',
+                                                   producer_pool={'8-K': DelayedPublisher(fail={failing})},
+                                                   concurrency=8))
+    assert sorted(published) == ['1', '2', '4', '5', '6', '7', '8']
+
+
+def test_publish_journal(monkeypatch, tmp_path):
+    s3 = FakeS3(['1|8-K|20191024|a.txt', '1|8-K|20191025|b.txt', '2|8-K|20191024|c.txt', '2|8-K|20191025|d.txt'])
+    monkeypatch.setattr(req_extract.boto3, 'client', lambda service: s3)
+    path = str(tmp_path / 'cik.txt.journal')
+    journal = req_extract.PublishJournal(path, 'bkt', '8-K', fsync_secs=0)
+    failing = b'{"bucket": "bkt", "key": "2|8-K|20191025|d.txt"}'
+    published = list(req_extract.extract_text_ciks(['1', '2'], form_types='8-K', date_str=None, bucket='bkt',
+                                                   producer_pool={'8-K': FakePublisher(fail={failing})},
+                                                   journal=journal))
+    assert published == ['1']
+    journal.close()
+    # Killed in the middle of a write
+    with open(path, 'a') as f:
+        f.write('key\tbkt\t2|8-K')
+
+    journal = req_extract.PublishJournal(path, 'bkt', '8-K')
+    assert journal.ciks == {'1'}
+    assert journal.keys == {'1|8-K|20191024|a.txt', '1|8-K|20191025|b.txt', '2|8-K|20191024|c.txt'}
+    report = req_extract.dry_run(['1', '2'], form_types='8-K', date_str=None, bucket='bkt', journal=journal)
+    assert report == {'ciks_done': 1, 'ciks_left': 1, 'keys_done': 3, 'keys_left': 1,
+                      'keys_left_by_form_type': {'8-K': 1}}
+
+    # Only the filing that failed is published again
+    publisher = FakePublisher()
+    assert list(req_extract.extract_text_ciks(['2'], form_types='8-K', date_str=None, bucket='bkt',
+                                              producer_pool={'8-K': publisher}, journal=journal)) == ['2']
+    assert publisher.sent == [failing]
+    journal.close()
+    assert req_extract.PublishJournal(path, 'bkt', '8-K').ciks == {'1', '2'}
+
+    # A cik is only complete for the options it was published with
+    other_date = req_extract.PublishJournal(path, 'bkt', '8-K', filing_date='20191024')
+    assert other_date.ciks == set()
+    assert len(other_date.keys) == 4
+    assert req_extract.PublishJournal(path, 'other', '8-K').keys == set()
@@ -0,0 +1,121 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+# search_filings.py imports its helpers from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'transformer'))
+import message_schema
+import pulsar.transformer.search_filings as search_filings
+
+
+class FakeEs:
+
+    def __init__(self):
+        self.watermarks = {}
+
+    def get(self, index, id):
+        if id not in self.watermarks:
+            raise search_filings.elasticsearch.exceptions.NotFoundError(404, 'not found', {})
+        return {'_source': self.watermarks[id]}
+
+    def index(self, index, body, id):
+        self.watermarks[id] = body
+
+
+class FakeBackend:
+
+    def __init__(self):
+        self.text_lines = []
+
+    def search(self, cik, search_term, since=None, until=None):
+        for text_line in self.text_lines:
+            parse_date = search_filings.parse_datetime(text_line['parse_date'])
+            if since is not None and (parse_date <= search_filings.parse_datetime(since)
+                                      or parse_date > search_filings.parse_datetime(until)):
+                continue
+            yield dict(text_line, score=20.0)
+
+
+class FakePublisher:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(message_schema.decode(data))
+
+    def flush(self):
+        pass
+
+
+def text_line(line_number, parse_date):
+    return {'content': 'The board approved a new stock repurchase program of up to $500 million.',
+            'line_number': line_number, 'as_of_date': '2019-10-24', 'cik': 1, 'form_type': '8-K',
+            'text_source_id': 'ts', 'text_line_id': 'ts-{0}'.format(line_number), 'parse_date': parse_date}
+
+
+def test_late_text_line_searched_once(monkeypatch):
+    es = FakeEs()
+    backend = FakeBackend()
+    monkeypatch.setattr(search_filings, 'capital_allocation_terms',
+                        lambda: [('share_repurchase', 'stock repurchase program')])
+    now = datetime.now()
+    first = (now - timedelta(seconds=10)).isoformat()
+    backend.text_lines = [text_line(1, first)]
+    monkeypatch.setattr(search_filings, 'latest_parse_date', lambda es, cik: first)
+
+    publisher = FakePublisher()
+    search_filings.process_cik(1, publisher, es, backend=backend)
+    assert [sentence['text_line_id'] for sentence in publisher.sent] == ['ts-1']
+    # The watermark stays behind the clock
+    assert search_filings.parse_datetime(es.watermarks[1]['parse_date']) < now - timedelta(seconds=600)
+
+    # A slow write shows up with an older parse_date than the line already searched
+    backend.text_lines.append(text_line(2, (now - timedelta(seconds=20)).isoformat()))
+    publisher = FakePublisher()
+    search_filings.process_cik(1, publisher, es, backend=backend)
+    assert [sentence['text_line_id'] for sentence in publisher.sent] == ['ts-2']
+
+    # Once the clock passes the lag the watermark catches up and the published keys are dropped
+    publisher = FakePublisher()
+    search_filings.process_cik(1, publisher, es, backend=backend, lag_secs=0)
+    assert publisher.sent == []
+    assert es.watermarks[1]['parse_date'] == search_filings.parse_datetime(first).isoformat()
+    assert es.watermarks[1]['published'] == []
+
+
+def test_in_memory_min_score(monkeypatch):
+    monkeypatch.setattr(search_filings, 'capital_allocation_terms',
+                        lambda: [('share_repurchase', 'stock repurchase program')])
+    text_lines = [dict(text_line(1, None), content='The board approved a new stock repurchase program.'),
+                  dict(text_line(2, None), content='The notes repurchase was announced by the company today.')]
+    stats = {'doc_count': 1000, 'avg_doc_length': 20.0, 'doc_freqs': {'repurchase': 10, 'program': 50, 'stock': 100}}
+    backend = search_filings.InMemoryBackend(lambda cik, since, until: text_lines, lambda search_term: stats)
+
+    # Elasticsearch scores the first 13.0446 and the second 5.8805 so only the first is over min_score
+    hits = list(search_filings.search_terms(1, min_score=10, backend=backend))
+    assert [(hit['text_line_id'], round(hit['hit_score'], 4)) for hit in hits] == [('ts-1', 13.0446)]
+
+
+def test_new_search_term_searches_history(monkeypatch):
+    es = FakeEs()
+    backend = FakeBackend()
+    terms = [('share_repurchase', 'stock repurchase program')]
+    monkeypatch.setattr(search_filings, 'capital_allocation_terms', lambda: list(terms))
+    parse_date = (datetime.now() - timedelta(days=1)).isoformat()
+    backend.text_lines = [text_line(1, parse_date)]
+    monkeypatch.setattr(search_filings, 'latest_parse_date', lambda es, cik: parse_date)
+
+    search_filings.process_cik(1, FakePublisher(), es, backend=backend)
+    assert es.watermarks[1]['search_terms'] == ['share_repurchase|stock repurchase program']
+
+    # No new text_line but the new term still searches the whole history
+    terms.append(('share_repurchase', 'buyback'))
+    publisher = FakePublisher()
+    search_filings.process_cik(1, publisher, es, backend=backend)
+    assert [(sentence['text_line_id'], sentence['search_term']) for sentence in publisher.sent] == [('ts-1', 'buyback')]
+    assert len(es.watermarks[1]['search_terms']) == 2
+
+    publisher = FakePublisher()
+    search_filings.process_cik(1, publisher, es, backend=backend)
+    assert publisher.sent == []
@@ -1,3 +1,4 @@
+import os
 import frontend.sentence_classifier as classifier
 
 
@@ -7,3 +8,30 @@ def test_classify_sentence():
         format="dic")
 
     assert cats['debt_reduction'] > 0.7
+
+
+def test_model_identity_includes_weights(tmp_path):
+    (tmp_path / 'textcat').mkdir()
+    (tmp_path / 'textcat' / 'model').write_bytes(b'weights')
+    meta = {'name': 'corp_alloc_bal', 'version': '2.0.0'}
+    os.utime(tmp_path / 'textcat' / 'model', ns=(0, 0))
+    before = classifier.model_identity(meta, classifier.weights_stamp(tmp_path))
+    assert classifier.model_identity(meta, classifier.weights_stamp(tmp_path)) == before
+    # Retrained weights of the same size
+    (tmp_path / 'textcat' / 'model').write_bytes(b'retrain')
+    assert classifier.model_identity(meta, classifier.weights_stamp(tmp_path)) != before
+
+
+def test_cache_evicts_by_age_and_size(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    old_model = classifier.ClassificationCache('old-model', path=path)
+    old_model.put_many({'a': {'dividend': 1.0}, 'b': {'dividend': 1.0}})
+    old_model.db.execute("UPDATE classification SET created = 0 WHERE key = 'a'")
+    old_model.db.commit()
+
+    # Another model's recent classifications are kept for the processes still using it
+    new_model = classifier.ClassificationCache('new-model', path=path, max_rows=2)
+    assert new_model.db.execute("SELECT key FROM classification").fetchall() == [('b',)]
+    new_model.put_many({'c': {'dividend': 1.0}, 'd': {'dividend': 1.0}})
+    assert new_model.evict() == 1
+    assert sorted(new_model.get_many(['b', 'c', 'd'])) == ['c', 'd']
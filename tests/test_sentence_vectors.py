@@ -0,0 +1,31 @@
+import numpy as np
+import pulsar.sink.sentence_vectors as sv
+
+
+def test_vector_retrieval(tmp_path):
+    terms = [('share_repurchase', 'announced authorized approved new equity shares stock repurchase buyback program'),
+             ('dividend', 'pay cash declared increase special authorized approved extraordinary dividend')]
+    categories, prototypes = sv.category_prototypes(terms)
+
+    lines = [{'content': 'The board approved a new stock repurchase program.', 'line_number': 1,
+              'text_line_id': 'ts-1'},
+             {'content': 'The board declared a special cash dividend.', 'line_number': 2, 'text_line_id': 'ts-2'}]
+    filing = {'text_source_id': 'ts', 'cik': 1, 'form_type': '8-K', 'as_of_date': '2020-02-01',
+              'parse_date': '2020-02-02T00:00:00', 'lines': lines}
+    sv.save_filing_vectors(str(tmp_path), filing, sv.vectorize([line['content'] for line in lines]))
+
+    vectors, sentences = sv.load_cik_vectors(str(tmp_path), 1)
+    assert vectors.dtype == np.float16 and vectors.shape == (2, sv.DIMENSIONS)
+    assert [sentence['text_line_id'] for sentence in sentences] == ['ts-1', 'ts-2']
+
+    best, similarity = sv.best_categories(vectors, prototypes)
+    assert [categories[i] for i in best] == ['share_repurchase', 'dividend']
+    assert sv.load_cik_vectors(str(tmp_path), 1, since='2020-02-03')[0].shape[0] == 0
+
+
+def test_parsed_between():
+    # isoformat from extract_text.py against value_as_string from an Elasticsearch max aggregation
+    assert sv.parsed_between('2019-10-24T12:00:00.123456', '2019-10-24T12:00:00.123Z')
+    assert not sv.parsed_between('2019-10-24T12:00:00', '2019-10-24T12:00:00.000Z')
+    assert sv.parsed_between('2019-10-24 12:00:01', '2019-10-24T12:00:00Z', until='2019-10-24T12:00:01.000Z')
+    assert not sv.parsed_between(None, '2019-10-24')
@@ -0,0 +1,39 @@
+import os
+import sys
+
+# create_timeline.py imports its helpers from its own directory like when it is run as a script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pulsar', 'sink'))
+import pulsar.sink.create_timeline as create_timeline
+import pulsar.sink.timeline_engine as timeline_engine
+
+
+def test_build_timelines_matches_do_create_timeline():
+    docs_by_cik = timeline_engine.synthetic_events(cik_count=50, events_per_cik=40, seed=1)
+    docs_by_cik[50] = [{'content': 'Only one', 'as_of_date': '2020-02-01', 'search_term_category': 'new_category',
+                        'capital_allocation': {'dividend': 0.2, 'new_label': 0.8}}]
+    # Repeats count once however far apart and whatever model classified them
+    docs_by_cik[51] = [{'content': 'Boilerplate', 'as_of_date': as_of_date, 'search_term_category': 'dividend',
+                        'classifier_version': classifier_version, 'capital_allocation': {'dividend': 0.9}}
+                       for as_of_date, classifier_version in [('2018-01-01', 'v1'), ('2020-01-01', 'v1'),
+                                                              ('2020-02-01', 'v2')]]
+    events = timeline_engine.TimelineEvents()
+    # Interleave companies to check events are grouped without losing their order
+    for i in range(40):
+        for cik, docs in docs_by_cik.items():
+            if i < len(docs):
+                events.add(cik, docs[i])
+
+    timelines = timeline_engine.build_timelines(events)
+    assert timelines == {cik: create_timeline.do_create_timeline(cik, docs) for cik, docs in docs_by_cik.items()}
+
+
+def test_build_timelines_breaks_ties_like_do_create_timeline():
+    docs = [{'content': 'First', 'as_of_date': '2020-02-01', 'search_term_category': 'b',
+             'capital_allocation': {'b': 0.3, 'a': 0.3}},
+            {'content': 'Second', 'as_of_date': '2020-03-01', 'search_term_category': 'a',
+             'capital_allocation': {'a': 0.3, 'b': 0.3}}]
+    events = timeline_engine.TimelineEvents.from_docs({1: docs})
+
+    timelines = timeline_engine.build_timelines(events)
+    assert len(timelines[1]['events']) == 2
+    assert timelines[1] == create_timeline.do_create_timeline(1, docs)